@@ -1,6 +1,7 @@
 import logging
+import os
 from collections import defaultdict, deque
-from typing import List, Tuple, Optional, Dict, Any, Deque, Sequence
+from typing import List, Tuple, Optional, Dict, Any, Deque, Sequence, Iterable
 from functools import partial, lru_cache
 
 import torch
@@ -13,7 +14,7 @@ from duorat.models.pointer import Pointer
 from duorat.asdl.asdl import ASDLPrimitiveType
 from duorat.asdl.transition_system import Partial, MaskAction
 
-from duorat.models.utils import _flip_attention_mask
+from duorat.models.utils import _flip_attention_mask, _scatter_logsumexp
 from duorat.preproc.duorat import (
     duo_rat_decoder_batch,
     duo_rat_encoder_batch,
@@ -44,6 +45,7 @@ from duorat.types import (
     DuoRATBatch,
     DuoRATEncoderBatch,
     DuoRATDecoderBatch,
+    DuoRATPreparedMemory,
     QuestionToken,
     ColumnToken,
     TableToken,
@@ -60,7 +62,8 @@ from duorat.types import (
 )
 from duorat.models.rat import RATLayerWithMemory, RATLayer
 from duorat.utils import registry
-from duorat.utils.beam_search import beam_search, Candidate, FinishedBeam
+from duorat.utils.beam_search import batched_beam_search, Candidate, FinishedBeam
+from duorat.utils.item_store import ItemStore, item_key
 
 logger = logging.getLogger(__name__)
 
@@ -257,6 +260,15 @@ class DuoRATModel(torch.nn.Module):
 
         self.mask_sampling_config = BernoulliMaskConfig(p_mask=decoder["p_mask"])
 
+        # items built offline by tensorize.py, for this configuration and vocabulary
+        self.item_store = ItemStore(
+            path=os.path.join(
+                preproc.save_path,
+                "items",
+                item_key((encoder, decoder, preproc.target_vocab.itos)),
+            )
+        )
+
     def compute_loss(
         self, preproc_items: List[RATPreprocItem], debug=False
     ) -> torch.Tensor:
@@ -541,6 +553,154 @@ class DuoRATModel(torch.nn.Module):
         assert target.shape == (batch_size, max_tgt_length, self.decoder_rat_embed_dim)
         return target
 
+    def _prepare_memory(self, memory: torch.Tensor) -> DuoRATPreparedMemory:
+        """Project the memory once for all decoder layers and for the pointer network,
+        so that the projections can be shared by all decoding steps and hypotheses."""
+        return DuoRATPreparedMemory(
+            memory=memory,
+            memory_key_values=tuple(
+                layer.project_memory(memory) for layer in self.decoder_rat_layers
+            ),
+            pointer_keys=self.pointer_network.prepare_keys(memory),
+        )
+
+    @staticmethod
+    def _select_prepared_memory(
+        prepared_memory: DuoRATPreparedMemory, index: List[int], memory_length: int
+    ) -> DuoRATPreparedMemory:
+        """Get the prepared memory of the question of each hypothesis,
+        truncated to the memory length of the longest of these questions."""
+        (num_questions, _max_src_length, _mem_embed_dim) = prepared_memory.memory.shape
+        if num_questions == 1:
+            # expand, so that the projections are not copied
+            batch_size = len(index)
+            return DuoRATPreparedMemory(
+                memory=prepared_memory.memory.expand(batch_size, -1, -1)[
+                    :, :memory_length
+                ],
+                memory_key_values=tuple(
+                    (
+                        k.expand(batch_size, -1, -1, -1)[:, :, :memory_length],
+                        v.expand(batch_size, -1, -1, -1)[:, :, :memory_length],
+                    )
+                    for k, v in prepared_memory.memory_key_values
+                ),
+                pointer_keys=prepared_memory.pointer_keys.expand(batch_size, -1, -1)[
+                    :, :memory_length
+                ],
+            )
+        else:
+            _index = torch.tensor(index, device=prepared_memory.memory.device)
+            return DuoRATPreparedMemory(
+                memory=prepared_memory.memory[_index, :memory_length],
+                memory_key_values=tuple(
+                    (k[_index, :, :memory_length], v[_index, :, :memory_length])
+                    for k, v in prepared_memory.memory_key_values
+                ),
+                pointer_keys=prepared_memory.pointer_keys[_index, :memory_length],
+            )
+
+    def _decode_incremental(
+        self,
+        prepared_memory: DuoRATPreparedMemory,
+        batch: DuoRATDecoderBatch,
+        past_key_values: Optional[Tuple[Tuple[torch.Tensor, torch.Tensor], ...]],
+    ) -> Tuple[torch.Tensor, Tuple[Tuple[torch.Tensor, torch.Tensor], ...]]:
+        """Decode only the target positions that are not covered by past_key_values.
+
+        past_key_values holds, for each decoder layer, the self-attention keys and
+        values of the first past_len target positions. Since target positions only
+        attend backwards, their outputs do not change when the target is extended.
+
+        Output shapes:
+            - target:     (batch_size, max_tgt_length - past_len, decoder_rat_embed_dim)
+            - key_values: num_layers x 2 x (batch_size, num_heads, max_tgt_length, head_dim)
+        """
+        device = next(self.parameters()).device
+
+        memory = prepared_memory.memory
+        (batch_size, max_src_length, _encoder_rat_embed_dim) = memory.shape
+        past_len = 0 if past_key_values is None else past_key_values[0][0].shape[2]
+        target = torch.cat(
+            (
+                self.target_embed(
+                    self._get_targets_as_input(batch)[:, past_len:].to(device=device)
+                ),
+                self.frontier_field_embed(
+                    batch.frontier_fields[:, past_len:].to(device=device)
+                ),
+                self.frontier_field_type_embed(
+                    batch.frontier_field_types[:, past_len:].to(device=device)
+                ),
+            ),
+            dim=2,
+        )
+        (_batch_size, max_tgt_length) = batch.target_key_padding_mask.shape
+        assert _batch_size == batch_size
+        assert target.shape == (
+            batch_size,
+            max_tgt_length - past_len,
+            self.decoder_rat_embed_dim,
+        )
+        target_relations = self.target_relation_embed(
+            batch.target_relations[:, past_len:].to(device=device)
+        )
+        assert target_relations.shape == (
+            batch_size,
+            max_tgt_length - past_len,
+            max_tgt_length,
+            self.decoder_rat_head_dim,
+        )
+        memory_relations = self.memory_relation_embed(
+            self._get_memory_relations(batch)[:, past_len:].to(device=device)
+        )
+        assert memory_relations.shape == (
+            batch_size,
+            max_tgt_length - past_len,
+            max_src_length,
+            self.decoder_rat_head_dim,
+        )
+        target_attention_mask = _flip_attention_mask(
+            mask=batch.target_attention_mask[:, past_len:].to(device=device)
+        )
+        memory_attention_mask = _flip_attention_mask(
+            mask=batch.memory_attention_mask[:, past_len:].to(device=device)
+        )
+        target_key_padding_mask = ~batch.target_key_padding_mask.to(device=device)
+        memory_key_padding_mask = ~batch.memory_key_padding_mask.to(device=device)
+        key_values = []
+        for layer_id, layer in enumerate(self.decoder_rat_layers):
+            target, key_value = layer.forward_incremental(
+                x=target,
+                memory=memory,
+                relations_k=target_relations,
+                memory_relations_k=memory_relations,
+                relations_v=target_relations,
+                memory_relations_v=memory_relations,
+                attention_mask=target_attention_mask,
+                memory_attention_mask=memory_attention_mask,
+                key_padding_mask=target_key_padding_mask,
+                memory_key_padding_mask=memory_key_padding_mask,
+                past_key_value=None
+                if past_key_values is None
+                else past_key_values[layer_id],
+                memory_key_value=prepared_memory.memory_key_values[layer_id],
+            )
+            key_values.append(key_value)
+        assert target.shape == (
+            batch_size,
+            max_tgt_length - past_len,
+            self.decoder_rat_embed_dim,
+        )
+        return target, tuple(key_values)
+
+    @staticmethod
+    def _get_cacheable_length(batch: DuoRATDecoderBatch) -> int:
+        """Number of leading target positions whose decoder states stay unchanged
+        when the next action is added. The last position holds the mask action
+        that will be replaced with the predicted action, hence it is excluded."""
+        return batch.masked_target.shape[1] - 1
+
     @staticmethod
     def _get_targets_as_input(batch: DuoRATDecoderBatch) -> torch.Tensor:
         return batch.masked_target
@@ -556,16 +716,33 @@ class DuoRATModel(torch.nn.Module):
         beam_size: int,
     ) -> List[FinishedBeam]:
         assert len(preproc_items) == 1
+        (finished_beams,) = self.parse_batch(
+            preproc_items=preproc_items,
+            decode_max_time_step=decode_max_time_step,
+            beam_size=beam_size,
+        )
+        return finished_beams
+
+    def parse_batch(
+        self,
+        preproc_items: List[RATPreprocItem],
+        decode_max_time_step: int,
+        beam_size: int,
+    ) -> List[List[FinishedBeam]]:
+        """Parse several questions at once.
+        The questions are encoded together and their beams are decoded in lockstep."""
         if not self.grammar_constrained_inference:
             assert beam_size == 1
-        preproc_item = preproc_items[0]
-        encoder_item, encoder_item_builder = self._get_encoder_item(
-            preproc_item=preproc_item
+        encoder_items, encoder_item_builders = zip(
+            *(
+                self._get_encoder_item(preproc_item=preproc_item)
+                for preproc_item in preproc_items
+            )
         )
-        memory = self._encode(batch=duo_rat_encoder_batch(items=[encoder_item]))
+        memory = self._encode(batch=duo_rat_encoder_batch(items=encoder_items))
         return self.parse_decode(
-            encoder_item_builder=encoder_item_builder,
-            memory=memory,
+            encoder_item_builders=encoder_item_builders,
+            memory=self._prepare_memory(memory),
             beam_size=beam_size,
             decode_max_time_step=decode_max_time_step,
             grammar_constrained_inference=self.grammar_constrained_inference,
@@ -602,6 +779,7 @@ class DuoRATModel(torch.nn.Module):
             positioned_source_tokens=positioned_source_tokens,
             target_vocab=self.preproc.target_vocab,
             transition_system=self.preproc.transition_system,
+            valid_actions_mask_table=self.preproc.valid_actions_mask_table,
             allow_unk=True,
             source_attention_scoping=self.source_attention_scoping,
             target_attention_scoping=self.target_attention_scoping,
@@ -610,30 +788,49 @@ class DuoRATModel(torch.nn.Module):
             device=device,
         )
 
+    def _get_item(
+        self, preproc_item: RATPreprocItem, device: torch.device
+    ) -> DuoRATItem:
+        return duo_rat_item(
+            preproc_item=preproc_item,
+            get_encoder_item=partial(self._get_encoder_item, device=device),
+            get_decoder_item=partial(self._get_decoder_item, device=device),
+        )
+
     @lru_cache(maxsize=None)
     def _get_item_cached(self, preproc_item: RATPreprocItem) -> DuoRATItem:
         if torch.cuda.is_available():
             device = torch.device("cuda")
         else:
             device = torch.device("cpu")
-        return duo_rat_item(
-            preproc_item=preproc_item,
-            get_encoder_item=partial(self._get_encoder_item, device=device),
-            get_decoder_item=partial(self._get_decoder_item, device=device),
-        )
+        item = self.item_store.get(key=item_key(preproc_item), device=device)
+        if item is None:
+            item = self._get_item(preproc_item=preproc_item, device=device)
+        return item
 
-    def parse_decode(
-        self,
-        encoder_item_builder: DuoRATEncoderItemBuilder,
-        memory: torch.Tensor,
-        beam_size: int,
-        decode_max_time_step: int,
-        grammar_constrained_inference: bool,
-    ) -> List[FinishedBeam]:
+    def tensorize(self, section: str, preproc_items: Iterable[RATPreprocItem]) -> int:
+        """Build the items of a section on the CPU and write them to the item store.
+        Returns the number of distinct items written."""
+        with self.item_store.writer(section) as writer:
+            for preproc_item in preproc_items:
+                key = item_key(preproc_item)
+                if key not in writer:
+                    writer.add(
+                        key,
+                        self._get_item(
+                            preproc_item=preproc_item, device=torch.device("cpu")
+                        ),
+                    )
+            return len(writer)
+
+    @staticmethod
+    def _get_position_maps(
+        positioned_source_tokens: Sequence[Token[InputId, str]]
+    ) -> Tuple[Dict[Any, Deque[Any]], Dict[Any, Deque[Any]], Dict[Any, Deque[Any]]]:
         question_position_map: Dict[Any, Deque[Any]] = defaultdict(deque)
         columns_position_map: Dict[Any, Deque[Any]] = defaultdict(deque)
         tables_position_map: Dict[Any, Deque[Any]] = defaultdict(deque)
-        for positioned_source_token in encoder_item_builder.positioned_source_tokens:
+        for positioned_source_token in positioned_source_tokens:
             if isinstance(positioned_source_token, QuestionToken):
                 question_position_map[positioned_source_token.raw_value].append(
                     positioned_source_token.position
@@ -652,23 +849,69 @@ class DuoRATModel(torch.nn.Module):
                         positioned_source_token.__repr__()
                     )
                 )
+        return question_position_map, columns_position_map, tables_position_map
 
-        initial_hypothesis = DuoRATHypothesis(
-            beam_builder=DuoRATDecoderItemBuilder(
-                positioned_source_tokens=encoder_item_builder.positioned_source_tokens,
-                target_vocab=self.preproc.target_vocab,
-                transition_system=self.preproc.transition_system,
-                allow_unk=False,
-                source_attention_scoping=self.source_attention_scoping,
-                target_attention_scoping=self.target_attention_scoping,
-                target_relation_types=self.target_relation_types,
-                memory_relation_types=self.memory_relation_types,
-            ),
-            scores=[],
-            tokens=[],
+    def _get_copy_groups(
+        self,
+        positioned_source_tokens: Sequence[Token[InputId, str]],
+        device: Optional[torch.device] = None,
+    ) -> Tuple[torch.Tensor, List[Any]]:
+        """Group the source positions by the value that copying from them produces.
+        Returns the group index of each source position and the value of each group."""
+        if device is None:
+            device = next(self.parameters()).device
+        copy_group_values = []
+        copy_group_positions = []
+        for position_map in self._get_position_maps(
+            positioned_source_tokens=positioned_source_tokens
+        ):
+            for token_value, positions in position_map.items():
+                copy_group_values.append(token_value)
+                copy_group_positions.append(positions)
+        copy_group_index = torch.full(
+            (1 + max(token.position for token in positioned_source_tokens),),
+            fill_value=len(copy_group_values),
+            dtype=torch.long,
         )
-        res = beam_search(
-            initial_hypothesis,
+        for copy_group_id, positions in enumerate(copy_group_positions):
+            copy_group_index[list(positions)] = copy_group_id
+        return copy_group_index.to(device=device), copy_group_values
+
+    def parse_decode(
+        self,
+        encoder_item_builders: Sequence[DuoRATEncoderItemBuilder],
+        memory: DuoRATPreparedMemory,
+        beam_size: int,
+        decode_max_time_step: int,
+        grammar_constrained_inference: bool,
+    ) -> List[List[FinishedBeam]]:
+        copy_groups = [
+            self._get_copy_groups(
+                positioned_source_tokens=encoder_item_builder.positioned_source_tokens
+            )
+            for encoder_item_builder in encoder_item_builders
+        ]
+
+        initial_hypotheses = [
+            DuoRATHypothesis(
+                beam_builder=DuoRATDecoderItemBuilder(
+                    positioned_source_tokens=encoder_item_builder.positioned_source_tokens,
+                    target_vocab=self.preproc.target_vocab,
+                    transition_system=self.preproc.transition_system,
+                    valid_actions_mask_table=self.preproc.valid_actions_mask_table,
+                    allow_unk=False,
+                    source_attention_scoping=self.source_attention_scoping,
+                    target_attention_scoping=self.target_attention_scoping,
+                    target_relation_types=self.target_relation_types,
+                    memory_relation_types=self.memory_relation_types,
+                ),
+                scores=[],
+                tokens=[],
+            )
+            for encoder_item_builder in encoder_item_builders
+        ]
+        res = batched_beam_search(
+            initial_hypotheses,
             beam_size,
             decode_max_time_step,
             get_new_hypothesis=lambda candidate: DuoRATHypothesis(
@@ -683,165 +926,207 @@ class DuoRATModel(torch.nn.Module):
                 score=candidate.score,
                 tokens=candidate.prev_hypothesis.tokens + [candidate.token],
                 scores=candidate.prev_hypothesis.scores + [candidate.score],
+                decoder_cache=candidate.prev_hypothesis.decoder_cache,
             ),
             get_continuations=partial(
                 self.get_continuations,
                 memory=memory,
-                question_position_map=question_position_map,
-                columns_position_map=columns_position_map,
-                tables_position_map=tables_position_map,
+                copy_groups=copy_groups,
+                beam_size=beam_size,
                 grammar_constrained_inference=grammar_constrained_inference,
             ),
         )
         return [
-            FinishedBeam(
-                ast=hypothesis.beam_builder.parsing_result.res, score=hypothesis.score
-            )
-            for hypothesis in res
+            [
+                FinishedBeam(
+                    ast=hypothesis.beam_builder.parsing_result.res,
+                    score=hypothesis.score,
+                )
+                for hypothesis in finished
+            ]
+            for finished in res
         ]
 
     def get_continuations(
         self,
-        beam_hypotheses: List[DuoRATHypothesis],
+        beams: Dict[int, List[DuoRATHypothesis]],
         step: int,
-        memory: torch.Tensor,
-        question_position_map: Dict[Any, Deque[Any]],
-        columns_position_map: Dict[Any, Deque[Any]],
-        tables_position_map: Dict[Any, Deque[Any]],
+        memory: DuoRATPreparedMemory,
+        copy_groups: Sequence[Tuple[torch.Tensor, List[Any]]],
+        beam_size: int,
         grammar_constrained_inference: bool,
-    ):
+    ) -> Dict[int, List[Candidate]]:
+        """Get the best beam_size continuations of each of several beams at once.
+        The beams are keyed by the index of their question in memory."""
         device = next(self.parameters()).device
+        # All the hypotheses of all the beams are decoded in a single batch
+        beam_ids = [beam_id for beam_id, beam in beams.items() for _ in beam]
+        beam_hypotheses = [hypothesis for beam in beams.values() for hypothesis in beam]
         # we have to make copies of the builders here so that the additions of the mask actions
         # are confined to the for loop:
-        decoder_batch = duo_rat_decoder_batch(
-            items=[
-                hypothesis.beam_builder.add_action_token(
-                    action_token=ActionToken(
-                        key=MaskAction(),
-                        value=MaskAction(),
-                        scope=AttentionScope(scope_name=AttentionScopeName.TARGET),
+        decoder_items = [
+            hypothesis.beam_builder.add_action_token(
+                action_token=ActionToken(
+                    key=MaskAction(),
+                    value=MaskAction(),
+                    scope=AttentionScope(scope_name=AttentionScopeName.TARGET),
+                ),
+                copy=True,
+            ).build(device=device)
+            for hypothesis in beam_hypotheses
+        ]
+        decoder_batch = duo_rat_decoder_batch(items=decoder_items)
+        # The memory projections are shared by reference among the hypotheses.
+        selected_memory = self._select_prepared_memory(
+            prepared_memory=memory,
+            index=beam_ids,
+            memory_length=decoder_batch.memory_key_padding_mask.shape[1],
+        )
+        if beam_hypotheses[0].decoder_cache is None:
+            past_key_values = None
+        else:
+            assert all(
+                hypothesis.decoder_cache is not None for hypothesis in beam_hypotheses
+            )
+            past_key_values = tuple(
+                (
+                    torch.cat(
+                        [
+                            hypothesis.decoder_cache[layer_id][0]
+                            for hypothesis in beam_hypotheses
+                        ],
+                        dim=0,
                     ),
-                    copy=True,
-                ).build(device=device)
-                for hypothesis in beam_hypotheses
-            ]
+                    torch.cat(
+                        [
+                            hypothesis.decoder_cache[layer_id][1]
+                            for hypothesis in beam_hypotheses
+                        ],
+                        dim=0,
+                    ),
+                )
+                for layer_id in range(len(self.decoder_rat_layers))
+            )
+        output, key_values = self._decode_incremental(
+            prepared_memory=selected_memory,
+            batch=decoder_batch,
+            past_key_values=past_key_values,
         )
-        expanded_memory = memory.expand(len(beam_hypotheses), -1, -1)
-        output = self._decode(memory=expanded_memory, batch=decoder_batch)
+        # Keep the keys and values of the positions that will not change at the next step.
+        # They are shared by all the hypotheses that extend this one.
+        cacheable_length = self._get_cacheable_length(decoder_batch)
+        for hypothesis_id, hypothesis in enumerate(beam_hypotheses):
+            hypothesis.decoder_cache = tuple(
+                (
+                    k[hypothesis_id : hypothesis_id + 1, :, :cacheable_length],
+                    v[hypothesis_id : hypothesis_id + 1, :, :cacheable_length],
+                )
+                for k, v in key_values
+            )
+        # Only the last position is needed to predict the next action.
+        output = output[:, -1:]
         p_copy_gen_logprobs = self.copy_logprob(output)
-        (batch_size, seq_len) = decoder_batch.target.shape
-        assert p_copy_gen_logprobs.shape == (batch_size, seq_len, 2)
+        batch_size = len(beam_hypotheses)
+        assert p_copy_gen_logprobs.shape == (batch_size, 1, 2)
         assert not torch.isnan(p_copy_gen_logprobs).any()
-        copy_logits = self.pointer_network(query=output, keys=expanded_memory)
+        copy_logits = self.pointer_network.forward_prepared(
+            query=output, prepared_keys=selected_memory.pointer_keys
+        )
+        # Never copy from the padding of the memory of shorter questions
+        memory_lengths = torch.tensor(
+            [item.memory_key_padding_mask.shape[0] for item in decoder_items],
+            device=device,
+        )
+        copy_logits = copy_logits.masked_fill(
+            mask=(
+                torch.arange(copy_logits.shape[2], device=device).unsqueeze(0)
+                >= memory_lengths.unsqueeze(1)
+            ).unsqueeze(1),
+            value=float("-inf"),
+        )
         gen_logits = self.out_proj(output)
-        # For each hypothesis, record all possible continuations
-        continuations = []
-        for hypothesis_id, hypothesis in enumerate(beam_hypotheses):
-            assert isinstance(hypothesis.beam_builder.parsing_result, Partial)
-            continuations += self.get_hyp_continuations(
-                decoder_batch=decoder_batch,
-                copy_logits=copy_logits,
-                gen_logits=gen_logits,
-                p_copy_gen_logprobs=p_copy_gen_logprobs,
-                hypothesis_id=hypothesis_id,
-                hypothesis=hypothesis,
-                step=step,
-                question_position_map=question_position_map,
-                columns_position_map=columns_position_map,
-                tables_position_map=tables_position_map,
-                grammar_constrained_inference=grammar_constrained_inference,
-            )
-        return continuations
-
-    def get_hyp_continuations(
-        self,
-        decoder_batch: DuoRATDecoderBatch,
-        copy_logits: torch.Tensor,
-        gen_logits: torch.Tensor,
-        p_copy_gen_logprobs: torch.Tensor,
-        hypothesis_id: int,
-        hypothesis: DuoRATHypothesis,
-        step: int,
-        question_position_map: Dict[Any, Deque[Any]],
-        columns_position_map: Dict[Any, Deque[Any]],
-        tables_position_map: Dict[Any, Deque[Any]],
-        grammar_constrained_inference: bool,
-    ):
-        device = next(self.parameters()).device
-        assert isinstance(hypothesis.beam_builder.parsing_result, Partial)
-        continuations = []
-        # Copy continuations
-        if (
-            hypothesis.beam_builder.parsing_result.frontier_field is None
-            or not isinstance(
-                hypothesis.beam_builder.parsing_result.frontier_field.type,
-                ASDLPrimitiveType,
-            )
-        ):
-            pass
-        else:
-            if grammar_constrained_inference:
-                masked_copy_logits = copy_logits.masked_fill(
-                    mask=~decoder_batch.valid_copy_mask.to(device=device),
-                    value=float("-inf"),
-                )
-            else:
-                masked_copy_logits = copy_logits
-            copy_log_probs = F.log_softmax(masked_copy_logits, dim=2)
-            for position_map in [
-                question_position_map,
-                columns_position_map,
-                tables_position_map,
-            ]:
-                for token_value, positions in position_map.items():
-                    if (
-                        any(decoder_batch.valid_copy_mask[hypothesis_id, -1, positions])
-                        or not grammar_constrained_inference
-                    ):
-                        score = (
-                            torch.logsumexp(
-                                copy_log_probs[hypothesis_id, step, positions], dim=0,
-                            )
-                            + p_copy_gen_logprobs[hypothesis_id, step, 0]
-                        )
-                        continuations.append(
-                            Candidate(
-                                token=self.preproc.transition_system.get_gen_token_action(
-                                    primitive_type=hypothesis.beam_builder.parsing_result.frontier_field.type
-                                )(
-                                    token=token_value
-                                ),
-                                score=hypothesis.score + score.item(),
-                                prev_hypothesis=hypothesis,
-                            )
-                        )
-        # Vocab continuations
+        # Grammar-based constraining
         if grammar_constrained_inference:
-            masked_gen_logits = gen_logits.masked_fill(
-                mask=~decoder_batch.valid_actions_mask.to(device=device),
+            copy_logits = copy_logits.masked_fill(
+                mask=~decoder_batch.valid_copy_mask[:, -1:].to(device=device),
                 value=float("-inf"),
             )
-        else:
-            masked_gen_logits = gen_logits
-        gen_log_probs = F.log_softmax(masked_gen_logits, dim=2)
-        action_ids = (
-            decoder_batch.valid_actions_mask[hypothesis_id, -1].nonzero(as_tuple=False)
-            if grammar_constrained_inference
-            else range(decoder_batch.valid_actions_mask.shape[2])
-        )
-        for valid_action_id in action_ids:
-            # Never continue with a MaskAction.
-            if self.preproc.target_vocab.itos[valid_action_id] == MaskAction():
-                continue
-            score = (
-                gen_log_probs[hypothesis_id, step, valid_action_id]
-                + p_copy_gen_logprobs[hypothesis_id, step, 1]
+            gen_logits = gen_logits.masked_fill(
+                mask=~decoder_batch.valid_actions_mask[:, -1:].to(device=device),
+                value=float("-inf"),
             )
-            continuations.append(
-                Candidate(
-                    token=self.preproc.target_vocab.itos[valid_action_id],
-                    score=hypothesis.score + score.item(),
-                    prev_hypothesis=hypothesis,
+        copy_log_probs = (
+            F.log_softmax(copy_logits, dim=2)[:, -1] + p_copy_gen_logprobs[:, -1, 0:1]
+        )
+        gen_log_probs = (
+            F.log_softmax(gen_logits, dim=2)[:, -1] + p_copy_gen_logprobs[:, -1, 1:2]
+        )
+        # Never continue with a MaskAction.
+        gen_log_probs[:, self.preproc.target_vocab[MaskAction()]] = float("-inf")
+        # Only primitive values can be copied
+        copy_allowed = torch.tensor(
+            [
+                hypothesis.beam_builder.parsing_result.frontier_field is not None
+                and isinstance(
+                    hypothesis.beam_builder.parsing_result.frontier_field.type,
+                    ASDLPrimitiveType,
                 )
+                for hypothesis in beam_hypotheses
+            ],
+            device=device,
+        )
+        # For each beam, only keep the best continuations of all its hypotheses
+        continuations: Dict[int, List[Candidate]] = {}
+        hypothesis_offset = 0
+        for beam_id, beam in beams.items():
+            beam_slice = slice(hypothesis_offset, hypothesis_offset + len(beam))
+            hypothesis_offset += len(beam)
+            copy_group_index, copy_group_values = copy_groups[beam_id]
+            num_copy_groups = len(copy_group_values)
+            # Positions past the end of this question go to an extra group
+            padded_copy_group_index = copy_group_index.new_full(
+                (copy_log_probs.shape[1],), num_copy_groups
+            )
+            padded_copy_group_index[: copy_group_index.shape[0]] = copy_group_index
+            copy_scores = _scatter_logsumexp(
+                src=copy_log_probs[beam_slice],
+                index=padded_copy_group_index.unsqueeze(0).expand(len(beam), -1),
+                dim_size=num_copy_groups + 1,
+            )[:, :num_copy_groups]
+            copy_scores = copy_scores.masked_fill(
+                mask=~copy_allowed[beam_slice].unsqueeze(1), value=float("-inf")
             )
+            scores = torch.cat((gen_log_probs[beam_slice], copy_scores), dim=1)
+            (_num_hypotheses, num_continuations) = scores.shape
+            total_scores = scores + torch.tensor(
+                [hypothesis.score for hypothesis in beam],
+                dtype=scores.dtype,
+                device=device,
+            ).unsqueeze(1)
+            top_ids = torch.topk(
+                total_scores.flatten(), k=min(beam_size, total_scores.numel())
+            ).indices
+            top_scores = scores.flatten()[top_ids]
+            continuations[beam_id] = []
+            for top_id, score in zip(top_ids.tolist(), top_scores.tolist()):
+                if score == float("-inf"):
+                    continue
+                hypothesis = beam[top_id // num_continuations]
+                assert isinstance(hypothesis.beam_builder.parsing_result, Partial)
+                continuation_id = top_id % num_continuations
+                if continuation_id < gen_log_probs.shape[1]:
+                    # Vocab continuation
+                    token = self.preproc.target_vocab.itos[continuation_id]
+                else:
+                    # Copy continuation
+                    token = self.preproc.transition_system.get_gen_token_action(
+                        primitive_type=hypothesis.beam_builder.parsing_result.frontier_field.type
+                    )(token=copy_group_values[continuation_id - gen_log_probs.shape[1]])
+                continuations[beam_id].append(
+                    Candidate(
+                        token=token,
+                        score=hypothesis.score + score,
+                        prev_hypothesis=hypothesis,
+                    )
+                )
         return continuations
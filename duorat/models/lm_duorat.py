@@ -51,6 +51,12 @@ class LMDuoRATModel(DuoRATModel):
             target=decoder_batch.target,
         ).mean()
 
+    @staticmethod
+    def _get_cacheable_length(batch: DuoRATDecoderBatch) -> int:
+        # With shifted targets, the last position does not depend on the
+        # mask action, so all the positions can be reused at the next step.
+        return batch.shifted_target.shape[1]
+
     @staticmethod
     def _get_targets_as_input(batch: DuoRATDecoderBatch) -> torch.Tensor:
         return batch.shifted_target
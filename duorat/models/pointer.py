@@ -2,6 +2,7 @@ import abc
 from typing import Optional
 
 import torch
+import torch.nn.functional as F
 import numpy as np
 import math
 
@@ -30,11 +31,30 @@ class Pointer(abc.ABC, torch.nn.Module):
     ) -> torch.Tensor:
         pass
 
+    def prepare_keys(self, keys: torch.Tensor) -> torch.Tensor:
+        """Precompute the query-independent part of the pointer for the given keys.
+        The result can be reused with `forward_prepared` for any number of queries."""
+        return keys
+
+    def forward_prepared(
+        self,
+        query: torch.Tensor,
+        prepared_keys: torch.Tensor,
+        attn_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        # prepared_keys can have a batch size of 1, it is then shared by all queries
+        return self.forward(
+            query=query,
+            keys=prepared_keys.expand(query.shape[0], -1, -1),
+            attn_mask=attn_mask,
+        )
+
 
 @registry.register("pointer", "Bahdanau")
 class BahdanauPointer(Pointer):
     def __init__(self, query_size: int, key_size: int, proj_size: int) -> None:
         super().__init__()
+        self.query_size = query_size
         self.compute_scores = torch.nn.Sequential(
             torch.nn.Linear(query_size + key_size, proj_size),
             torch.nn.Tanh(),
@@ -64,6 +84,33 @@ class BahdanauPointer(Pointer):
         maybe_mask(attn_logits, attn_mask)
         return attn_logits
 
+    def prepare_keys(self, keys: torch.Tensor) -> torch.Tensor:
+        # The first linear layer acts on the concatenation of query and keys,
+        # hence it splits into a query part and a key part.
+        linear = self.compute_scores[0]
+        return F.linear(keys, linear.weight[:, self.query_size :], linear.bias)
+
+    def forward_prepared(
+        self,
+        query: torch.Tensor,
+        prepared_keys: torch.Tensor,
+        attn_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        # query shape: batch x seq_len x query_size
+        # prepared_keys shape: batch x mem_len x proj_size
+
+        linear = self.compute_scores[0]
+        h_query = F.linear(query, linear.weight[:, : self.query_size])
+
+        # batch_size x seq_len x mem_len x proj_size
+        h = prepared_keys.unsqueeze(1) + h_query.unsqueeze(2)
+        attn_logits = self.compute_scores[2](self.compute_scores[1](h))
+
+        # scores shape: batch x seq_len x mem_len
+        attn_logits = attn_logits.squeeze(3)
+        maybe_mask(attn_logits, attn_mask)
+        return attn_logits
+
 
 @registry.register("pointer", "BahdanauMemEfficient")
 class BahdanauPointerMemEfficient(Pointer):
@@ -90,10 +137,25 @@ class BahdanauPointerMemEfficient(Pointer):
         # query shape: batch x seq_len x query_size
         # keys shape: batch x mem_len x key_size
 
+        return self.forward_prepared(
+            query=query, prepared_keys=self.prepare_keys(keys), attn_mask=attn_mask
+        )
+
+    def prepare_keys(self, keys: torch.Tensor) -> torch.Tensor:
+        return self.key_linear(keys)  # batch_size x mem_len x proj_size
+
+    def forward_prepared(
+        self,
+        query: torch.Tensor,
+        prepared_keys: torch.Tensor,
+        attn_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        # query shape: batch x seq_len x query_size
+        # prepared_keys shape: batch x mem_len x proj_size
+
         h_query = self.query_linear(query)  # batch_size x seq_len x proj_size
-        h_keys = self.key_linear(keys)  # batch_size x mem_len x proj_size
 
-        h = h_keys.unsqueeze(1) + h_query.unsqueeze(
+        h = prepared_keys.unsqueeze(1) + h_query.unsqueeze(
             2
         )  # batch_size x seq_len x mem_len x proj_size
         h = self.tanh(h)
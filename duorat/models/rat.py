@@ -74,22 +74,57 @@ class RelationAwareMultiheadAttention(nn.Module):
         else:
             return attn_weights
 
+    def project_key(self, key: torch.Tensor) -> torch.Tensor:
+        """Project keys and split them into attention heads.
+
+        Input shapes:
+            - key:              (batch_size, seq_a_len, k_embed_dim)
+
+        Output shapes:
+            - k:                (batch_size, num_heads, seq_a_len, head_dim)
+        """
+
+        batch_size, seq_a_len, k_embed_dim = key.shape
+        assert k_embed_dim == self.k_embed_dim
+
+        k = self._reshape(self.k_in_proj(key))
+        assert k.shape == (batch_size, self.num_heads, seq_a_len, self.head_dim)
+
+        return k
+
+    def project_value(self, value: torch.Tensor) -> torch.Tensor:
+        """Project values and split them into attention heads.
+
+        Input shapes:
+            - value:            (batch_size, seq_a_len, v_embed_dim)
+
+        Output shapes:
+            - v:                (batch_size, num_heads, seq_a_len, head_dim)
+        """
+
+        batch_size, seq_a_len, v_embed_dim = value.shape
+        assert v_embed_dim == self.v_embed_dim
+
+        v = self._reshape(self.v_in_proj(value))
+        assert v.shape == (batch_size, self.num_heads, seq_a_len, self.head_dim)
+
+        return v
+
     def _attn_weights(
         self,
         query: torch.Tensor,
-        key: torch.Tensor,
+        k: torch.Tensor,
         relations_k: Optional[torch.Tensor],
     ) -> torch.Tensor:
         batch_size, seq_b_len, _ = query.shape
-        _batch_size, seq_a_len, _ = key.shape
+        _batch_size, _num_heads, seq_a_len, _head_dim = k.shape
         assert _batch_size == batch_size
+        assert _num_heads == self.num_heads
+        assert _head_dim == self.head_dim
 
         q = self._reshape(self.q_in_proj(query) * self.scaling)
         assert q.shape == (batch_size, self.num_heads, seq_b_len, self.head_dim)
 
-        k = self._reshape(self.k_in_proj(key))
-        assert k.shape == (batch_size, self.num_heads, seq_a_len, self.head_dim)
-
         k_t = k.transpose(2, 3)
         assert k_t.shape == (batch_size, self.num_heads, self.head_dim, seq_a_len)
 
@@ -121,15 +156,13 @@ class RelationAwareMultiheadAttention(nn.Module):
     def _attn(
         self,
         attn_weights: torch.Tensor,
-        value: torch.Tensor,
+        v: torch.Tensor,
         relations_v: Optional[torch.Tensor],
     ) -> torch.Tensor:
         """Calculate attention output."""
 
         batch_size, num_heads, seq_b_len, seq_a_len = attn_weights.shape
         assert num_heads == self.num_heads
-
-        v = self._reshape(self.v_in_proj(value))
         assert v.shape == (batch_size, self.num_heads, seq_a_len, self.head_dim)
 
         attn = torch.matmul(attn_weights, v).transpose(1, 2)
@@ -198,7 +231,54 @@ class RelationAwareMultiheadAttention(nn.Module):
         assert _seq_a_len == seq_a_len
         assert v_embed_dim == self.v_embed_dim
 
-        attn_weights = self._attn_weights(query, key, relations_k)
+        return self.forward_projected(
+            query=query,
+            k=self.project_key(key),
+            v=self.project_value(value),
+            relations_k=relations_k,
+            relations_v=relations_v,
+            attention_mask=attention_mask,
+            key_padding_mask=key_padding_mask,
+        )
+
+    def forward_projected(
+        self,
+        query: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        relations_k: Optional[torch.Tensor],
+        relations_v: Optional[torch.Tensor],
+        attention_mask: Optional[torch.Tensor],
+        key_padding_mask: Optional[torch.Tensor],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Forward pass for relation-aware multi-headed attention
+        with keys and values that have already been projected,
+        see `project_key` and `project_value`.
+
+        Input shapes:
+            - query:            (batch_size, seq_b_len, embed_dim)
+            - k:                (batch_size, num_heads, seq_a_len, head_dim)
+            - v:                (batch_size, num_heads, seq_a_len, head_dim)
+            - relations_k:      (batch_size, seq_b_len, seq_a_len, head_dim), optional
+            - relations_v:      (batch_size, seq_b_len, seq_a_len, head_dim), optional
+            - attention_mask:   (batch_size, seq_b_len, seq_a_len), optional
+            - key_padding_mask: (batch_size, seq_a_len), optional
+
+        Output shapes:
+            - attn:             (batch_size, seq_b_len, embed_dim)
+            - attn_weights:     (batch_size, seq_b_len, seq_a_len)
+        """
+
+        batch_size, seq_b_len, embed_dim = query.shape
+        assert embed_dim == self.embed_dim
+
+        _batch_size, num_heads, seq_a_len, head_dim = k.shape
+        assert _batch_size == batch_size
+        assert num_heads == self.num_heads
+        assert head_dim == self.head_dim
+        assert v.shape == k.shape
+
+        attn_weights = self._attn_weights(query, k, relations_k)
 
         attn_weights = self._mask_attention(attn_weights, attention_mask)
         assert attn_weights.shape == (batch_size, self.num_heads, seq_b_len, seq_a_len)
@@ -212,7 +292,7 @@ class RelationAwareMultiheadAttention(nn.Module):
         )
         assert attn_weights.shape == (batch_size, self.num_heads, seq_b_len, seq_a_len)
 
-        attn = self._attn(attn_weights, value, relations_v)
+        attn = self._attn(attn_weights, v, relations_v)
         assert attn.shape == (batch_size, seq_b_len, self.embed_dim)
 
         # average attention weights over heads
@@ -313,6 +393,60 @@ class DressedRelationAwareMultiheadAttention(nn.Module):
 
         return y
 
+    def project_key(self, key: torch.Tensor) -> torch.Tensor:
+        return self.self_attn.project_key(key)
+
+    def project_value(self, value: torch.Tensor) -> torch.Tensor:
+        return self.self_attn.project_value(value)
+
+    def forward_projected(
+        self,
+        query: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        relations_k: Optional[torch.Tensor],
+        relations_v: Optional[torch.Tensor],
+        attention_mask: Optional[torch.Tensor],
+        key_padding_mask: Optional[torch.Tensor],
+    ) -> torch.Tensor:
+        """Forward pass for relation-aware multi-headed attention
+        with residual connection and layer norms
+        and with keys and values that have already been projected.
+
+        Input shapes:
+            - query:            (batch_size, seq_b_len, embed_dim)
+            - k:                (batch_size, num_heads, seq_a_len, head_dim)
+            - v:                (batch_size, num_heads, seq_a_len, head_dim)
+            - relations_k:      (batch_size, seq_b_len, seq_a_len, head_dim), optional
+            - relations_v:      (batch_size, seq_b_len, seq_a_len, head_dim), optional
+            - attention_mask:   (batch_size, seq_b_len, seq_a_len), optional
+            - key_padding_mask: (batch_size, seq_a_len), optional
+
+        Output shapes:
+            - y:                (batch_size, seq_b_len, embed_dim)
+        """
+
+        batch_size, seq_len, embed_dim = query.shape
+        assert embed_dim == self.embed_dim
+
+        z, _ = self.self_attn.forward_projected(
+            query=query,
+            k=k,
+            v=v,
+            relations_k=relations_k,
+            relations_v=relations_v,
+            attention_mask=attention_mask,
+            key_padding_mask=key_padding_mask,
+        )
+        y = _residual(
+            z,
+            query,
+            lambda z_: F.dropout(z_, p=self.dropout, training=self.training),
+            self.norm,
+        )
+
+        return y
+
 
 class TransformerMLP(nn.Module):
     """Transformer MLP Layer."""
@@ -508,6 +642,96 @@ class RATLayerWithMemory(nn.Module):
 
         return x
 
+    def forward_incremental(
+        self,
+        x: torch.Tensor,
+        memory: torch.Tensor,
+        relations_k: Optional[torch.Tensor],
+        memory_relations_k: Optional[torch.Tensor],
+        relations_v: Optional[torch.Tensor],
+        memory_relations_v: Optional[torch.Tensor],
+        attention_mask: Optional[torch.Tensor],
+        memory_attention_mask: Optional[torch.Tensor],
+        key_padding_mask: Optional[torch.Tensor],
+        memory_key_padding_mask: Optional[torch.Tensor],
+        past_key_value: Optional[Tuple[torch.Tensor, torch.Tensor]],
+        memory_key_value: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    ) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        """Forward pass for the transformer layer with memory
+        that only computes the last new_len positions of the sequence.
+
+        The self-attention keys and values of the first past_len = seq_len - new_len
+        positions are taken from past_key_value. This is exact as long as
+        no earlier position attends to a later one, i.e. for backward attention.
+        If given, memory_key_value is used instead of projecting memory again,
+        see `project_memory`.
+
+        Input shapes:
+            - x:                       (batch_size, new_len, embed_dim)
+            - memory:                  (batch_size, mem_len, mem_embed_dim)
+            - relations_k:             (batch_size, new_len, seq_len, head_dim), optional
+            - memory_relations_k:      (batch_size, new_len, mem_len, head_dim), optional
+            - relations_v:             (batch_size, new_len, seq_len, head_dim), optional
+            - memory_relations_v:      (batch_size, new_len, mem_len, head_dim), optional
+            - attention_mask:          (batch_size, new_len, seq_len), optional
+            - memory_attention_mask:   (batch_size, new_len, mem_len), optional
+            - key_padding_mask:        (batch_size, seq_len), optional
+            - memory_key_padding_mask: (batch_size, mem_len), optional
+            - past_key_value:          2 x (batch_size, num_heads, past_len, head_dim), optional
+            - memory_key_value:        2 x (batch_size, num_heads, mem_len, head_dim), optional
+
+        Output shapes:
+            - x:                       (batch_size, new_len, embed_dim)
+            - key_value:               2 x (batch_size, num_heads, seq_len, head_dim)
+        """
+
+        k = self.self_attn.project_key(x)
+        v = self.self_attn.project_value(x)
+        if past_key_value is not None:
+            past_k, past_v = past_key_value
+            k = torch.cat((past_k, k), dim=2)
+            v = torch.cat((past_v, v), dim=2)
+
+        x = self.self_attn.forward_projected(
+            query=x,
+            k=k,
+            v=v,
+            relations_k=relations_k,
+            relations_v=relations_v,
+            attention_mask=attention_mask,
+            key_padding_mask=key_padding_mask,
+        )
+        if memory_key_value is None:
+            memory_key_value = self.project_memory(memory)
+        memory_k, memory_v = memory_key_value
+        x = self.memory_attn.forward_projected(
+            query=x,
+            k=memory_k,
+            v=memory_v,
+            relations_k=memory_relations_k,
+            relations_v=memory_relations_v,
+            attention_mask=memory_attention_mask,
+            key_padding_mask=memory_key_padding_mask,
+        )
+        x = self.mlp(x)
+
+        return x, (k, v)
+
+    def project_memory(self, memory: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Project the memory to the keys and values of the memory attention.
+
+        Input shapes:
+            - memory:                  (batch_size, mem_len, mem_embed_dim)
+
+        Output shapes:
+            - memory_key_value:        2 x (batch_size, num_heads, mem_len, head_dim)
+        """
+
+        return (
+            self.memory_attn.project_key(memory),
+            self.memory_attn.project_value(memory),
+        )
+
 
 class RAT(nn.Module):
     def __init__(
@@ -5,3 +5,27 @@ def _flip_attention_mask(mask: torch.Tensor) -> torch.Tensor:
     return torch.zeros_like(mask, dtype=torch.float).masked_fill(
         ~mask, value=float("-inf")
     )
+
+
+def _scatter_logsumexp(
+    src: torch.Tensor, index: torch.Tensor, dim_size: int
+) -> torch.Tensor:
+    """Log-sum-exp of the entries of src that share the same index along the last dimension.
+
+    Input shapes:
+        - src:   (batch_size, src_len)
+        - index: (batch_size, src_len), with values in [0, dim_size)
+
+    Output shapes:
+        - out:   (batch_size, dim_size), -inf where no finite entry is scattered
+    """
+    batch_size, _src_len = src.shape
+    assert index.shape == src.shape
+    out_max = src.new_full((batch_size, dim_size), float("-inf")).scatter_reduce(
+        dim=1, index=index, src=src, reduce="amax"
+    )
+    out_max = out_max.masked_fill(~torch.isfinite(out_max), 0)
+    sum_exp = src.new_zeros((batch_size, dim_size)).scatter_add(
+        dim=1, index=index, src=torch.exp(src - out_max.gather(dim=1, index=index))
+    )
+    return torch.log(sum_exp) + out_max
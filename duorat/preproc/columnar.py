@@ -0,0 +1,202 @@
+"""Columnar, memory-mapped storage of the preprocessed items of a section.
+
+A section is a directory of flat NumPy arrays, one per field of the question tokens
+and of the actions, with offsets that delimit the items, and of a pickled file of
+tables for everything that repeats: token strings, match tags, actions and the ids of
+SQL schemas. Items hold indices into these tables, and the schemas themselves are
+stored once in a schema registry, which the sections of all languages share. The
+arrays are memory-mapped and items are only rebuilt when they are accessed, which keeps
+opening a section cheap and lets processes share the pages of the arrays.
+"""
+
+import os
+import pickle
+from typing import (
+    Any,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+from uuid import UUID
+
+import numpy as np
+
+from duorat.preproc.schema_registry import SCHEMA_IDS_FILE, SQLSchemaRegistry
+from duorat.types import (
+    PreprocQuestionToken,
+    QuestionTokenId,
+    RATPreprocItem,
+    SQLSchema,
+)
+
+TABLES_FILE = "tables.pkl"
+
+
+class _Interner(object):
+    def __init__(self) -> None:
+        self.ids: Dict[Hashable, int] = {}
+
+    def __call__(self, value: Hashable) -> int:
+        return self.ids.setdefault(value, len(self.ids))
+
+    def table(self) -> List[Any]:
+        return list(self.ids.keys())
+
+
+def save_items(
+    path: str, items: Iterable[RATPreprocItem], schema_registry: SQLSchemaRegistry
+) -> None:
+    """Writes the items of a section to the directory `path`.
+    The schemas of the items are added to the registry, which has to be saved too."""
+    strings, match_tags, actions, schemas = (
+        _Interner(),
+        _Interner(),
+        _Interner(),
+        _Interner(),
+    )
+    question_offsets, action_offsets, item_schemas = [0], [0], []
+    token_keys, token_values, token_raw_values, token_match_tags = [], [], [], []
+    item_actions = []
+    for item in items:
+        for token in item.question:
+            token_keys.append(np.frombuffer(token.key.bytes, dtype=np.uint8))
+            token_values.append(strings(token.value))
+            token_raw_values.append(strings(token.raw_value))
+            token_match_tags.append(match_tags(token.match_tags))
+        question_offsets.append(len(token_values))
+
+        item_actions += [actions(action) for action in item.actions]
+        action_offsets.append(len(item_actions))
+
+        item_schemas.append(schemas(schema_registry.schema_id(item.sql_schema)))
+
+    columns = {
+        "question_offsets": np.array(question_offsets, dtype=np.int64),
+        "action_offsets": np.array(action_offsets, dtype=np.int64),
+        "item_schemas": np.array(item_schemas, dtype=np.int32),
+        "token_keys": np.array(token_keys, dtype=np.uint8).reshape(-1, 16),
+        "token_values": np.array(token_values, dtype=np.int32),
+        "token_raw_values": np.array(token_raw_values, dtype=np.int32),
+        "token_match_tags": np.array(token_match_tags, dtype=np.int32),
+        "actions": np.array(item_actions, dtype=np.int32),
+    }
+    tables = {
+        "strings": strings.table(),
+        "match_tags": match_tags.table(),
+        "actions": actions.table(),
+        "schema_ids": schemas.table(),
+    }
+
+    # the tables file is written last and marks the section as complete
+    tables_path = os.path.join(path, TABLES_FILE)
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(tables_path):
+        os.remove(tables_path)
+    for name, column in columns.items():
+        np.save(os.path.join(path, name + ".npy"), column)
+    with open(os.path.join(path, SCHEMA_IDS_FILE), "wb") as f:
+        pickle.dump(tables["schema_ids"], f)
+    with open(tables_path + ".tmp", "wb") as f:
+        pickle.dump(tables, f)
+    os.replace(tables_path + ".tmp", tables_path)
+
+
+def has_items(path: str) -> bool:
+    return os.path.exists(os.path.join(path, TABLES_FILE))
+
+
+class ColumnarItems(Sequence[RATPreprocItem]):
+    """The items of a section, with random access by index.
+    The section is opened on first access, also after unpickling, e.g. in data loader
+    workers."""
+
+    def __init__(self, path: str, schema_registry: SQLSchemaRegistry) -> None:
+        self.path = path
+        self.schema_registry = schema_registry
+        self._columns: Optional[Dict[str, np.ndarray]] = None
+        self._tables: Optional[Dict[str, List[Any]]] = None
+
+    def _open(self) -> None:
+        with open(os.path.join(self.path, TABLES_FILE), "rb") as f:
+            self._tables = pickle.load(f)
+        self._columns = {
+            name[: -len(".npy")]: np.load(os.path.join(self.path, name), mmap_mode="r")
+            for name in os.listdir(self.path)
+            if name.endswith(".npy")
+        }
+
+    @property
+    def columns(self) -> Dict[str, np.ndarray]:
+        if self._columns is None:
+            self._open()
+        return self._columns
+
+    @property
+    def tables(self) -> Dict[str, List[Any]]:
+        if self._tables is None:
+            self._open()
+        return self._tables
+
+    def __len__(self) -> int:
+        return len(self.columns["item_schemas"])
+
+    def __getitem__(self, index: int) -> RATPreprocItem:
+        if not -len(self) <= index < len(self):
+            raise IndexError("item index out of range")
+        index = index % len(self)
+        columns, tables = self.columns, self.tables
+
+        question_start, question_end = columns["question_offsets"][index : index + 2]
+        strings, match_tags = tables["strings"], tables["match_tags"]
+        question = tuple(
+            PreprocQuestionToken(
+                key=QuestionTokenId(UUID(bytes=key.tobytes())),
+                value=strings[value],
+                raw_value=strings[raw_value],
+                match_tags=match_tags[token_match_tags],
+            )
+            for key, value, raw_value, token_match_tags in zip(
+                columns["token_keys"][question_start:question_end],
+                columns["token_values"][question_start:question_end].tolist(),
+                columns["token_raw_values"][question_start:question_end].tolist(),
+                columns["token_match_tags"][question_start:question_end].tolist(),
+            )
+        )
+
+        action_start, action_end = columns["action_offsets"][index : index + 2]
+        actions = tuple(
+            tables["actions"][action]
+            for action in columns["actions"][action_start:action_end].tolist()
+        )
+
+        sql_schema = self.schema_registry[
+            tables["schema_ids"][columns["item_schemas"][index]]
+        ]
+        return RATPreprocItem(question=question, sql_schema=sql_schema, actions=actions)
+
+    def item_lengths(self) -> Iterator[Tuple[int, SQLSchema, int]]:
+        """The question length, the schema and the number of actions of every item,
+        which are read from the offsets rather than rebuilding the items."""
+        columns = self.columns
+        schemas = [
+            self.schema_registry[schema_id]
+            for schema_id in self.tables["schema_ids"]
+        ]
+        return zip(
+            np.diff(columns["question_offsets"]).tolist(),
+            (schemas[schema] for schema in columns["item_schemas"].tolist()),
+            np.diff(columns["action_offsets"]).tolist(),
+        )
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "schema_registry": self.schema_registry,
+            "_columns": None,
+            "_tables": None,
+        }
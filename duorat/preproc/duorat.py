@@ -42,6 +42,7 @@ from duorat.preproc.relations import (
 )
 from duorat.preproc.target import (
     ValidActionsMaskBuilder,
+    ValidActionsMaskTable,
     ValidCopyMaskBuilder,
     CopyTargetMaskBuilder,
     index_frontier_field,
@@ -489,6 +490,7 @@ class DuoRATDecoderItemBuilder(object):
     positioned_source_tokens: Sequence[Token[InputId, str]]
     target_vocab: Vocab
     transition_system: TransitionSystem
+    valid_actions_mask_table: ValidActionsMaskTable
     allow_unk: bool
     source_attention_scoping: Scoping
     target_attention_scoping: Scoping
@@ -573,8 +575,7 @@ class DuoRATDecoderItemBuilder(object):
                 for token in self.positioned_source_tokens
                 if isinstance(token, QuestionToken)
             ],
-            target_vocab=self.target_vocab,
-            transition_system=self.transition_system,
+            valid_actions_mask_table=self.valid_actions_mask_table,
             allow_unk=self.allow_unk,
         )
         self.target_relations_builder = TargetRelationsBuilder(
@@ -724,7 +725,11 @@ class DuoRATDecoderItemBuilder(object):
         )
 
 
+@dataclass
 class DuoRATHypothesis(Hypothesis[DuoRATDecoderItemBuilder]):
+    # per-layer decoder self-attention keys and values of the already decoded positions
+    decoder_cache: Optional[Tuple[Tuple[torch.Tensor, torch.Tensor], ...]] = None
+
     def is_finished(self) -> bool:
         return isinstance(self.beam_builder.parsing_result, Done)
 
@@ -784,6 +789,7 @@ def duo_rat_decoder_item(
     positioned_source_tokens: Sequence[Token[InputId, str]],
     target_vocab: Vocab,
     transition_system: TransitionSystem,
+    valid_actions_mask_table: ValidActionsMaskTable,
     allow_unk: bool,
     source_attention_scoping: Scoping,
     target_attention_scoping: Scoping,
@@ -795,6 +801,7 @@ def duo_rat_decoder_item(
         positioned_source_tokens=positioned_source_tokens,
         target_vocab=target_vocab,
         transition_system=transition_system,
+        valid_actions_mask_table=valid_actions_mask_table,
         allow_unk=allow_unk,
         source_attention_scoping=source_attention_scoping,
         target_attention_scoping=target_attention_scoping,
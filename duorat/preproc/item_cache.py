@@ -0,0 +1,47 @@
+"""Content-addressed cache of preprocessing results.
+
+Every entry is a pickle file named after the hash of everything the result depends
+on, so that entries never have to be invalidated: a change in the inputs or the
+configuration simply leads to other keys. Entries are moved into place atomically as
+soon as they are computed, which makes interrupted runs resume where they stopped, and
+lets several processes share a cache directory.
+"""
+
+import os
+import pickle
+from typing import Any, Optional
+from uuid import uuid4
+
+from duorat.utils.item_store import item_key
+
+
+class PreprocItemCache(object):
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        return item_key(parts)
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key + ".pkl")
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(self._entry_path(key))
+
+    def get(self, key: str) -> Optional[Any]:
+        try:
+            with open(self._entry_path(key), "rb") as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(entry_path, uuid4().hex)
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f)
+        os.replace(tmp_path, entry_path)
+
@@ -1,9 +1,10 @@
 import itertools
-from collections import deque, defaultdict
+from collections import deque, defaultdict, OrderedDict
 from copy import deepcopy, copy
 from dataclasses import dataclass, field
-from typing import Iterable, Deque, Dict, Set, Tuple, Generator
+from typing import Iterable, Deque, Dict, Set, Tuple
 
+import numpy as np
 import torch
 
 from duorat.asdl.transition_system import Pos
@@ -11,8 +12,8 @@ from duorat.types import (
     Token,
     KT,
     VT,
-    Sparse2DMaskTensorBuilder,
     Sparse1DMaskTensorBuilder,
+    PrefixSharingList,
     Scoping,
     AttentionScopeName,
     NoScoping,
@@ -20,33 +21,34 @@ from duorat.types import (
     CoarseScoping,
     FineScoping,
 )
+from duorat.preproc.tokens import SCOPE_LAYOUT_CACHE_SIZE, flatten_scope_positions
+
+_scope_connectivity_cache: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
 
 
 @dataclass
 class MemoryAttentionMaskBuilder(object):
     source_scoping: Scoping
     target_scoping: Scoping
-    source_scope_positions: Dict[AttentionScope, Set[Pos]] = field(init=False)
-    target_scope_positions: Dict[AttentionScope, Set[Pos]] = field(init=False)
-    sparse_2d_mask_tensor_builder: Sparse2DMaskTensorBuilder = field(
-        default_factory=lambda: Sparse2DMaskTensorBuilder()
+    source_scope_positions: Dict[AttentionScope, PrefixSharingList[Pos]] = field(
+        init=False
+    )
+    target_scope_positions: Dict[AttentionScope, PrefixSharingList[Pos]] = field(
+        init=False
     )
 
     def __post_init__(self):
-        self.source_scope_positions = defaultdict(set)
-        self.target_scope_positions = defaultdict(set)
+        self.source_scope_positions = defaultdict(PrefixSharingList)
+        self.target_scope_positions = defaultdict(PrefixSharingList)
 
     def __deepcopy__(self, memo) -> "MemoryAttentionMaskBuilder":
         builder = copy(self)
-        builder.source_scope_positions = defaultdict(set)
+        builder.source_scope_positions = defaultdict(PrefixSharingList)
         for scope, tokens in self.source_scope_positions.items():
             builder.source_scope_positions[scope] = copy(tokens)
-        builder.target_scope_positions = defaultdict(set)
+        builder.target_scope_positions = defaultdict(PrefixSharingList)
         for scope, tokens in self.target_scope_positions.items():
             builder.target_scope_positions[scope] = copy(tokens)
-        builder.sparse_2d_mask_tensor_builder = deepcopy(
-            self.sparse_2d_mask_tensor_builder
-        )
         return builder
 
     def _get_source_scopes_by_name(
@@ -127,37 +129,38 @@ class MemoryAttentionMaskBuilder(object):
         else:
             raise NotImplementedError
 
-    @staticmethod
-    def _make_mask(
-        attend_from: Iterable[Pos], attend_to: Iterable[Pos],
-    ) -> Generator[Tuple[Pos, Pos], None, None]:
-        attend_from_to = (
-            (from_pos, to_pos) for from_pos in attend_from for to_pos in attend_to
+    def _scope_connectivity(
+        self,
+        target_scopes: Tuple[AttentionScope, ...],
+        source_scopes: Tuple[AttentionScope, ...],
+    ) -> np.ndarray:
+        """Which target scopes see which source scopes.
+        This only depends on the scopings and on the scopes, and is cached."""
+        cache_key = (
+            self.source_scoping,
+            self.target_scoping,
+            target_scopes,
+            source_scopes,
         )
-        return attend_from_to
+        connectivity = _scope_connectivity_cache.get(cache_key)
+        if connectivity is not None:
+            _scope_connectivity_cache.move_to_end(cache_key)
+            return connectivity
+        connectivity = np.zeros((len(target_scopes), len(source_scopes)), dtype=bool)
+        for i, target_scope in enumerate(target_scopes):
+            scope_connections = self._scope_connections(target_scope=target_scope)
+            for j, source_scope in enumerate(source_scopes):
+                connectivity[i, j] = source_scope in scope_connections
+        _scope_connectivity_cache[cache_key] = connectivity
+        if len(_scope_connectivity_cache) > SCOPE_LAYOUT_CACHE_SIZE:
+            _scope_connectivity_cache.popitem(last=False)
+        return connectivity
 
     def add_source_token(
         self, source_token: Token[KT, VT], copy: bool = False
     ) -> "MemoryAttentionMaskBuilder":
         builder = deepcopy(self) if copy is True else self
-        builder.source_scope_positions[source_token.scope].add(source_token.position)
-        this_scope = source_token.scope
-        attend_self: Set[Pos] = {source_token.position}
-        mask: Set[Tuple[Pos, Pos]] = set().union(
-            *(
-                builder._make_mask(
-                    attend_from=builder.target_scope_positions[that_scope],
-                    attend_to=attend_self,
-                )
-                for that_scope in builder.target_scope_positions.keys()
-                if this_scope in builder._scope_connections(target_scope=that_scope)
-            )
-        )
-        for _index in mask:
-            builder.sparse_2d_mask_tensor_builder.append(index=_index)
-        builder.sparse_2d_mask_tensor_builder.resize(
-            size=(0, 1 + source_token.position)
-        )
+        builder.source_scope_positions[source_token.scope].append(source_token.position)
         return builder
 
     def add_source_tokens(
@@ -172,23 +175,7 @@ class MemoryAttentionMaskBuilder(object):
         self, target_token: Token[KT, VT], copy: bool = False
     ) -> "MemoryAttentionMaskBuilder":
         builder = deepcopy(self) if copy is True else self
-        builder.target_scope_positions[target_token.scope].add(target_token.position)
-        this_scope = target_token.scope
-        attend_self: Set[Pos] = {target_token.position}
-        mask: Set[Tuple[Pos, Pos]] = set().union(
-            *(
-                builder._make_mask(
-                    attend_from=attend_self,
-                    attend_to=builder.source_scope_positions[that_scope],
-                )
-                for that_scope in builder._scope_connections(target_scope=this_scope)
-            )
-        )
-        for _index in mask:
-            builder.sparse_2d_mask_tensor_builder.append(index=_index)
-        builder.sparse_2d_mask_tensor_builder.resize(
-            size=(1 + target_token.position, 0)
-        )
+        builder.target_scope_positions[target_token.scope].append(target_token.position)
         return builder
 
     def add_target_tokens(
@@ -200,7 +187,27 @@ class MemoryAttentionMaskBuilder(object):
         return builder
 
     def build(self, device: torch.device) -> torch.Tensor:
-        return self.sparse_2d_mask_tensor_builder.build(device=device)
+        connectivity = self._scope_connectivity(
+            target_scopes=tuple(self.target_scope_positions.keys()),
+            source_scopes=tuple(self.source_scope_positions.keys()),
+        )
+        target_positions, target_scope_ids = flatten_scope_positions(
+            self.target_scope_positions
+        )
+        source_positions, source_scope_ids = flatten_scope_positions(
+            self.source_scope_positions
+        )
+        mask = np.zeros(
+            (
+                1 + target_positions.max(initial=-1),
+                1 + source_positions.max(initial=-1),
+            ),
+            dtype=bool,
+        )
+        mask[np.ix_(target_positions, source_positions)] = connectivity[
+            np.ix_(target_scope_ids, source_scope_ids)
+        ]
+        return torch.from_numpy(mask).to(device=device)
 
 
 @dataclass
@@ -2,7 +2,7 @@ import itertools
 import os
 import pickle
 from collections import Counter, defaultdict
-from typing import List, Tuple, Dict, Optional, Set, Union
+from typing import List, Tuple, Dict, Optional, Sequence, Set, Union
 from uuid import uuid4
 import re
 
@@ -22,7 +22,11 @@ from duorat.asdl.lang.spider.spider_transition_system import (
     SpiderTransitionSystem,
 )
 from duorat.preproc import abstract_preproc
+from duorat.preproc.columnar import ColumnarItems, has_items, save_items
+from duorat.preproc.item_cache import PreprocItemCache
+from duorat.preproc.schema_registry import SQLSchemaRegistry
 from duorat.preproc.slml import SLMLParser
+from duorat.preproc.target import ValidActionsMaskTable
 from duorat.preproc.utils import (
     ActionVocab,
     preprocess_schema_uncached,
@@ -52,10 +56,23 @@ class DuoRATPreproc(abstract_preproc.AbstractPreproc):
         # self.target_vocab_path = os.path.join(self.save_path, "target_vocab.pkl")
         self.target_vocab_path = kwargs["target_vocab_pkl_path"]
         self.target_vocab = None
+        self.valid_actions_mask_table_path = os.path.join(
+            os.path.dirname(self.target_vocab_path), "valid_actions_masks.pkl"
+        )
+        self.valid_actions_mask_table = None
 
         self.counted_db_ids: Set[int] = set()
         # self.sql_schemas: Dict[str, SQLSchema] = {}
         self.sql_schemas_multi: Dict[str, Dict[str, SQLSchema]] = defaultdict(dict)
+        # languages and schema shuffles share the schemas with the same content. The
+        # registry is in the parent directory of the save path by default, which the
+        # save paths of all the languages share.
+        self.schema_registry = SQLSchemaRegistry(
+            kwargs.get(
+                "schema_registry_path",
+                os.path.dirname(os.path.abspath(self.save_path)),
+            )
+        )
 
         self.tokenizer: AbstractTokenizer = registry.construct(
             "tokenizer", kwargs["tokenizer"]
@@ -75,6 +92,26 @@ class DuoRATPreproc(abstract_preproc.AbstractPreproc):
 
         self.lang_dict = kwargs.get('langs', dict())
 
+        # Results of preprocess_item, keyed on the item and everything it depends on.
+        # None disables the cache.
+        item_cache_path = kwargs.get(
+            "item_cache_path", os.path.join(self.save_path, "item_cache")
+        )
+        self.item_cache: Optional[PreprocItemCache] = (
+            PreprocItemCache(item_cache_path) if item_cache_path is not None else None
+        )
+        self.item_cache_config = (
+            type(self).__name__,
+            kwargs["tokenizer"],
+            kwargs["schema_linker"],
+            kwargs["transition_system"],
+            # the grammar version
+            tuple(
+                repr(production)
+                for production in self.transition_system.grammar.productions
+            ),
+        )
+
 
     def input_a_str_to_id(self, s: str) -> int:
         raise NotImplementedError
@@ -87,9 +124,7 @@ class DuoRATPreproc(abstract_preproc.AbstractPreproc):
     ) -> List[str]:
         raise NotImplementedError
 
-    def validate_item(
-        self, item: SpiderItem, section: str
-    ) -> Tuple[bool, Optional[AbstractSyntaxTree]]:
+    def _sql_schema(self, item: SpiderItem, section: str) -> SQLSchema:
         lang = self.lang_dict.get(section, 'default')
         if item.spider_schema.db_id not in self.sql_schemas_multi[lang]:
             schema = preprocess_schema_uncached(
@@ -97,7 +132,15 @@ class DuoRATPreproc(abstract_preproc.AbstractPreproc):
                 db_path=item.db_path,
                 tokenize=self._schema_tokenize,
             )
-            self.sql_schemas_multi[self.lang_dict[section]][item.spider_schema.db_id] = schema
+            self.sql_schemas_multi[self.lang_dict[section]][
+                item.spider_schema.db_id
+            ] = self.schema_registry.intern(schema)
+        return self.sql_schemas_multi[lang][item.spider_schema.db_id]
+
+    def validate_item(
+        self, item: SpiderItem, section: str
+    ) -> Tuple[bool, Optional[AbstractSyntaxTree]]:
+        self._sql_schema(item, section)
 
         try:
             if isinstance(item, SpiderItem) and isinstance(
@@ -125,13 +168,73 @@ class DuoRATPreproc(abstract_preproc.AbstractPreproc):
     ) -> RATPreprocItem:
         raise NotImplementedError
 
+    def _item_cache_key(
+        self, item: SpiderItem, sql_schema: SQLSchema, section: str
+    ) -> str:
+        # with the db_id, the schema id catches edits of the schema definitions
+        return PreprocItemCache.key(
+            item.question,
+            item.spider_sql,
+            item.slml_question,
+            item.spider_schema.db_id,
+            self.schema_registry.schema_id(sql_schema),
+            self.lang_dict.get(section, 'en'),
+            self.item_cache_config,
+        )
+
+    def prefetch(self, items: Sequence[SpiderItem], section: str) -> None:
+        """Lets the schema linker batch the work for the items that will be added next,
+        except for those that do not need it."""
+        questions, sql_schemas = [], {}
+        for item in items:
+            if item.slml_question is not None:
+                continue
+            sql_schema = self._sql_schema(item, section)
+            if self.item_cache is not None and self.item_cache.contains(
+                self._item_cache_key(item, sql_schema, section)
+            ):
+                continue
+            questions.append(item.question)
+            sql_schemas[id(sql_schema)] = sql_schema
+        if len(questions) > 0:
+            self.schema_linker.prefetch(
+                questions=questions,
+                sql_schemas=sql_schemas.values(),
+                lang=self.lang_dict.get(section, 'en'),
+            )
+
+    def preprocess_item_cached(
+        self,
+        item: SpiderItem,
+        sql_schema: SQLSchema,
+        validation_info: AbstractSyntaxTree,
+        section: str
+    ) -> RATPreprocItem:
+        if self.item_cache is None:
+            return self.preprocess_item(item, sql_schema, validation_info, section)
+
+        key = self._item_cache_key(item, sql_schema, section)
+        cached = self.item_cache.get(key)
+        if cached is not None:
+            slml_question, question, actions = cached
+            item.slml_question = slml_question
+            return RATPreprocItem(
+                question=question, sql_schema=sql_schema, actions=actions
+            )
+
+        preproc_item = self.preprocess_item(item, sql_schema, validation_info, section)
+        self.item_cache.put(
+            key, (item.slml_question, preproc_item.question, preproc_item.actions)
+        )
+        return preproc_item
+
     def add_item(
         self, item: SpiderItem, section: str, validation_info: AbstractSyntaxTree
     ) -> None:
         """Adds item and copies of it with shuffled schema if num_schema_shuffles > 0"""
         lang = self.lang_dict.get(section, 'default')
         sql_schema = self.sql_schemas_multi[lang][item.spider_schema.db_id]
-        preproc_item_no_shuffle = self.preprocess_item(
+        preproc_item_no_shuffle = self.preprocess_item_cached(
             item, sql_schema, validation_info, section
         )
         preproc_items = [preproc_item_no_shuffle]
@@ -143,7 +246,7 @@ class DuoRATPreproc(abstract_preproc.AbstractPreproc):
         else:
             num_schema_shuffles = 0
         for _ in range(num_schema_shuffles):
-            shuffled_schema = shuffle_schema(sql_schema)
+            shuffled_schema = self.schema_registry.intern(shuffle_schema(sql_schema))
             preproc_items.append(
                 replace(preproc_item_no_shuffle, sql_schema=shuffled_schema)
             )
@@ -158,11 +261,36 @@ class DuoRATPreproc(abstract_preproc.AbstractPreproc):
     def clear_items(self) -> None:
         self.preproc_items: Dict[str, List[RATPreprocItem]] = {}
 
+    def vocab_counts(self) -> Dict[str, Union[Counter, Set[str]]]:
+        """The counts gathered by update_vocab, e.g. to merge them across shards."""
+        return {
+            "target_vocab_counter": self.target_vocab_counter,
+            "counted_db_ids": self.counted_db_ids,
+        }
+
+    def merge_vocab_counts(
+        self, vocab_counts: Dict[str, Union[Counter, Set[str]]]
+    ) -> None:
+        """Add the counts of another preprocessor. The counts are only the same as if the
+        items had been added here if the schemas of a database were counted only once."""
+        self.target_vocab_counter.update(vocab_counts["target_vocab_counter"])
+        self.counted_db_ids |= vocab_counts["counted_db_ids"]
+
+    def clear_vocab_counts(self) -> None:
+        self.target_vocab_counter = Counter()
+        self.counted_db_ids = set()
+
     def save_examples(self) -> None:
         os.makedirs(self.save_path, exist_ok=True)
         for section, items in self.preproc_items.items():
-            with open(os.path.join(self.save_path, section + ".pkl"), "wb") as f:
-                pickle.dump(items, f)
+            save_items(
+                os.path.join(self.save_path, section), items, self.schema_registry
+            )
+        self.schema_registry.save(
+            sections=[
+                os.path.join(self.save_path, section) for section in self.preproc_items
+            ]
+        )
 
     def save(self) -> None:
         self.save_examples()
@@ -185,36 +313,54 @@ class DuoRATPreproc(abstract_preproc.AbstractPreproc):
         with open(self.target_vocab_path, "wb") as f:
             pickle.dump(self.target_vocab, f)
 
+        self.valid_actions_mask_table = ValidActionsMaskTable(
+            target_vocab=self.target_vocab, transition_system=self.transition_system
+        ).precompute(grammar=self.transition_system.grammar)
+        self.valid_actions_mask_table.save(self.valid_actions_mask_table_path)
+
     def load(self) -> None:
         with open(self.target_vocab_path, "rb") as f:
             self.target_vocab = pickle.load(f)
-
-    def dataset(self, section: str) -> List[RATPreprocItem]:
+        self.valid_actions_mask_table = ValidActionsMaskTable(
+            target_vocab=self.target_vocab, transition_system=self.transition_system
+        ).load(self.valid_actions_mask_table_path)
+
+    def dataset(self, section: str) -> Sequence[RATPreprocItem]:
+        if has_items(os.path.join(self.save_path, section)):
+            return ColumnarItems(
+                os.path.join(self.save_path, section), self.schema_registry
+            )
+        # sections preprocessed before the columnar format
         with open(os.path.join(self.save_path, section + ".pkl"), "rb") as f:
             items = pickle.load(f)
         return items
 
 
 class SingletonGloVe(Vectors):
+    """The GloVe vectors, which are loaded on first use."""
 
     _glove = None
 
     def __init__(self):
-        SingletonGloVe._load_if_needed()
+        pass
 
     @property
     def vectors(self):
+        SingletonGloVe._load_if_needed()
         return SingletonGloVe._glove.vectors
 
     def __getitem__(self, token):
+        SingletonGloVe._load_if_needed()
         return SingletonGloVe._glove[token]
 
     @property
     def dim(self):
-        return self._glove.dim
+        SingletonGloVe._load_if_needed()
+        return SingletonGloVe._glove.dim
 
     @property
     def stoi(self):
+        SingletonGloVe._load_if_needed()
         return SingletonGloVe._glove.stoi
 
     @staticmethod
@@ -230,7 +376,6 @@ class SingletonGloVe(Vectors):
 
     def __setstate__(self, state):
         assert len(state) == 0
-        self._load_if_needed()
 
 
 @registry.register("preproc", "TransformerDuoRAT")
@@ -240,14 +385,17 @@ class TransformerDuoRATPreproc(DuoRATPreproc):
 
         self.use_full_glove_vocab = kwargs.get("use_full_glove_vocab", False)
 
+        # for the tokens that appear in the training data. They are only split into
+        # GloVe tokens and others when the vocabularies are built, so that counting,
+        # e.g. in preprocessing workers, does not load GloVe.
+        self.input_tokens_counter = Counter()
+
         # for GloVe tokens that appear in the training data
-        self.input_vocab_a_counter = Counter()
         self.input_vocab_a_vectors = SingletonGloVe()
         self.input_vocab_a_path = os.path.join(self.save_path, "input_vocab_a.pkl")
         self.input_vocab_a = None
 
         # for tokens that appear in the training data and are not in GloVe
-        self.input_vocab_b_counter = Counter()
         self.input_vocab_b_path = os.path.join(self.save_path, "input_vocab_b.pkl")
         self.input_vocab_b = None
 
@@ -311,23 +459,7 @@ class TransformerDuoRATPreproc(DuoRATPreproc):
                 )
             )
 
-        # add to first input vocab only what is in GLoVe
-        self.input_vocab_a_counter.update(
-            (
-                token
-                for token in tokens_to_count
-                if token in self.input_vocab_a_vectors.stoi
-            )
-        )
-
-        # add only to second input vocab what is *not* already in first input vocab (GLoVe)
-        self.input_vocab_b_counter.update(
-            (
-                token
-                for token in tokens_to_count
-                if token not in self.input_vocab_a_vectors.stoi
-            )
-        )
+        self.input_tokens_counter.update(tokens_to_count)
 
         # add only GenToken tokens to target vocab that are *not* in the encoder sequence
         self.target_vocab_counter.update(
@@ -338,12 +470,36 @@ class TransformerDuoRATPreproc(DuoRATPreproc):
             )
         )
 
+    def vocab_counts(self) -> Dict[str, Union[Counter, Set[str]]]:
+        vocab_counts = super(TransformerDuoRATPreproc, self).vocab_counts()
+        vocab_counts["input_tokens_counter"] = self.input_tokens_counter
+        return vocab_counts
+
+    def merge_vocab_counts(
+        self, vocab_counts: Dict[str, Union[Counter, Set[str]]]
+    ) -> None:
+        super(TransformerDuoRATPreproc, self).merge_vocab_counts(vocab_counts)
+        self.input_tokens_counter.update(vocab_counts["input_tokens_counter"])
+
+    def clear_vocab_counts(self) -> None:
+        super(TransformerDuoRATPreproc, self).clear_vocab_counts()
+        self.input_tokens_counter = Counter()
+
     def save(self) -> None:
         super(TransformerDuoRATPreproc, self).save()
 
+        # add to first input vocab only what is in GLoVe, and only to second input vocab
+        # what is *not* already in first input vocab (GLoVe)
+        input_vocab_a_counter, input_vocab_b_counter = Counter(), Counter()
+        for token, count in self.input_tokens_counter.items():
+            if token in self.input_vocab_a_vectors.stoi:
+                input_vocab_a_counter[token] = count
+            else:
+                input_vocab_b_counter[token] = count
+
         # GloVe tokens that appear in the training data
         self.input_vocab_a = Vocab(
-            counter=self.input_vocab_a_counter,
+            counter=input_vocab_a_counter,
             max_size=50000,
             min_freq=1,
             vectors=self.input_vocab_a_vectors,
@@ -355,7 +511,7 @@ class TransformerDuoRATPreproc(DuoRATPreproc):
 
         # tokens that appear in the training data and are not in GloVe
         self.input_vocab_b = Vocab(
-            counter=self.input_vocab_b_counter,
+            counter=input_vocab_b_counter,
             max_size=5000,
             min_freq=self.min_freq,
             specials=["<unk>"],
@@ -1,10 +1,20 @@
 import itertools
 import logging
-from collections import deque, defaultdict
+from collections import deque, defaultdict, OrderedDict
 from copy import deepcopy, copy
 from dataclasses import dataclass, field
-from typing import Generator, Tuple, Union, Iterable, Dict, Sequence, Deque
+from typing import (
+    Generator,
+    Tuple,
+    Iterable,
+    Dict,
+    Sequence,
+    Deque,
+    Callable,
+    Optional,
+)
 
+import numpy as np
 import torch
 
 from duorat.asdl.action_info import ActionInfo
@@ -401,33 +411,27 @@ def freeze_order(xxs: Iterable[Iterable[T]]) -> FrozenDict[T, int]:
     return frozendict({rel: i for i, rel in enumerate(itertools.chain(*xxs))})
 
 
+# Maximum number of schemas for which the column and table relations are kept around
+SCHEMA_RELATIONS_CACHE_SIZE = 256
+_schema_relation_ids_cache: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+
+
 @dataclass
 class SourceRelationsBuilder(object):
     sql_schema: SQLSchema
     relation_types: FrozenDict[SourceRelation, int]
     input_tokens: Deque[Token[InputId, str]] = field(default_factory=deque)
     source_question_tokens: Deque[QuestionToken[str]] = field(default_factory=deque)
-    columns_position_map: PositionMap[ColumnId] = field(
-        default_factory=lambda: defaultdict(deque)
-    )
-    tables_position_map: PositionMap[TableId] = field(
-        default_factory=lambda: defaultdict(deque)
-    )
-    sparse_2d_tensor_builder: Sparse2DTensorBuilder = field(
-        default_factory=lambda: Sparse2DTensorBuilder()
-    )
+    source_column_tokens: Deque[ColumnToken[str]] = field(default_factory=deque)
+    source_table_tokens: Deque[TableToken[str]] = field(default_factory=deque)
+    source_token_max_position: int = -1
 
     def __deepcopy__(self, memo) -> "SourceRelationsBuilder":
         builder = copy(self)
         builder.input_tokens = copy(self.input_tokens)
         builder.source_question_tokens = copy(self.source_question_tokens)
-        builder.columns_position_map = defaultdict(deque)
-        for s, positions in self.columns_position_map.items():
-            builder.columns_position_map[s] = copy(positions)
-        builder.tables_position_map = defaultdict(deque)
-        for s, positions in self.tables_position_map.items():
-            builder.tables_position_map[s] = copy(positions)
-        builder.sparse_2d_tensor_builder = deepcopy(self.sparse_2d_tensor_builder)
+        builder.source_column_tokens = copy(self.source_column_tokens)
+        builder.source_table_tokens = copy(self.source_table_tokens)
         return builder
 
     def add_input_token(
@@ -445,424 +449,226 @@ class SourceRelationsBuilder(object):
             builder.add_input_token(input_token=input_token)
         return builder
 
-    def _qq_relations(
-        self, position: Pos, other_position: Pos
-    ) -> Generator[
-        Tuple[Pos, Pos, Union[QQDefaultRelation, QQDistRelation]], None, None
-    ]:
-        relation = QQDistRelation(position - other_position)
-        if relation in self.relation_types:
-            yield position, other_position, relation
-        elif QQDefaultRelation() in self.relation_types:
-            yield position, other_position, QQDefaultRelation()
-
-    def _cc_relations(
-        self,
-        column_id: ColumnId,
-        position: Pos,
-        other_column_id: ColumnId,
-        other_position: Pos,
-    ) -> Generator[
-        Tuple[
-            Pos,
-            Pos,
-            Union[
-                CCDefaultRelation,
-                CCDistRelation,
-                CCForeignKeyForwardRelation,
-                CCForeignKeyBackwardRelation,
-                CCTableMatchRelation,
-            ],
-        ],
-        None,
-        None,
-    ]:
-        if column_id == other_column_id:
-            # sibling positions share the same column
-            dist_relation = CCDistRelation(position - other_position)
-            if dist_relation in self.relation_types:
-                yield position, other_position, dist_relation
-            elif CCDefaultRelation() in self.relation_types:
-                yield position, other_position, CCDefaultRelation()
-        elif (
-            CCForeignKeyForwardRelation() in self.relation_types
-            and column_id in self.sql_schema.foreign_keys
-            and self.sql_schema.foreign_keys[column_id] == other_column_id
-        ):
-            yield position, other_position, CCForeignKeyForwardRelation()
-        elif (
-            CCForeignKeyBackwardRelation() in self.relation_types
-            and other_column_id in self.sql_schema.foreign_keys
-            and self.sql_schema.foreign_keys[other_column_id] == column_id
-        ):
-            yield position, other_position, CCForeignKeyBackwardRelation()
-        elif (
-            CCTableMatchRelation() in self.relation_types
-            and self.sql_schema.column_to_table[column_id]
-            == self.sql_schema.column_to_table[other_column_id]
-        ):
-            yield position, other_position, CCTableMatchRelation()
-        elif CCDefaultRelation() in self.relation_types:
-            yield position, other_position, CCDefaultRelation()
+    def _relation_id(self, *relations: SourceRelation) -> int:
+        """Id of the first of the relations that is in use.
+        If none is, the pair of positions is left at 0, as are all unrelated pairs."""
+        for relation in relations:
+            if relation in self.relation_types:
+                return self.relation_types[relation]
+        return 0
 
-    def _tt_relations(
+    def _dist_relation_ids(
         self,
-        table_id: TableId,
-        position: Pos,
-        other_table_id: TableId,
-        other_position: Pos,
-    ) -> Generator[
-        Tuple[
-            Pos,
-            Pos,
-            Union[
-                TTDefaultRelation,
-                TTDistRelation,
-                TTForeignKeyForwardRelation,
-                TTForeignKeyBackwardRelation,
-                TTForeignKeyBidirectionalRelation,
+        positions: np.ndarray,
+        other_positions: np.ndarray,
+        dist_relation: Callable[[int], SourceRelation],
+        default_relation: SourceRelation,
+    ) -> np.ndarray:
+        dist = positions[:, None] - other_positions[None, :]
+        max_dist = int(np.abs(dist).max(initial=0))
+        dist_relation_ids = np.array(
+            [
+                self._relation_id(dist_relation(d), default_relation)
+                for d in range(-max_dist, max_dist + 1)
             ],
-        ],
-        None,
-        None,
-    ]:
-        if table_id == other_table_id:
-            # sibling positions share the same table
-            relation = TTDistRelation(position - other_position)
-            if relation in self.relation_types:
-                yield position, other_position, relation
-            elif TTDefaultRelation() in self.relation_types:
-                yield position, other_position, TTDefaultRelation()
-        elif (
-            TTForeignKeyBidirectionalRelation() in self.relation_types
-            and other_table_id
-            in self.sql_schema.foreign_keys_tables.get(table_id, tuple())
-            and table_id
-            in self.sql_schema.foreign_keys_tables.get(other_table_id, tuple())
-        ):
-            yield position, other_position, TTForeignKeyBidirectionalRelation()
-        elif TTForeignKeyForwardRelation() in self.relation_types and (
-            other_table_id in self.sql_schema.foreign_keys_tables.get(table_id, tuple())
-        ):
-            yield position, other_position, TTForeignKeyForwardRelation()
-        elif TTForeignKeyBackwardRelation() in self.relation_types and (
-            table_id in self.sql_schema.foreign_keys_tables.get(other_table_id, tuple())
-        ):
-            yield position, other_position, TTForeignKeyBackwardRelation()
-        elif TTDefaultRelation() in self.relation_types:
-            yield position, other_position, TTDefaultRelation()
+            dtype=np.int64,
+        )
+        return dist_relation_ids[dist + max_dist]
+
+    def _qq_relation_ids(self, question_positions: np.ndarray) -> np.ndarray:
+        return self._dist_relation_ids(
+            positions=question_positions,
+            other_positions=question_positions,
+            dist_relation=QQDistRelation,
+            default_relation=QQDefaultRelation(),
+        )
 
-    def _ct_relations(
+    def _cc_relation_ids(
         self,
-        column_id: ColumnId,
-        column_position: Pos,
-        table_id: TableId,
-        table_position: Pos,
-    ) -> Generator[
-        Tuple[
-            Pos,
-            Pos,
-            Union[
-                CTDefaultRelation,
-                CTAnyTableRelation,
-                CTForeignKeyRelation,
-                CTPrimaryKeyRelation,
-                CTTableMatchRelation,
-                TCDefaultRelation,
-                TCAnyTableRelation,
-                TCForeignKeyRelation,
-                TCPrimaryKeyRelation,
-                TCTableMatchRelation,
+        column_positions: np.ndarray,
+        column_indices: np.ndarray,
+        foreign_key_matrix: np.ndarray,
+        column_table_indices: np.ndarray,
+    ) -> np.ndarray:
+        foreign_key = foreign_key_matrix[np.ix_(column_indices, column_indices)]
+        table_indices = column_table_indices[column_indices]
+        return np.select(
+            [
+                # sibling positions share the same column
+                column_indices[:, None] == column_indices[None, :],
+                foreign_key & (CCForeignKeyForwardRelation() in self.relation_types),
+                foreign_key.T & (CCForeignKeyBackwardRelation() in self.relation_types),
+                (table_indices[:, None] == table_indices[None, :])
+                & (CCTableMatchRelation() in self.relation_types),
             ],
-        ],
-        None,
-        None,
-    ]:
-        if (
-            column_id in self.sql_schema.foreign_keys
-            and self.sql_schema.column_to_table[column_id]
-            == self.sql_schema.column_to_table[self.sql_schema.foreign_keys[column_id]]
-        ):
-            if CTForeignKeyRelation() in self.relation_types:
-                yield column_position, table_position, CTForeignKeyRelation()
-            elif CTDefaultRelation() in self.relation_types:
-                yield column_position, table_position, CTDefaultRelation()
-            if TCForeignKeyRelation() in self.relation_types:
-                yield table_position, column_position, TCForeignKeyRelation()
-            elif TCDefaultRelation() in self.relation_types:
-                yield table_position, column_position, TCDefaultRelation()
-        elif column_id not in self.sql_schema.column_to_table:
-            # for the * wild card column
-            if CTAnyTableRelation() in self.relation_types:
-                yield column_position, table_position, CTAnyTableRelation()
-            elif CTDefaultRelation() in self.relation_types:
-                yield column_position, table_position, CTDefaultRelation()
-            if TCAnyTableRelation() in self.relation_types:
-                yield table_position, column_position, TCAnyTableRelation()
-            elif TCDefaultRelation() in self.relation_types:
-                yield table_position, column_position, TCDefaultRelation()
-        elif (
-            table_id == self.sql_schema.column_to_table[column_id]
-            and column_id in self.sql_schema.primary_keys
-        ):
-            if CTPrimaryKeyRelation() in self.relation_types:
-                yield column_position, table_position, CTPrimaryKeyRelation()
-            elif CTDefaultRelation() in self.relation_types:
-                yield column_position, table_position, CTDefaultRelation()
-            if TCPrimaryKeyRelation() in self.relation_types:
-                yield table_position, column_position, TCPrimaryKeyRelation()
-            elif TCDefaultRelation() in self.relation_types:
-                yield table_position, column_position, TCDefaultRelation()
-        elif (
-            table_id == self.sql_schema.column_to_table[column_id]
-            and column_id not in self.sql_schema.primary_keys
-        ):
-            if CTTableMatchRelation() in self.relation_types:
-                yield column_position, table_position, TCTableMatchRelation()
-            elif CTDefaultRelation() in self.relation_types:
-                yield column_position, table_position, CTDefaultRelation()
-            if TCTableMatchRelation() in self.relation_types:
-                yield table_position, column_position, TCTableMatchRelation()
-            elif TCDefaultRelation() in self.relation_types:
-                yield table_position, column_position, TCDefaultRelation()
-        else:
-            if CTDefaultRelation() in self.relation_types:
-                yield column_position, table_position, CTDefaultRelation()
-            if TCDefaultRelation() in self.relation_types:
-                yield table_position, column_position, TCDefaultRelation()
+            [
+                self._dist_relation_ids(
+                    positions=column_positions,
+                    other_positions=column_positions,
+                    dist_relation=CCDistRelation,
+                    default_relation=CCDefaultRelation(),
+                ),
+                self._relation_id(CCForeignKeyForwardRelation()),
+                self._relation_id(CCForeignKeyBackwardRelation()),
+                self._relation_id(CCTableMatchRelation()),
+            ],
+            default=self._relation_id(CCDefaultRelation()),
+        )
 
-    def _qc_relations(
+    def _tt_relation_ids(
         self,
-        question_match_tags: Tuple[MatchTag, ...],
-        question_position: Pos,
-        column_id: ColumnId,
-        column_position: Pos,
-    ) -> Generator[
-        Tuple[
-            Pos,
-            Pos,
-            Union[
-                QCDefaultRelation, QCMatchRelation, CQDefaultRelation, CQMatchRelation,
+        table_positions: np.ndarray,
+        table_indices: np.ndarray,
+        foreign_key_tables_matrix: np.ndarray,
+    ) -> np.ndarray:
+        foreign_key = foreign_key_tables_matrix[np.ix_(table_indices, table_indices)]
+        return np.select(
+            [
+                # sibling positions share the same table
+                table_indices[:, None] == table_indices[None, :],
+                foreign_key
+                & foreign_key.T
+                & (TTForeignKeyBidirectionalRelation() in self.relation_types),
+                foreign_key & (TTForeignKeyForwardRelation() in self.relation_types),
+                foreign_key.T & (TTForeignKeyBackwardRelation() in self.relation_types),
             ],
-        ],
-        None,
-        None,
-    ]:
-        question_match_tags = list(
-            match_tag
-            for match_tag in question_match_tags
-            if (
-                isinstance(match_tag, ColumnMatchTag)
-                or isinstance(match_tag, ValueMatchTag)
-            )
-            and match_tag.column_id == column_id
+            [
+                self._dist_relation_ids(
+                    positions=table_positions,
+                    other_positions=table_positions,
+                    dist_relation=TTDistRelation,
+                    default_relation=TTDefaultRelation(),
+                ),
+                self._relation_id(TTForeignKeyBidirectionalRelation()),
+                self._relation_id(TTForeignKeyForwardRelation()),
+                self._relation_id(TTForeignKeyBackwardRelation()),
+            ],
+            default=self._relation_id(TTDefaultRelation()),
         )
-        if len(question_match_tags) == 1:
-            question_match_tag = question_match_tags[0]
-        elif len(question_match_tags) == 0:
-            question_match_tag = None
-        else:
-            raise ValueError(f"Found more than 1 q-c matches: {question_match_tags}")
-        if question_match_tag is not None:
-            qc_match_relation = QCMatchRelation(
-                confidence=question_match_tag.confidence,
-                value_match=isinstance(question_match_tag, ValueMatchTag),
-            )
-            if qc_match_relation in self.relation_types:
-                yield question_position, column_position, qc_match_relation
-            elif QCDefaultRelation() in self.relation_types:
-                yield question_position, column_position, QCDefaultRelation()
-            cq_match_relation = CQMatchRelation(
-                confidence=question_match_tag.confidence,
-                value_match=isinstance(question_match_tag, ValueMatchTag),
-            )
-            if cq_match_relation in self.relation_types:
-                yield column_position, question_position, cq_match_relation
-            elif CQDefaultRelation() in self.relation_types:
-                yield column_position, question_position, CQDefaultRelation()
-        else:
-            if QCDefaultRelation() in self.relation_types:
-                yield question_position, column_position, QCDefaultRelation()
-            if CQDefaultRelation() in self.relation_types:
-                yield column_position, question_position, CQDefaultRelation()
 
-    def _qt_relations(
+    def _ct_relation_ids(
         self,
-        question_match_tags: Tuple[MatchTag, ...],
-        question_position: Pos,
-        table_id: TableId,
-        table_position: Pos,
-    ) -> Generator[
-        Tuple[
-            Pos,
-            Pos,
-            Union[
-                QTDefaultRelation, QTMatchRelation, TQDefaultRelation, TQMatchRelation,
+        column_indices: np.ndarray,
+        table_indices: np.ndarray,
+        column_table_indices: np.ndarray,
+        column_foreign_key_same_table: np.ndarray,
+        column_without_table: np.ndarray,
+        column_primary_key: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        table_match = (
+            column_table_indices[column_indices][:, None] == table_indices[None, :]
+        )
+        primary_key = column_primary_key[column_indices][:, None]
+        conditions = [
+            np.broadcast_to(
+                column_foreign_key_same_table[column_indices][:, None],
+                table_match.shape,
+            ),
+            # for the * wild card column
+            np.broadcast_to(
+                column_without_table[column_indices][:, None], table_match.shape
+            ),
+            table_match & primary_key,
+            table_match & ~primary_key,
+        ]
+        ct_relation_ids = np.select(
+            conditions,
+            [
+                self._relation_id(CTForeignKeyRelation(), CTDefaultRelation()),
+                self._relation_id(CTAnyTableRelation(), CTDefaultRelation()),
+                self._relation_id(CTPrimaryKeyRelation(), CTDefaultRelation()),
+                # column-to-table matches have always been tagged with the
+                # table-to-column relation, keep it that way
+                (
+                    self._relation_id(TCTableMatchRelation())
+                    if CTTableMatchRelation() in self.relation_types
+                    else self._relation_id(CTDefaultRelation())
+                ),
             ],
-        ],
-        None,
-        None,
-    ]:
-        question_match_tags = list(
-            match_tag
-            for match_tag in question_match_tags
-            if (
-                isinstance(match_tag, TableMatchTag)
-                # or isinstance(match_tag, ColumnMatchTag)
-                # or isinstance(match_tag, ValueMatchTag)
-            )
-            and match_tag.table_id == table_id
+            default=self._relation_id(CTDefaultRelation()),
         )
-        if len(question_match_tags) == 1:
-            question_match_tag = question_match_tags[0]
-        elif len(question_match_tags) == 0:
-            question_match_tag = None
-        else:
-            raise ValueError(f"Found more than 1 q-t matches: {question_match_tags}")
+        tc_relation_ids = np.select(
+            conditions,
+            [
+                self._relation_id(TCForeignKeyRelation(), TCDefaultRelation()),
+                self._relation_id(TCAnyTableRelation(), TCDefaultRelation()),
+                self._relation_id(TCPrimaryKeyRelation(), TCDefaultRelation()),
+                self._relation_id(TCTableMatchRelation(), TCDefaultRelation()),
+            ],
+            default=self._relation_id(TCDefaultRelation()),
+        )
+        return ct_relation_ids, tc_relation_ids.T
 
-        if question_match_tag is not None:
-            qt_match_relation = QTMatchRelation(
-                confidence=question_match_tag.confidence,
-                value_match=isinstance(question_match_tag, ValueMatchTag),
-            )
-            if qt_match_relation in self.relation_types:
-                yield question_position, table_position, qt_match_relation
-            elif QTDefaultRelation() in self.relation_types:
-                yield question_position, table_position, QTDefaultRelation()
-            tq_match_relation = TQMatchRelation(
-                confidence=question_match_tag.confidence,
-                value_match=isinstance(question_match_tag, ValueMatchTag),
-            )
-            if tq_match_relation in self.relation_types:
-                yield table_position, question_position, tq_match_relation
-            elif TQDefaultRelation() in self.relation_types:
-                yield table_position, question_position, TQDefaultRelation()
-        else:
-            if QTDefaultRelation() in self.relation_types:
-                yield question_position, table_position, QTDefaultRelation()
-            if TQDefaultRelation() in self.relation_types:
-                yield table_position, question_position, TQDefaultRelation()
-
-    def _source_relations(
-        self, source_token: Token[InputId, str]
-    ) -> Generator[
-        Tuple[Pos, Pos, SourceRelation], None, None,
-    ]:
-        if isinstance(source_token, QuestionToken):
-            self.source_question_tokens.append(source_token)
-            for other_token in self.source_question_tokens:
-                yield from self._qq_relations(
-                    position=source_token.position, other_position=other_token.position
-                )
-                if source_token.position != other_token.position:
-                    yield from self._qq_relations(
-                        position=other_token.position,
-                        other_position=source_token.position,
-                    )
-            for column_id, column_positions in self.columns_position_map.items():
-                for column_position in column_positions:
-                    yield from self._qc_relations(
-                        question_match_tags=source_token.match_tags,
-                        question_position=source_token.position,
-                        column_id=column_id,
-                        column_position=column_position,
-                    )
-            for table_id, table_positions in self.tables_position_map.items():
-                for table_position in table_positions:
-                    yield from self._qt_relations(
-                        question_match_tags=source_token.match_tags,
-                        question_position=source_token.position,
-                        table_id=table_id,
-                        table_position=table_position,
-                    )
-        elif isinstance(source_token, ColumnToken):
-            self.columns_position_map[source_token.key].append(source_token.position)
-            assert source_token.key in self.columns_position_map
-            for other_column_id, other_positions in self.columns_position_map.items():
-                for other_position in other_positions:
-                    yield from self._cc_relations(
-                        column_id=source_token.key,
-                        position=source_token.position,
-                        other_column_id=other_column_id,
-                        other_position=other_position,
-                    )
-                    if source_token.position != other_position:
-                        yield from self._cc_relations(
-                            column_id=other_column_id,
-                            position=other_position,
-                            other_column_id=source_token.key,
-                            other_position=source_token.position,
-                        )
-            for table_id, table_positions in self.tables_position_map.items():
-                for table_position in table_positions:
-                    yield from self._ct_relations(
-                        column_id=source_token.key,
-                        column_position=source_token.position,
-                        table_id=table_id,
-                        table_position=table_position,
-                    )
-            for question_token in self.source_question_tokens:
-                yield from self._qc_relations(
-                    question_match_tags=question_token.match_tags,
-                    question_position=question_token.position,
-                    column_id=source_token.key,
-                    column_position=source_token.position,
+    def _q_schema_relation_ids(
+        self,
+        schema_indices: np.ndarray,
+        num_schema_indices: int,
+        get_match_schema_index: Callable[[MatchTag], Optional[int]],
+        match_relation: Callable[[MatchConfidence, bool], SourceRelation],
+        reverse_match_relation: Callable[[MatchConfidence, bool], SourceRelation],
+        default_relation: SourceRelation,
+        reverse_default_relation: SourceRelation,
+        kind: str,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        num_question_tokens = len(self.source_question_tokens)
+        relation_ids = np.full(
+            (num_question_tokens, num_schema_indices),
+            self._relation_id(default_relation),
+            dtype=np.int64,
+        )
+        reverse_relation_ids = np.full(
+            (num_question_tokens, num_schema_indices),
+            self._relation_id(reverse_default_relation),
+            dtype=np.int64,
+        )
+        num_matches = np.zeros(
+            (num_question_tokens, num_schema_indices), dtype=np.int64
+        )
+        for i, question_token in enumerate(self.source_question_tokens):
+            for match_tag in question_token.match_tags:
+                schema_index = get_match_schema_index(match_tag)
+                if schema_index is None:
+                    continue
+                value_match = isinstance(match_tag, ValueMatchTag)
+                num_matches[i, schema_index] += 1
+                relation_ids[i, schema_index] = self._relation_id(
+                    match_relation(match_tag.confidence, value_match), default_relation
                 )
-        elif isinstance(source_token, TableToken):
-            for column_id, column_positions in self.columns_position_map.items():
-                for column_position in column_positions:
-                    yield from self._ct_relations(
-                        column_id=column_id,
-                        column_position=column_position,
-                        table_id=source_token.key,
-                        table_position=source_token.position,
-                    )
-            self.tables_position_map[source_token.key].append(source_token.position)
-            assert source_token.key in self.tables_position_map
-            for other_table_id, other_positions in self.tables_position_map.items():
-                for other_position in other_positions:
-                    yield from self._tt_relations(
-                        table_id=source_token.key,
-                        position=source_token.position,
-                        other_table_id=other_table_id,
-                        other_position=other_position,
-                    )
-                    if source_token.position != other_position:
-                        yield from self._tt_relations(
-                            table_id=other_table_id,
-                            position=other_position,
-                            other_table_id=source_token.key,
-                            other_position=source_token.position,
-                        )
-            for question_token in self.source_question_tokens:
-                yield from self._qt_relations(
-                    question_match_tags=question_token.match_tags,
-                    question_position=question_token.position,
-                    table_id=source_token.key,
-                    table_position=source_token.position,
+                reverse_relation_ids[i, schema_index] = self._relation_id(
+                    reverse_match_relation(match_tag.confidence, value_match),
+                    reverse_default_relation,
                 )
-        else:
-            raise ValueError(
-                "Unsupported token type: {}".format(source_token.__repr__())
-            )
+        num_matches = num_matches[:, schema_indices]
+        if (num_matches > 1).any():
+            i, j = np.argwhere(num_matches > 1)[0]
+            match_tags = [
+                match_tag
+                for match_tag in self.source_question_tokens[i].match_tags
+                if get_match_schema_index(match_tag) == schema_indices[j]
+            ]
+            raise ValueError(f"Found more than 1 {kind} matches: {match_tags}")
+        return (
+            relation_ids[:, schema_indices],
+            reverse_relation_ids[:, schema_indices].T,
+        )
 
     def add_source_token(
         self, source_token: Token[InputId, str], copy: bool = False
     ) -> "SourceRelationsBuilder":
         builder = deepcopy(self) if copy is True else self
-
-        for position, other_position, relation in builder._source_relations(
-            source_token=source_token
-        ):
-            builder.sparse_2d_tensor_builder.append(
-                index=(position, other_position),
-                value=builder.relation_types[relation],
+        if isinstance(source_token, QuestionToken):
+            builder.source_question_tokens.append(source_token)
+        elif isinstance(source_token, ColumnToken):
+            builder.source_column_tokens.append(source_token)
+        elif isinstance(source_token, TableToken):
+            builder.source_table_tokens.append(source_token)
+        else:
+            raise ValueError(
+                "Unsupported token type: {}".format(source_token.__repr__())
             )
-
-        builder.sparse_2d_tensor_builder.resize(
-            size=(1 + source_token.position, 1 + source_token.position)
+        builder.source_token_max_position = max(
+            builder.source_token_max_position, source_token.position
         )
-
         return builder
 
     def add_source_tokens(
@@ -873,8 +679,208 @@ class SourceRelationsBuilder(object):
             builder.add_source_token(source_token=token)
         return builder
 
+    def _schema_relation_ids(self) -> np.ndarray:
+        """Column and table relations, ordered as the column and then the table tokens.
+        They only depend on the structure of the schema and on the schema tokens,
+        and are thus shared by all the questions asked on the same database."""
+        sql_schema = self.sql_schema
+        column_keys = tuple(token.key for token in self.source_column_tokens)
+        table_keys = tuple(token.key for token in self.source_table_tokens)
+        schema_positions = [
+            token.position
+            for token in itertools.chain(
+                self.source_column_tokens, self.source_table_tokens
+            )
+        ]
+        offset = min(schema_positions, default=0)
+        cache_key = (
+            sql_schema.db_id,
+            sql_schema.column_to_table,
+            sql_schema.foreign_keys,
+            sql_schema.foreign_keys_tables,
+            sql_schema.primary_keys,
+            self.relation_types,
+            column_keys,
+            table_keys,
+            tuple(position - offset for position in schema_positions),
+        )
+        schema_relation_ids = _schema_relation_ids_cache.get(cache_key)
+        if schema_relation_ids is not None:
+            _schema_relation_ids_cache.move_to_end(cache_key)
+            return schema_relation_ids
+
+        column_index: Dict[ColumnId, int] = {}
+        for column_id in itertools.chain(
+            column_keys,
+            sql_schema.foreign_keys.keys(),
+            sql_schema.foreign_keys.values(),
+        ):
+            column_index.setdefault(column_id, len(column_index))
+        table_index: Dict[Optional[TableId], int] = {None: -1}
+        for table_id in itertools.chain(
+            table_keys,
+            sql_schema.column_to_table.values(),
+            sql_schema.foreign_keys_tables.keys(),
+            itertools.chain.from_iterable(sql_schema.foreign_keys_tables.values()),
+        ):
+            table_index.setdefault(table_id, len(table_index) - 1)
+        num_columns, num_tables = len(column_index), len(table_index) - 1
+
+        # schema adjacency matrices and per-column properties
+        foreign_key_matrix = np.zeros((num_columns, num_columns), dtype=bool)
+        for column_id, other_column_id in sql_schema.foreign_keys.items():
+            foreign_key_matrix[
+                column_index[column_id], column_index[other_column_id]
+            ] = True
+        foreign_key_tables_matrix = np.zeros((num_tables, num_tables), dtype=bool)
+        for table_id, other_table_ids in sql_schema.foreign_keys_tables.items():
+            for other_table_id in other_table_ids:
+                foreign_key_tables_matrix[
+                    table_index[table_id], table_index[other_table_id]
+                ] = True
+        # -1 for columns without a table, -2 for columns unknown to the schema
+        column_table_indices = np.full((num_columns,), -2, dtype=np.int64)
+        column_foreign_key_same_table = np.zeros((num_columns,), dtype=bool)
+        column_primary_key = np.zeros((num_columns,), dtype=bool)
+        primary_keys = set(sql_schema.primary_keys)
+        for column_id, i in column_index.items():
+            if column_id in sql_schema.column_to_table:
+                column_table_indices[i] = table_index[
+                    sql_schema.column_to_table[column_id]
+                ]
+            column_primary_key[i] = column_id in primary_keys
+        for column_id, other_column_id in sql_schema.foreign_keys.items():
+            column_foreign_key_same_table[column_index[column_id]] = (
+                column_id in sql_schema.column_to_table
+                and other_column_id in sql_schema.column_to_table
+                and sql_schema.column_to_table[column_id]
+                == sql_schema.column_to_table[other_column_id]
+            )
+
+        column_positions = np.array(
+            [token.position for token in self.source_column_tokens], dtype=np.int64
+        )
+        column_indices = np.array(
+            [column_index[column_id] for column_id in column_keys], dtype=np.int64
+        )
+        table_positions = np.array(
+            [token.position for token in self.source_table_tokens], dtype=np.int64
+        )
+        table_indices = np.array(
+            [table_index[table_id] for table_id in table_keys], dtype=np.int64
+        )
+
+        ct_relation_ids, tc_relation_ids = self._ct_relation_ids(
+            column_indices=column_indices,
+            table_indices=table_indices,
+            column_table_indices=column_table_indices,
+            column_foreign_key_same_table=column_foreign_key_same_table,
+            column_without_table=column_table_indices == -2,
+            column_primary_key=column_primary_key,
+        )
+        schema_relation_ids = np.block(
+            [
+                [
+                    self._cc_relation_ids(
+                        column_positions=column_positions,
+                        column_indices=column_indices,
+                        foreign_key_matrix=foreign_key_matrix,
+                        column_table_indices=column_table_indices,
+                    ),
+                    ct_relation_ids,
+                ],
+                [
+                    tc_relation_ids,
+                    self._tt_relation_ids(
+                        table_positions=table_positions,
+                        table_indices=table_indices,
+                        foreign_key_tables_matrix=foreign_key_tables_matrix,
+                    ),
+                ],
+            ]
+        ).astype(np.int64)
+        schema_relation_ids.flags.writeable = False
+
+        _schema_relation_ids_cache[cache_key] = schema_relation_ids
+        if len(_schema_relation_ids_cache) > SCHEMA_RELATIONS_CACHE_SIZE:
+            _schema_relation_ids_cache.popitem(last=False)
+        return schema_relation_ids
+
     def build(self, device: torch.device) -> torch.Tensor:
-        return self.sparse_2d_tensor_builder.build(device=device)
+        """Compute all the source relations at once from per-token arrays of positions
+        and schema indices and from adjacency matrices of the schema."""
+        column_index: Dict[ColumnId, int] = {}
+        for token in self.source_column_tokens:
+            column_index.setdefault(token.key, len(column_index))
+        table_index: Dict[TableId, int] = {}
+        for token in self.source_table_tokens:
+            table_index.setdefault(token.key, len(table_index))
+
+        question_positions = np.array(
+            [token.position for token in self.source_question_tokens], dtype=np.int64
+        )
+        column_indices = np.array(
+            [column_index[token.key] for token in self.source_column_tokens],
+            dtype=np.int64,
+        )
+        table_indices = np.array(
+            [table_index[token.key] for token in self.source_table_tokens],
+            dtype=np.int64,
+        )
+        schema_positions = np.array(
+            [
+                token.position
+                for token in itertools.chain(
+                    self.source_column_tokens, self.source_table_tokens
+                )
+            ],
+            dtype=np.int64,
+        )
+        column_positions = schema_positions[: len(self.source_column_tokens)]
+        table_positions = schema_positions[len(self.source_column_tokens) :]
+
+        qc_relation_ids, cq_relation_ids = self._q_schema_relation_ids(
+            schema_indices=column_indices,
+            num_schema_indices=len(column_index),
+            get_match_schema_index=lambda match_tag: column_index.get(
+                match_tag.column_id
+            )
+            if isinstance(match_tag, (ColumnMatchTag, ValueMatchTag))
+            else None,
+            match_relation=QCMatchRelation,
+            reverse_match_relation=CQMatchRelation,
+            default_relation=QCDefaultRelation(),
+            reverse_default_relation=CQDefaultRelation(),
+            kind="q-c",
+        )
+        qt_relation_ids, tq_relation_ids = self._q_schema_relation_ids(
+            schema_indices=table_indices,
+            num_schema_indices=len(table_index),
+            get_match_schema_index=lambda match_tag: table_index.get(
+                match_tag.table_id
+            )
+            if isinstance(match_tag, TableMatchTag)
+            else None,
+            match_relation=QTMatchRelation,
+            reverse_match_relation=TQMatchRelation,
+            default_relation=QTDefaultRelation(),
+            reverse_default_relation=TQDefaultRelation(),
+            kind="q-t",
+        )
+
+        size = 1 + self.source_token_max_position
+        relation_ids = np.zeros((size, size), dtype=np.int64)
+        relation_ids[np.ix_(question_positions, question_positions)] = (
+            self._qq_relation_ids(question_positions=question_positions)
+        )
+        relation_ids[
+            np.ix_(schema_positions, schema_positions)
+        ] = self._schema_relation_ids()
+        relation_ids[np.ix_(question_positions, column_positions)] = qc_relation_ids
+        relation_ids[np.ix_(column_positions, question_positions)] = cq_relation_ids
+        relation_ids[np.ix_(question_positions, table_positions)] = qt_relation_ids
+        relation_ids[np.ix_(table_positions, question_positions)] = tq_relation_ids
+        return torch.as_tensor(relation_ids, device=device)
 
 
 def mask_source_relation_tensor(
@@ -905,16 +911,8 @@ class MemoryRelationsBuilder(object):
     )
 
     def __deepcopy__(self, memo) -> "MemoryRelationsBuilder":
+        # The position maps are not modified after __post_init__ and can be shared
         builder = copy(self)
-        builder.question_position_map = defaultdict(deque)
-        for s, positions in self.question_position_map.items():
-            builder.question_position_map[s] = copy(positions)
-        builder.columns_position_map = defaultdict(deque)
-        for s, positions in self.columns_position_map.items():
-            builder.columns_position_map[s] = copy(positions)
-        builder.tables_position_map = defaultdict(deque)
-        for s, positions in self.tables_position_map.items():
-            builder.tables_position_map[s] = copy(positions)
         builder.sparse_2d_tensor_builder = deepcopy(self.sparse_2d_tensor_builder)
         return builder
 
@@ -1016,16 +1014,14 @@ def mask_memory_relation_tensor(
 @dataclass
 class TargetRelationsBuilder(object):
     relation_types: FrozenDict[TargetRelation, int]
-    parents: Dict[Pos, Deque[Token[KT, ActionInfo]]] = field(default_factory=dict)
+    parents: Dict[Pos, Tuple[Token[KT, ActionInfo], ...]] = field(default_factory=dict)
     sparse_2d_tensor_builder: Sparse2DTensorBuilder = field(
         default_factory=lambda: Sparse2DTensorBuilder()
     )
 
     def __deepcopy__(self, memo) -> "TargetRelationsBuilder":
         builder = copy(self)
-        builder.parents = dict(
-            (pos, copy(tokens)) for pos, tokens in self.parents.items()
-        )
+        builder.parents = dict(self.parents)
         builder.sparse_2d_tensor_builder = deepcopy(self.sparse_2d_tensor_builder)
         return builder
 
@@ -1060,10 +1056,9 @@ class TargetRelationsBuilder(object):
             for relation in self.relation_types.keys()
         ):
             if token.value.parent_pos is not None:
-                sibling_tokens: Deque[Token[KT, ActionInfo]] = self.parents.get(
-                    token.value.parent_pos, deque()
-                )
-                sibling_tokens.append(token)
+                sibling_tokens: Tuple[Token[KT, ActionInfo], ...] = self.parents.get(
+                    token.value.parent_pos, tuple()
+                ) + (token,)
 
                 token_sib_idx = sibling_tokens.index(token)
 
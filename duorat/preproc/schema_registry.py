@@ -0,0 +1,164 @@
+"""SQL schemas interned by content.
+
+Items of all sections and languages share the schemas of a registry, and the columnar
+sections refer to the schemas by their content hash rather than storing copies of them.
+The save paths of all the languages share a registry, by default in their parent
+directory, so that sections can be gathered into another save path, e.g. for
+multilingual training.
+
+A registry records the sections that were saved with it, and keeps the schemas that
+these sections, or the sections in the save paths under it, still refer to.
+"""
+
+import dataclasses
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import pickle
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Set, Tuple
+
+from duorat.types import SQLSchema
+
+SCHEMAS_FILE = "schemas.pkl"
+SECTIONS_FILE = "sections.pkl"
+LOCK_FILE = "schemas.lock"
+# the file in which a section lists the ids of the schemas it refers to
+SCHEMA_IDS_FILE = "schema_ids.pkl"
+
+
+def _canonical(value: Any) -> Any:
+    if isinstance(value, Mapping):
+        return [[_canonical(key), _canonical(item)] for key, item in value.items()]
+    if isinstance(value, (tuple, list)):
+        return [_canonical(item) for item in value]
+    return value
+
+
+def schema_content_key(sql_schema: SQLSchema) -> str:
+    """Hash of the content of a schema, which, unlike the one of its pickle, does not
+    depend on which of its strings are the same objects."""
+    fields = [
+        [field.name, _canonical(getattr(sql_schema, field.name))]
+        for field in dataclasses.fields(sql_schema)
+    ]
+    return hashlib.sha1(json.dumps(fields, ensure_ascii=False).encode()).hexdigest()
+
+
+def section_schema_ids(path: str) -> List[str]:
+    """The ids of the schemas that the items of a section refer to."""
+    with open(os.path.join(path, SCHEMA_IDS_FILE), "rb") as f:
+        return pickle.load(f)
+
+
+class SQLSchemaRegistry(object):
+    def __init__(self, path: str) -> None:
+        # the directory of the schemas file
+        self.path = path
+        self._schemas: Dict[str, SQLSchema] = {}
+        # ids of the schemas seen so far, by object identity. The schemas are kept
+        # alive so that their identities are not reused.
+        self._schema_ids: Dict[int, Tuple[SQLSchema, str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._schemas)
+
+    def schema_id(self, sql_schema: SQLSchema) -> str:
+        """The content hash of a schema, which is interned if it is not yet."""
+        if id(sql_schema) in self._schema_ids:
+            return self._schema_ids[id(sql_schema)][1]
+        schema_id = schema_content_key(sql_schema)
+        self._schemas.setdefault(schema_id, sql_schema)
+        self._schema_ids[id(sql_schema)] = (sql_schema, schema_id)
+        return schema_id
+
+    def intern(self, sql_schema: SQLSchema) -> SQLSchema:
+        """The registered schema with the same content."""
+        return self._schemas[self.schema_id(sql_schema)]
+
+    def __getitem__(self, schema_id: str) -> SQLSchema:
+        if schema_id not in self._schemas:
+            self.load()
+        if schema_id not in self._schemas:
+            raise KeyError(
+                "Schema {} is not in the registry {}".format(schema_id, self.path)
+            )
+        return self._schemas[schema_id]
+
+    def load(self) -> None:
+        schemas_path = os.path.join(self.path, SCHEMAS_FILE)
+        if not os.path.exists(schemas_path):
+            return
+        with open(schemas_path, "rb") as f:
+            schemas: Dict[str, SQLSchema] = pickle.load(f)
+        for schema_id, sql_schema in schemas.items():
+            if schema_id not in self._schemas:
+                self._schemas[schema_id] = sql_schema
+                self._schema_ids[id(sql_schema)] = (sql_schema, schema_id)
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        # processes that save to the same registry, e.g. for other languages, do so
+        # one after the other
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, LOCK_FILE), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_sections(self) -> Set[str]:
+        sections_path = os.path.join(self.path, SECTIONS_FILE)
+        if not os.path.exists(sections_path):
+            return set()
+        with open(sections_path, "rb") as f:
+            return pickle.load(f)
+
+    def _dump(self, file_name: str, value: Any) -> None:
+        path = os.path.join(self.path, file_name)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(value, f)
+        os.replace(path + ".tmp", path)
+
+    def save(self, sections: Iterable[str] = ()) -> None:
+        """Writes the schemas, together with those that were saved earlier, e.g. with
+        other sections or languages, and records `sections`, the paths of the sections
+        that were saved with them. Only the schemas that the recorded sections that
+        still exist, or the sections in the save paths under the registry, refer to
+        are kept, so that e.g. the schema shuffles of earlier runs are dropped."""
+        with self._locked():
+            self.load()
+            recorded_sections = self._load_sections() | {
+                os.path.abspath(section) for section in sections
+            }
+            found_sections = {
+                os.path.abspath(os.path.dirname(schema_ids_path))
+                for pattern in ("*", os.path.join("*", "*"))
+                for schema_ids_path in glob.glob(
+                    os.path.join(self.path, pattern, SCHEMA_IDS_FILE)
+                )
+            }
+            recorded_sections = {
+                section
+                for section in recorded_sections
+                if os.path.exists(os.path.join(section, SCHEMA_IDS_FILE))
+            }
+            keep: Set[str] = set()
+            for section in recorded_sections | found_sections:
+                keep.update(section_schema_ids(section))
+            self._dump(
+                SCHEMAS_FILE,
+                {
+                    schema_id: sql_schema
+                    for schema_id, sql_schema in self._schemas.items()
+                    if schema_id in keep
+                },
+            )
+            self._dump(SECTIONS_FILE, recorded_sections)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # the schemas are reloaded rather than pickled, e.g. in data loader workers
+        return {"path": self.path, "_schemas": {}, "_schema_ids": {}}
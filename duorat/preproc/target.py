@@ -1,13 +1,17 @@
+import os
+import pickle
 from copy import deepcopy, copy
 from dataclasses import dataclass, field
-from typing import Iterator, Optional, Sequence, Iterable
+from typing import Iterator, Optional, Sequence, Iterable, Dict, Tuple, Type
 
+import numpy as np
 import torch
 from torchtext.vocab import Vocab
 
 from duorat.asdl.action_info import ActionInfo
-from duorat.asdl.asdl import ASDLGrammar, ASDLPrimitiveType
+from duorat.asdl.asdl import ASDLGrammar, ASDLPrimitiveType, ASDLType, Field
 from duorat.asdl.transition_system import (
+    Action,
     ReduceAction,
     GenTokenAction,
     TransitionSystem,
@@ -22,13 +26,145 @@ from duorat.types import (
     Sparse2DMaskTensorBuilder,
     TableToken,
 )
+from duorat.utils.item_store import item_key
+
+
+ValidActionsMaskKey = Tuple[Optional[ASDLType], Optional[str], Type, bool]
 
 
 @dataclass
-class ValidActionsMaskBuilder(object):
-    question_tokens: Sequence[Token[KT, str]]
+class ValidActionsMaskTable(object):
+    """Lookup table of the boolean masks of the valid actions over the target vocabulary.
+
+    A mask is keyed by the type and the cardinality of the frontier field, the class of
+    the previous action, and whether UNK is allowed. This assumes that
+    `TransitionSystem.valid_action_predicate` depends on the previous action only
+    through its class, which is the case for the Spider transition system.
+    Missing masks are computed on first use.
+    """
+
     target_vocab: Vocab
     transition_system: TransitionSystem
+    masks: Dict[ValidActionsMaskKey, torch.Tensor] = field(default_factory=dict)
+    indices: Dict[ValidActionsMaskKey, np.ndarray] = field(
+        default_factory=dict, repr=False
+    )
+
+    @staticmethod
+    def get_key(
+        previous_action: Optional[Action],
+        frontier_field: Optional[Field],
+        allow_unk: bool,
+    ) -> ValidActionsMaskKey:
+        return (
+            frontier_field.type if frontier_field is not None else None,
+            frontier_field.cardinality if frontier_field is not None else None,
+            type(previous_action),
+            allow_unk,
+        )
+
+    def _compute_mask(
+        self,
+        previous_action: Optional[Action],
+        frontier_field: Optional[Field],
+        allow_unk: bool,
+    ) -> torch.Tensor:
+        return torch.tensor(
+            [
+                self.transition_system.valid_action_predicate(
+                    action=action,
+                    previous_action=previous_action,
+                    frontier_field=frontier_field,
+                    allow_unk=allow_unk,
+                )
+                for action in self.target_vocab.itos
+            ],
+            dtype=torch.bool,
+        )
+
+    def get_mask(
+        self,
+        previous_action: Optional[Action],
+        frontier_field: Optional[Field],
+        allow_unk: bool,
+    ) -> torch.Tensor:
+        key = self.get_key(
+            previous_action=previous_action,
+            frontier_field=frontier_field,
+            allow_unk=allow_unk,
+        )
+        mask = self.masks.get(key)
+        if mask is None:
+            mask = self._compute_mask(
+                previous_action=previous_action,
+                frontier_field=frontier_field,
+                allow_unk=allow_unk,
+            )
+            self.masks[key] = mask
+        return mask
+
+    def get_indices(
+        self,
+        previous_action: Optional[Action],
+        frontier_field: Optional[Field],
+        allow_unk: bool,
+    ) -> np.ndarray:
+        key = self.get_key(
+            previous_action=previous_action,
+            frontier_field=frontier_field,
+            allow_unk=allow_unk,
+        )
+        indices = self.indices.get(key)
+        if indices is None:
+            mask = self.get_mask(
+                previous_action=previous_action,
+                frontier_field=frontier_field,
+                allow_unk=allow_unk,
+            )
+            indices = mask.nonzero(as_tuple=True)[0].numpy()
+            self.indices[key] = indices
+        return indices
+
+    def precompute(self, grammar: ASDLGrammar) -> "ValidActionsMaskTable":
+        """Fill the table for all the fields of the grammar and for one previous
+        action of every action class in the target vocabulary."""
+        previous_actions: Dict[Type, Optional[Action]] = {type(None): None}
+        for action in self.target_vocab.itos:
+            previous_actions.setdefault(type(action), action)
+        frontier_fields: Dict[Tuple[ASDLType, str], Optional[Field]] = {}
+        for frontier_field in grammar.fields:
+            frontier_fields.setdefault(
+                (frontier_field.type, frontier_field.cardinality), frontier_field
+            )
+        for frontier_field in (None, *frontier_fields.values()):
+            for previous_action in previous_actions.values():
+                for allow_unk in (False, True):
+                    self.get_mask(
+                        previous_action=previous_action,
+                        frontier_field=frontier_field,
+                        allow_unk=allow_unk,
+                    )
+        return self
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as f:
+            pickle.dump((item_key(self.target_vocab.itos), self.masks), f)
+
+    def load(self, path: str) -> "ValidActionsMaskTable":
+        """Load the masks saved at path, unless they were built for another target
+        vocabulary, in which case they are left to be recomputed."""
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                target_vocab_key, masks = pickle.load(f)
+            if target_vocab_key == item_key(self.target_vocab.itos):
+                self.masks.update(masks)
+        return self
+
+
+@dataclass
+class ValidActionsMaskBuilder(object):
+    question_tokens: Sequence[Token[KT, str]]
+    valid_actions_mask_table: ValidActionsMaskTable
     allow_unk: bool
     previous_action_info: Optional[ActionInfo] = None
     sparse_2d_mask_tensor_builder: Sparse2DMaskTensorBuilder = field(
@@ -54,28 +190,23 @@ class ValidActionsMaskBuilder(object):
             token.value for token in builder.question_tokens
         ]
 
-        for _index in map(
-            lambda action_index: (token.position, action_index[1]),
-            filter(
-                lambda action_index: self.transition_system.valid_action_predicate(
-                    action=action_index[0],
-                    previous_action=(
-                        builder.previous_action_info.action
-                        if builder.previous_action_info
-                        else None
-                    ),
-                    frontier_field=token.value.frontier_field,
-                    allow_unk=(
-                        False if can_be_copied else builder.allow_unk
-                    ),  # UNK not allowed if the target can be copied from the question
+        builder.sparse_2d_mask_tensor_builder.append_row(
+            index_0=token.position,
+            index_1=builder.valid_actions_mask_table.get_indices(
+                previous_action=(
+                    builder.previous_action_info.action
+                    if builder.previous_action_info
+                    else None
                 ),
-                builder.target_vocab.stoi.items(),
+                frontier_field=token.value.frontier_field,
+                allow_unk=(
+                    False if can_be_copied else builder.allow_unk
+                ),  # UNK not allowed if the target can be copied from the question
+            ),
+            size=(
+                1 + token.position,
+                len(builder.valid_actions_mask_table.target_vocab),
             ),
-        ):
-            builder.sparse_2d_mask_tensor_builder.append(index=_index)
-
-        builder.sparse_2d_mask_tensor_builder.resize(
-            size=(1 + token.position, len(builder.target_vocab))
         )
 
         builder.previous_action_info = token.value
@@ -1,5 +1,5 @@
 import itertools
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from copy import deepcopy, copy
 from dataclasses import dataclass, field
 from typing import (
@@ -12,6 +12,7 @@ from typing import (
     Tuple,
 )
 
+import numpy as np
 import torch
 
 from duorat.asdl.transition_system import Action, Pos
@@ -29,7 +30,7 @@ from duorat.types import (
     ForwardAttention,
     Sparse1DTensorBuilder,
     Sparse1DMaskTensorBuilder,
-    Sparse2DMaskTensorBuilder,
+    PrefixSharingList,
     PreprocQuestionToken,
     TableId,
     ColumnId,
@@ -406,6 +407,25 @@ Thus, if it were to be used in a transformer model, it would need to be inverted
         return self.sparse_1d_mask_tensor_builder.build(device=device)
 
 
+# Maximum number of scope layouts for which the scope connectivity is kept around
+SCOPE_LAYOUT_CACHE_SIZE = 1024
+_scope_layout_cache: "OrderedDict[tuple, Tuple[np.ndarray, ...]]" = OrderedDict()
+
+
+def flatten_scope_positions(
+    scope_positions: Dict[AttentionScope, PrefixSharingList[Pos]]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Flatten the positions grouped by scope into arrays of positions and scope ids."""
+    positions = np.fromiter(
+        itertools.chain.from_iterable(scope_positions.values()), dtype=np.int64
+    )
+    scope_ids = np.repeat(
+        np.arange(len(scope_positions)),
+        [len(scope_positions_) for scope_positions_ in scope_positions.values()],
+    )
+    return positions, scope_ids
+
+
 @dataclass
 class AttentionMaskBuilder(object):
     r"""
@@ -415,22 +435,16 @@ Thus, if it were to be used in a transformer model where attention masks are add
 be mapped to `0` and `False` would need to be mapped to `float("-inf")`.
 """
     scoping: Scoping
-    scope_positions: Dict[AttentionScope, Set[Pos]] = field(init=False)
-    sparse_2d_mask_tensor_builder: Sparse2DMaskTensorBuilder = field(
-        default_factory=lambda: Sparse2DMaskTensorBuilder()
-    )
+    scope_positions: Dict[AttentionScope, PrefixSharingList[Pos]] = field(init=False)
 
     def __post_init__(self):
-        self.scope_positions = defaultdict(set)
+        self.scope_positions = defaultdict(PrefixSharingList)
 
     def __deepcopy__(self, memo) -> "AttentionMaskBuilder":
         builder = copy(self)
-        builder.scope_positions = defaultdict(set)
+        builder.scope_positions = defaultdict(PrefixSharingList)
         for scope, tokens in self.scope_positions.items():
             builder.scope_positions[scope] = copy(tokens)
-        builder.sparse_2d_mask_tensor_builder = deepcopy(
-            self.sparse_2d_mask_tensor_builder
-        )
         return builder
 
     def _get_scopes_by_name(
@@ -581,82 +595,44 @@ be mapped to `0` and `False` would need to be mapped to `float("-inf")`.
         else:
             raise NotImplementedError
 
-    @staticmethod
-    def _constrain_attention(
-        attention_kind: AttentionKind,
-        attend_from_to: Generator[Tuple[Pos, Pos], None, None],
-    ) -> Generator[Tuple[Pos, Pos], None, None]:
-        if attention_kind == BidirectionalAttention():
-            return attend_from_to
-        elif attention_kind == BackwardAttention():
-            return (
-                (from_pos, to_pos)
-                for (from_pos, to_pos) in attend_from_to
-                if from_pos >= to_pos
-            )
-        elif attention_kind == ForwardAttention():
-            return (
-                (from_pos, to_pos)
-                for (from_pos, to_pos) in attend_from_to
-                if from_pos <= to_pos
-            )
-        else:
-            raise ValueError("Unexpected attention kind: {}".format(attention_kind))
-
-    @classmethod
-    def _make_mask(
-        cls,
-        attention_kind: AttentionKind,
-        attend_from: Iterable[Pos],
-        attend_to: Iterable[Pos],
-    ) -> Generator[Tuple[Pos, Pos], None, None]:
-        attend_from_to = (
-            (from_pos, to_pos) for from_pos in attend_from for to_pos in attend_to
-        )
-        return cls._constrain_attention(
-            attention_kind=attention_kind, attend_from_to=attend_from_to
-        )
+    def _scope_layout(
+        self, scopes: Tuple[AttentionScope, ...]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Which scopes see which other scopes, and whether the positions of a scope see
+        the positions before and after them. The layout only depends on the scoping
+        and on the scopes, and is cached."""
+        cache_key = (self.scoping, scopes)
+        scope_layout = _scope_layout_cache.get(cache_key)
+        if scope_layout is not None:
+            _scope_layout_cache.move_to_end(cache_key)
+            return scope_layout
+        connectivity = np.zeros((len(scopes), len(scopes)), dtype=bool)
+        sees_before = np.zeros((len(scopes),), dtype=bool)
+        sees_after = np.zeros((len(scopes),), dtype=bool)
+        for i, scope in enumerate(scopes):
+            scope_connections = self._scope_connections(scope=scope)
+            for j, that_scope in enumerate(scopes):
+                connectivity[i, j] = that_scope in scope_connections
+            attention_kind = self._scope_attention_kind(scope=scope)
+            if attention_kind == BidirectionalAttention():
+                sees_before[i], sees_after[i] = True, True
+            elif attention_kind == BackwardAttention():
+                sees_before[i], sees_after[i] = True, False
+            elif attention_kind == ForwardAttention():
+                sees_before[i], sees_after[i] = False, True
+            else:
+                raise ValueError("Unexpected attention kind: {}".format(attention_kind))
+        scope_layout = connectivity, sees_before, sees_after
+        _scope_layout_cache[cache_key] = scope_layout
+        if len(_scope_layout_cache) > SCOPE_LAYOUT_CACHE_SIZE:
+            _scope_layout_cache.popitem(last=False)
+        return scope_layout
 
     def add_token(
         self, token: Token[KT, VT], copy: bool = False
     ) -> "AttentionMaskBuilder":
         builder = deepcopy(self) if copy is True else self
-        builder.scope_positions[token.scope].add(token.position)
-        this_scope = token.scope
-        attend_self: Set[Pos] = {token.position}
-        mask: Set[Tuple[Pos, Pos]] = set().union(
-            *(
-                builder._make_mask(
-                    attention_kind=builder._scope_attention_kind(scope=this_scope),
-                    attend_from=attend_self,
-                    attend_to=set().union(
-                        *(
-                            builder.scope_positions[that_scope]
-                            for that_scope in builder._scope_connections(
-                                scope=this_scope
-                            )
-                        )
-                    ),
-                ),
-                set().union(
-                    *(
-                        builder._make_mask(
-                            attention_kind=builder._scope_attention_kind(
-                                scope=that_scope
-                            ),
-                            attend_from=builder.scope_positions[that_scope],
-                            attend_to=attend_self,
-                        )
-                        for that_scope in builder.scope_positions.keys()
-                        if this_scope in builder._scope_connections(scope=that_scope)
-                    )
-                ),
-            )
-        )
-        for _index in mask:
-            builder.sparse_2d_mask_tensor_builder.append(
-                index=_index, size=(1 + token.position, 1 + token.position)
-            )
+        builder.scope_positions[token.scope].append(token.position)
         return builder
 
     def add_tokens(
@@ -668,4 +644,15 @@ be mapped to `0` and `False` would need to be mapped to `float("-inf")`.
         return builder
 
     def build(self, device: torch.device) -> torch.Tensor:
-        return self.sparse_2d_mask_tensor_builder.build(device=device)
+        scopes = tuple(self.scope_positions.keys())
+        connectivity, sees_before, sees_after = self._scope_layout(scopes=scopes)
+        positions, scope_ids = flatten_scope_positions(self.scope_positions)
+        from_positions, to_positions = positions[:, None], positions[None, :]
+        from_scope_ids = scope_ids[:, None]
+        mask = np.zeros((1 + positions.max(initial=-1),) * 2, dtype=bool)
+        mask[np.ix_(positions, positions)] = connectivity[from_scope_ids, scope_ids] & (
+            (from_positions == to_positions)
+            | (sees_before[from_scope_ids] & (to_positions < from_positions))
+            | (sees_after[from_scope_ids] & (to_positions > from_positions))
+        )
+        return torch.from_numpy(mask).to(device=device)
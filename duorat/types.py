@@ -1,3 +1,5 @@
+import itertools
+import os
 from collections import deque, OrderedDict
 from copy import deepcopy, copy
 from enum import Enum, auto
@@ -5,8 +7,12 @@ from uuid import UUID
 
 from dataclasses import dataclass, field
 from typing import (
+    Any,
     Tuple,
     Mapping,
+    Sequence,
+    Iterable,
+    Iterator,
     Optional,
     Generic,
     TypeVar,
@@ -20,6 +26,7 @@ from typing import (
     ClassVar,
 )
 
+import numpy as np
 import torch
 
 from duorat.asdl.action_info import ActionInfo
@@ -76,6 +83,14 @@ class FrozenDict(Mapping[KT, VT], Generic[KT, VT]):
             self._hash = h
         return self._hash
 
+    def __getstate__(self):
+        # string hashes are salted per process, so the cached hash is not pickled
+        return {"_dict": self._dict}
+
+    def __setstate__(self, state):
+        self._dict = state["_dict"]
+        self._hash = None
+
 
 class OrderedFrozenDict(FrozenDict):
     """Ordered version of FrozenDict"""
@@ -96,6 +111,69 @@ class OrderedFrozenDict(FrozenDict):
 frozendict = FrozenDict
 
 
+class PrefixSharingList(Sequence[T], Generic[T]):
+    """
+    An append-only list whose copies share their common prefix.
+
+    New items go to a tail that is owned by the list. Copying the list freezes that tail
+    into an immutable chunk that points to the chunks before it, and the copy starts with
+    an empty tail of its own. Copying and then extending a list thus costs time and
+    memory proportional to the number of new items, not to the length of the list.
+    The items themselves are never copied and should be immutable.
+    """
+
+    __slots__ = ("_chunks", "_chunks_length", "_tail")
+
+    def __init__(self, items: Iterable[T] = ()):
+        self._chunks: Optional[Tuple[Any, Tuple[T, ...]]] = None
+        self._chunks_length = 0
+        self._tail: List[T] = list(items)
+
+    def _freeze(self) -> None:
+        if self._tail:
+            self._chunks = (self._chunks, tuple(self._tail))
+            self._chunks_length += len(self._tail)
+            self._tail = []
+
+    def __copy__(self) -> "PrefixSharingList[T]":
+        self._freeze()
+        other = self.__class__()
+        other._chunks = self._chunks
+        other._chunks_length = self._chunks_length
+        return other
+
+    def __deepcopy__(self, memo) -> "PrefixSharingList[T]":
+        return self.__copy__()
+
+    def __reduce__(self):
+        return self.__class__, (list(self),)
+
+    def append(self, item: T) -> None:
+        self._tail.append(item)
+
+    def extend(self, items: Iterable[T]) -> None:
+        self._tail.extend(items)
+
+    def __len__(self) -> int:
+        return self._chunks_length + len(self._tail)
+
+    def __iter__(self) -> Iterator[T]:
+        chunks = deque()
+        node = self._chunks
+        while node is not None:
+            node, chunk = node
+            chunks.appendleft(chunk)
+        return itertools.chain(itertools.chain.from_iterable(chunks), self._tail)
+
+    def __getitem__(self, index):
+        if isinstance(index, int) and self._chunks_length <= index < len(self):
+            return self._tail[index - self._chunks_length]
+        return list(self)[index]
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, list(self))
+
+
 QuestionTokenId = NewType("QuestionTokenId", UUID)
 TableId = NewType("TableId", str)
 ColumnId = NewType("ColumnId", str)
@@ -635,10 +713,112 @@ class DuoRATBatch(object):
     decoder_batch: DuoRATDecoderBatch
 
 
+@dataclass
+class DuoRATPreparedMemory(object):
+    memory: torch.Tensor
+    memory_key_values: Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+    pointer_keys: torch.Tensor
+
+
+DEBUG_TENSOR_BUILDERS = os.environ.get("DUORAT_DEBUG_TENSOR_BUILDERS", "0") == "1"
+
+
+class _IndexStorage(object):
+    __slots__ = ("array", "used")
+
+    def __init__(self, array: np.ndarray, used: int):
+        self.array = array
+        self.used = used
+
+
+class IndexBuffer(object):
+    """
+    A growable buffer of integers backed by a preallocated NumPy array.
+
+    Single items are collected in a list and written to the array in bulk. Copies share
+    the array: the copy whose length matches the number of values written to the array
+    keeps writing to it in place, any other copy first moves its prefix to an array of
+    its own. A beam hypothesis and its first continuation thus share their storage.
+    """
+
+    __slots__ = ("_storage", "_length", "_pending")
+
+    def __init__(self, values: Iterable[int] = ()):
+        array = np.asarray(
+            values if isinstance(values, np.ndarray) else list(values), dtype=np.int64
+        )
+        self._storage = _IndexStorage(array=array, used=len(array))
+        self._length = len(array)
+        self._pending: List[int] = []
+
+    def _reserve(self, n: int) -> None:
+        storage = self._storage
+        if storage.used != self._length or self._length + n > len(storage.array):
+            array = np.empty(max(16, 2 * (self._length + n)), dtype=np.int64)
+            array[: self._length] = storage.array[: self._length]
+            self._storage = _IndexStorage(array=array, used=self._length)
+
+    def _write(self, values: np.ndarray) -> None:
+        self._reserve(len(values))
+        self._storage.array[self._length : self._length + len(values)] = values
+        self._length += len(values)
+        self._storage.used = self._length
+
+    def _flush(self) -> None:
+        if self._pending:
+            self._write(np.asarray(self._pending, dtype=np.int64))
+            self._pending = []
+
+    def __copy__(self) -> "IndexBuffer":
+        self._flush()
+        other = self.__class__()
+        other._storage = self._storage
+        other._length = self._length
+        return other
+
+    def __deepcopy__(self, memo) -> "IndexBuffer":
+        return self.__copy__()
+
+    def __reduce__(self):
+        return self.__class__, (self.array.copy(),)
+
+    @property
+    def array(self) -> np.ndarray:
+        """A view of the values. It is not modified by later appends."""
+        self._flush()
+        return self._storage.array[: self._length]
+
+    def append(self, value: int) -> None:
+        self._pending.append(value)
+
+    def extend(self, values: Union["IndexBuffer", np.ndarray, Iterable[int]]) -> None:
+        if isinstance(values, IndexBuffer):
+            values = values.array
+        if isinstance(values, np.ndarray):
+            self._flush()
+            self._write(values)
+        else:
+            self._pending.extend(values)
+
+    def __len__(self) -> int:
+        return self._length + len(self._pending)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.array.tolist())
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.array.tolist())
+
+
+def _check_unique_indices(*indices: np.ndarray) -> None:
+    if DEBUG_TENSOR_BUILDERS:
+        assert len(set(zip(*(index.tolist() for index in indices)))) == len(indices[0])
+
+
 @dataclass
 class Sparse1DTensorBuilder(object):
-    index: Deque[int] = field(default_factory=deque)
-    value: Deque[int] = field(default_factory=deque)
+    index: IndexBuffer = field(default_factory=IndexBuffer)
+    value: IndexBuffer = field(default_factory=IndexBuffer)
     size: int = 0
 
     def __deepcopy__(self, memo) -> "Sparse1DTensorBuilder":
@@ -649,8 +829,8 @@ class Sparse1DTensorBuilder(object):
 
     def empty(self, copy: bool = False) -> "Sparse1DTensorBuilder":
         builder = deepcopy(self) if copy is True else self
-        builder.index = deque()
-        builder.value = deque()
+        builder.index = IndexBuffer()
+        builder.value = IndexBuffer()
         return builder
 
     def resize(self, size: int, copy: bool = False) -> "Sparse1DTensorBuilder":
@@ -679,21 +859,20 @@ class Sparse1DTensorBuilder(object):
         return builder
 
     def build(self, device: torch.device) -> torch.Tensor:
-        assert len(set(self.index)) == len(self.index)
-        return torch.sparse_coo_tensor(
-            torch.tensor((self.index,), dtype=torch.long, device=device),
-            torch.tensor(self.value, dtype=torch.long, device=device),
-            torch.Size((self.size,)),
-            dtype=torch.long,
-            device=device,
-        ).to_dense()
+        index = self.index.array
+        _check_unique_indices(index)
+        tensor = torch.zeros((self.size,), dtype=torch.long, device=device)
+        tensor[torch.as_tensor(index, device=device)] = torch.as_tensor(
+            self.value.array, device=device
+        )
+        return tensor
 
 
 @dataclass
 class Sparse2DTensorBuilder(object):
-    index_0: Deque[int] = field(default_factory=deque)
-    index_1: Deque[int] = field(default_factory=deque)
-    value: Deque[int] = field(default_factory=deque)
+    index_0: IndexBuffer = field(default_factory=IndexBuffer)
+    index_1: IndexBuffer = field(default_factory=IndexBuffer)
+    value: IndexBuffer = field(default_factory=IndexBuffer)
     size_0: int = 0
     size_1: int = 0
 
@@ -706,9 +885,9 @@ class Sparse2DTensorBuilder(object):
 
     def empty(self, copy: bool = False) -> "Sparse2DTensorBuilder":
         builder = deepcopy(self) if copy is True else self
-        builder.index_0 = deque()
-        builder.index_1 = deque()
-        builder.value = deque()
+        builder.index_0 = IndexBuffer()
+        builder.index_1 = IndexBuffer()
+        builder.value = IndexBuffer()
         return builder
 
     def resize(self, size: Tuple[int, int], copy=False) -> "Sparse2DTensorBuilder":
@@ -735,6 +914,27 @@ class Sparse2DTensorBuilder(object):
             builder.size_1 = max(builder.size_1, size[1])
         return builder
 
+    def append_row(
+        self,
+        index_0: int,
+        index_1: np.ndarray,
+        value: np.ndarray,
+        size: Optional[Tuple[int, int]] = None,
+        copy: bool = False,
+    ) -> "Sparse2DTensorBuilder":
+        builder = deepcopy(self) if copy is True else self
+        assert len(index_1) == len(value)
+        builder.index_0.extend(np.full(len(index_1), index_0, dtype=np.int64))
+        builder.index_1.extend(index_1)
+        builder.value.extend(value)
+        builder.size_0 = max(builder.size_0, 1 + index_0)
+        if len(index_1) > 0:
+            builder.size_1 = max(builder.size_1, 1 + int(index_1.max()))
+        if size is not None:
+            builder.size_0 = max(builder.size_0, size[0])
+            builder.size_1 = max(builder.size_1, size[1])
+        return builder
+
     def extend(
         self, other: "Sparse2DTensorBuilder", copy: bool = False
     ) -> "Sparse2DTensorBuilder":
@@ -747,21 +947,21 @@ class Sparse2DTensorBuilder(object):
         return builder
 
     def build(self, device: torch.device) -> torch.Tensor:
-        assert len(set(zip(self.index_0, self.index_1))) == len(
-            list(zip(self.index_0, self.index_1))
+        index_0, index_1 = self.index_0.array, self.index_1.array
+        _check_unique_indices(index_0, index_1)
+        tensor = torch.zeros(
+            (self.size_0, self.size_1), dtype=torch.long, device=device
         )
-        return torch.sparse_coo_tensor(
-            torch.tensor((self.index_0, self.index_1), dtype=torch.long, device=device),
-            torch.tensor(self.value, dtype=torch.long, device=device),
-            torch.Size((self.size_0, self.size_1)),
-            dtype=torch.long,
-            device=device,
-        ).to_dense()
+        tensor[
+            torch.as_tensor(index_0, device=device),
+            torch.as_tensor(index_1, device=device),
+        ] = torch.as_tensor(self.value.array, device=device)
+        return tensor
 
 
 @dataclass
 class Sparse1DMaskTensorBuilder(object):
-    index: Deque[int] = field(default_factory=deque)
+    index: IndexBuffer = field(default_factory=IndexBuffer)
     size: int = 0
 
     def __deepcopy__(self, memo) -> "Sparse1DMaskTensorBuilder":
@@ -771,7 +971,7 @@ class Sparse1DMaskTensorBuilder(object):
 
     def empty(self, copy: bool = False) -> "Sparse1DMaskTensorBuilder":
         builder = deepcopy(self) if copy is True else self
-        builder.index = deque()
+        builder.index = IndexBuffer()
         return builder
 
     def resize(self, size: int, copy: bool = False) -> "Sparse1DMaskTensorBuilder":
@@ -798,28 +998,17 @@ class Sparse1DMaskTensorBuilder(object):
         return builder
 
     def build(self, device: torch.device) -> torch.Tensor:
-        assert len(set(self.index)) == len(self.index)
-        return (
-            torch.sparse_coo_tensor(
-                torch.tensor((self.index,), dtype=torch.long, device=device),
-                torch.ones(
-                    size=torch.Size((len(self.index),)),
-                    dtype=torch.long,
-                    device=device,
-                ),
-                torch.Size((self.size,)),
-                dtype=torch.long,
-                device=device,
-            )
-            .to_dense()
-            .bool()
-        )
+        index = self.index.array
+        _check_unique_indices(index)
+        tensor = torch.zeros((self.size,), dtype=torch.bool, device=device)
+        tensor[torch.as_tensor(index, device=device)] = True
+        return tensor
 
 
 @dataclass
 class Sparse2DMaskTensorBuilder(object):
-    index_0: Deque[int] = field(default_factory=deque)
-    index_1: Deque[int] = field(default_factory=deque)
+    index_0: IndexBuffer = field(default_factory=IndexBuffer)
+    index_1: IndexBuffer = field(default_factory=IndexBuffer)
     size_0: int = 0
     size_1: int = 0
 
@@ -831,8 +1020,8 @@ class Sparse2DMaskTensorBuilder(object):
 
     def empty(self, copy: bool = False) -> "Sparse2DMaskTensorBuilder":
         builder = deepcopy(self) if copy is True else self
-        builder.index_0 = deque()
-        builder.index_1 = deque()
+        builder.index_0 = IndexBuffer()
+        builder.index_1 = IndexBuffer()
         return builder
 
     def resize(
@@ -859,6 +1048,24 @@ class Sparse2DMaskTensorBuilder(object):
             builder.size_1 = max(builder.size_1, size[1])
         return builder
 
+    def append_row(
+        self,
+        index_0: int,
+        index_1: np.ndarray,
+        size: Optional[Tuple[int, int]] = None,
+        copy: bool = False,
+    ) -> "Sparse2DMaskTensorBuilder":
+        builder = deepcopy(self) if copy is True else self
+        builder.index_0.extend(np.full(len(index_1), index_0, dtype=np.int64))
+        builder.index_1.extend(index_1)
+        builder.size_0 = max(builder.size_0, 1 + index_0)
+        if len(index_1) > 0:
+            builder.size_1 = max(builder.size_1, 1 + int(index_1.max()))
+        if size is not None:
+            builder.size_0 = max(builder.size_0, size[0])
+            builder.size_1 = max(builder.size_1, size[1])
+        return builder
+
     def extend(
         self, other: "Sparse2DMaskTensorBuilder", copy: bool = False
     ) -> "Sparse2DMaskTensorBuilder":
@@ -870,23 +1077,13 @@ class Sparse2DMaskTensorBuilder(object):
         return builder
 
     def build(self, device: torch.device) -> torch.Tensor:
-        assert len(set(zip(self.index_0, self.index_1))) == len(
-            list(zip(self.index_0, self.index_1))
-        )
-        return (
-            torch.sparse_coo_tensor(
-                torch.tensor(
-                    (self.index_0, self.index_1), dtype=torch.long, device=device
-                ),
-                torch.ones(
-                    size=torch.Size((len(self.index_0),)),
-                    dtype=torch.long,
-                    device=device,
-                ),
-                torch.Size((self.size_0, self.size_1)),
-                dtype=torch.long,
-                device=device,
-            )
-            .to_dense()
-            .bool()
+        index_0, index_1 = self.index_0.array, self.index_1.array
+        _check_unique_indices(index_0, index_1)
+        tensor = torch.zeros(
+            (self.size_0, self.size_1), dtype=torch.bool, device=device
         )
+        tensor[
+            torch.as_tensor(index_0, device=device),
+            torch.as_tensor(index_1, device=device),
+        ] = True
+        return tensor
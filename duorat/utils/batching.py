@@ -0,0 +1,130 @@
+import random
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from torch.utils.data import ConcatDataset, Sampler
+
+from duorat.preproc.columnar import ColumnarItems
+from duorat.types import RATPreprocItem, SQLSchema
+from duorat.utils import registry
+
+
+def schema_length(sql_schema: SQLSchema) -> int:
+    """Number of tokens in the column and table names."""
+    return sum(
+        len(tokens) for tokens in sql_schema.tokenized_column_names.values()
+    ) + sum(len(tokens) for tokens in sql_schema.tokenized_table_names.values())
+
+
+def item_lengths(
+    data: Sequence[RATPreprocItem],
+) -> Iterator[Tuple[int, SQLSchema, int]]:
+    """The question length, the schema and the number of actions of every item.
+    Columnar items, also in concatenations, are not rebuilt for that."""
+    if isinstance(data, ConcatDataset):
+        for dataset in data.datasets:
+            yield from item_lengths(dataset)
+    elif isinstance(data, ColumnarItems):
+        yield from data.item_lengths()
+    else:
+        for preproc_item in data:
+            yield len(preproc_item.question), preproc_item.sql_schema, len(
+                preproc_item.actions
+            )
+
+
+@registry.register("batch_sampler", "bucket")
+class BucketBatchSampler(Sampler):
+    """Batches items of similar source lengths and numbers of actions together.
+
+    Every epoch, the items are shuffled and split into buckets of
+    `batch_size * bucket_size_multiplier` items. Each bucket is sorted by source length
+    and number of actions and cut into batches, and the batches of all the buckets are
+    shuffled. Randomness comes from the `random` module, and is thus controlled by the
+    trainer's data random context.
+
+    If `max_tokens_squared` is set, batches have a variable size: a batch is closed
+    before its padded relation tensors, i.e. the batch size times the squared maximum
+    source length plus the squared maximum number of actions, would exceed the budget,
+    or when it has `batch_size` items. In both modes, `drop_last` drops the last batch
+    of every bucket if it was not closed that way.
+    """
+
+    def __init__(
+        self,
+        data: Sequence[RATPreprocItem],
+        batch_size: int,
+        bucket_size_multiplier: int = 50,
+        max_tokens_squared: Optional[int] = None,
+        drop_last: bool = True,
+    ) -> None:
+        super(BucketBatchSampler, self).__init__()
+        # the number of question and schema tokens approximates the source length.
+        # Schemas are kept, so that their ids are not reused.
+        schema_lengths: Dict[int, Tuple[SQLSchema, int]] = {}
+        self.source_lengths, self.num_actions = [], []
+        for question_length, sql_schema, num_actions in item_lengths(data):
+            schema_key = id(sql_schema)
+            if schema_key not in schema_lengths:
+                schema_lengths[schema_key] = (sql_schema, schema_length(sql_schema))
+            self.source_lengths.append(question_length + schema_lengths[schema_key][1])
+            self.num_actions.append(num_actions)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.max_tokens_squared = max_tokens_squared
+        self.drop_last = drop_last
+
+    def _cost(self, batch_size: int, max_source_length: int, max_actions: int) -> int:
+        return batch_size * (max_source_length ** 2 + max_actions ** 2)
+
+    def _bucket_batches(self, bucket: List[int]) -> Iterator[List[int]]:
+        bucket = sorted(
+            bucket, key=lambda i: (self.source_lengths[i], self.num_actions[i])
+        )
+        batch: List[int] = []
+        max_source_length, max_actions = 0, 0
+        for i in bucket:
+            if (
+                len(batch) > 0
+                and self.max_tokens_squared is not None
+                and self._cost(
+                    batch_size=len(batch) + 1,
+                    max_source_length=max(max_source_length, self.source_lengths[i]),
+                    max_actions=max(max_actions, self.num_actions[i]),
+                )
+                > self.max_tokens_squared
+            ):
+                yield batch
+                batch, max_source_length, max_actions = [], 0, 0
+            batch.append(i)
+            max_source_length = max(max_source_length, self.source_lengths[i])
+            max_actions = max(max_actions, self.num_actions[i])
+            if len(batch) == self.batch_size:
+                yield batch
+                batch, max_source_length, max_actions = [], 0, 0
+        if len(batch) > 0 and not self.drop_last:
+            yield batch
+
+    def __iter__(self) -> Iterator[List[int]]:
+        indices = list(range(len(self.source_lengths)))
+        random.shuffle(indices)
+        batches = [
+            batch
+            for start in range(0, len(indices), self.bucket_size)
+            for batch in self._bucket_batches(
+                indices[start : start + self.bucket_size]
+            )
+        ]
+        random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self) -> int:
+        if self.max_tokens_squared is not None:
+            raise TypeError("The number of batches varies from epoch to epoch")
+        num_batches = 0
+        for start in range(0, len(self.source_lengths), self.bucket_size):
+            bucket_size = min(self.bucket_size, len(self.source_lengths) - start)
+            if self.drop_last:
+                num_batches += bucket_size // self.batch_size
+            else:
+                num_batches += -(-bucket_size // self.batch_size)
+        return num_batches
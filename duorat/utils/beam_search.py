@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import List, Callable, Any, Generic, TypeVar
+from typing import List, Callable, Any, Generic, TypeVar, Dict, Sequence
 
 from duorat.asdl.asdl_ast import AbstractSyntaxTree
 
@@ -44,28 +44,69 @@ def beam_search(
     get_new_hypothesis: get new hypothesis from candidate
     get_continuations: get list of possible continuations (candidates) from hypothesis
     """
-    beam: List[Hypothesis] = [initial_hypothesis]
-    finished = []
+    (finished,) = batched_beam_search(
+        [initial_hypothesis],
+        beam_size,
+        max_steps,
+        get_new_hypothesis=get_new_hypothesis,
+        get_continuations=lambda beams, step: {
+            beam_id: get_continuations(beam, step) for beam_id, beam in beams.items()
+        },
+    )
+    return finished
+
+
+def batched_beam_search(
+    initial_hypotheses: Sequence[Hypothesis[B]],
+    beam_size: int,
+    max_steps: int,
+    get_new_hypothesis: Callable[[Candidate[T]], Hypothesis[B]],
+    get_continuations: Callable[
+        [Dict[int, List[Hypothesis[B]]], int], Dict[int, List[Candidate[T]]]
+    ],
+) -> List[List[Hypothesis[B]]]:
+    """
+    Run one beam search per initial hypothesis, all in lockstep.
+    initial hypotheses: one per independent search
+    get_new_hypothesis: get new hypothesis from candidate
+    get_continuations: get lists of possible continuations (candidates) from the beams
+        of all active searches at once, keyed by the index of the search.
+        A search is active until it has beam_size finished hypotheses or an empty beam.
+    """
+    beams: Dict[int, List[Hypothesis[B]]] = {
+        beam_id: [initial_hypothesis]
+        for beam_id, initial_hypothesis in enumerate(initial_hypotheses)
+    }
+    finished: List[List[Hypothesis[B]]] = [[] for _ in initial_hypotheses]
     for step in range(max_steps):
-        # Stop if all beams are finished
-        if len(finished) == beam_size:
+        # Stop the searches for which all beams are finished
+        beams = {
+            beam_id: beam
+            for beam_id, beam in beams.items()
+            if len(finished[beam_id]) < beam_size and len(beam) > 0
+        }
+        if not beams:
             break
 
         # Get possible continuations
-        candidates = get_continuations(beam, step)
-
-        # Keep the top K expansions
-        candidates.sort(key=lambda c: c.score, reverse=True)
-        candidates = candidates[: beam_size - len(finished)]
-
-        # Create the new hypotheses from the expansions
-        beam = []
-        for candidate in candidates:
-            new_hyp = get_new_hypothesis(candidate)
-            if new_hyp.is_finished():
-                finished.append(new_hyp)
-            else:
-                beam.append(new_hyp)
-
-    finished.sort(key=lambda h: h.score, reverse=True)
+        candidates = get_continuations(beams, step)
+
+        for beam_id in beams.keys():
+            # Keep the top K expansions
+            beam_candidates = sorted(
+                candidates[beam_id], key=lambda c: c.score, reverse=True
+            )[: beam_size - len(finished[beam_id])]
+
+            # Create the new hypotheses from the expansions
+            beam = []
+            for candidate in beam_candidates:
+                new_hyp = get_new_hypothesis(candidate)
+                if new_hyp.is_finished():
+                    finished[beam_id].append(new_hyp)
+                else:
+                    beam.append(new_hyp)
+            beams[beam_id] = beam
+
+    for beam_finished in finished:
+        beam_finished.sort(key=lambda h: h.score, reverse=True)
     return finished
@@ -1,8 +1,13 @@
+import hashlib
+import logging
 import os
+import pickle
 import re
 import sqlite3
+from collections import OrderedDict, deque
 from enum import Enum, auto
-from typing import Dict, List, Set, Tuple, Iterable
+from urllib.request import pathname2url
+from typing import Dict, List, Optional, Sequence, Tuple, Iterable, Iterator
 
 from dataclasses import dataclass
 
@@ -12,6 +17,8 @@ import nltk
 
 stemmer = PorterStemmer()
 
+logger = logging.getLogger(__name__)
+
 @dataclass(frozen=True)
 class ColumnIdentifier:
     db_id: str
@@ -29,10 +36,400 @@ class EntryType(Enum):
 Entry = Tuple[Tuple[str, ...], EntryType]
 
 stop_words = set(stopwords.words("english")).union({".", "?", ","})
-# map: (span, entry_type) -> {column_that_matches: value}
-_db_index: Dict[Entry, Dict[ColumnIdentifier, str]] = {}
-# set of indexed columns
-_indexed_columns: Set[ColumnIdentifier] = set()
+
+# bump to rebuild the persisted indexes after changes of the index layout
+DB_CONTENT_INDEX_VERSION = 2
+# the scan of a column stops at the first value beyond this many distinct values
+DB_CONTENT_MAX_DISTINCT_VALUES = 50000
+# number of rows that are fetched at once when a column is indexed
+DB_CONTENT_FETCH_SIZE = 1000
+# bound on the total number of whole and partial entries of the indexes in memory
+DB_CONTENT_INDEXES_MAX_ENTRIES = 5000000
+DB_CONTENT_INDEX_SUFFIX = ".content_index.pkl"
+
+# ({whole entry: value}, {word of a partial entry: value})
+ColumnEntries = Tuple[Dict[Tuple[str, ...], str], Dict[str, str]]
+
+
+class DBContentIndex(object):
+    """
+    Index of the content of all the columns of a database.
+    Every row of a column is indexed as a whole entry, and each of its words as a
+    partial entry. When several rows of a column produce the same entry, the last row
+    wins.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        with_stemming: bool,
+        columns: Dict[Tuple[str, str], ColumnEntries],
+    ) -> None:
+        self.db_path = db_path
+        self.with_stemming = with_stemming
+        # map: (table_name, column_name) -> column entries. Names are lower-cased,
+        # since SQLite identifiers are case-insensitive
+        self.columns = columns
+        # map: (by characters, maximum span length) -> automaton of the entries, built
+        # on first use
+        self._automatons: Dict[Tuple[bool, Optional[int]], "DBContentAutomaton"] = {}
+
+    @staticmethod
+    def fingerprint(db_path: str, with_stemming: bool) -> Tuple:
+        stat = os.stat(db_path)
+        return (
+            DB_CONTENT_INDEX_VERSION,
+            os.path.abspath(db_path),
+            stat.st_size,
+            stat.st_mtime_ns,
+            with_stemming,
+        )
+
+    @classmethod
+    def build(cls, db_path: str, with_stemming: bool) -> "DBContentIndex":
+        """Go through the content of all columns and add each row and its words"""
+        columns = {}
+        for table_name, column_name, column_content in get_db_content(db_path):
+            whole_entries: Dict[Tuple[str, ...], str] = {}
+            partial_entries: Dict[str, str] = {}
+            processed_rows: Dict[str, Tuple[str, ...]] = {}
+            for row in column_content:
+                if row not in processed_rows:
+                    if len(processed_rows) == DB_CONTENT_MAX_DISTINCT_VALUES:
+                        break
+                    processed_rows[row] = pre_process_words(
+                        words=row.lower().split(), with_stemming=with_stemming
+                    )
+                processed_row = processed_rows[row]
+                whole_entries[processed_row] = row
+                # TODO: also add sub-spans of length >1 ?
+                for word in processed_row:
+                    partial_entries[word] = row
+            columns[(table_name.lower(), column_name.lower())] = (
+                whole_entries,
+                partial_entries,
+            )
+        return cls(db_path=db_path, with_stemming=with_stemming, columns=columns)
+
+    @staticmethod
+    def index_path(db_path: str, with_stemming: bool, index_dir: Optional[str]) -> str:
+        if index_dir is None:
+            index_dir = os.path.dirname(db_path)
+        db_name = os.path.splitext(os.path.basename(db_path))[0]
+        # databases with the same file name, e.g. in different directories, have
+        # different indexes
+        db_path_hash = hashlib.sha1(os.path.abspath(db_path).encode()).hexdigest()[:16]
+        return os.path.join(
+            index_dir,
+            "{}.{}.{}{}".format(
+                db_name,
+                db_path_hash,
+                "stem" if with_stemming else "raw",
+                DB_CONTENT_INDEX_SUFFIX,
+            ),
+        )
+
+    @classmethod
+    def load_or_build(
+        cls, db_path: str, with_stemming: bool, index_dir: Optional[str] = None
+    ) -> "DBContentIndex":
+        """
+        Load the persisted index of a database, or build and persist it if there is none
+        or if the database changed since. Persisting is best effort: if the index cannot
+        be written, e.g. next to a database in a read-only directory, it is only kept in
+        memory.
+        """
+        index_path = cls.index_path(db_path, with_stemming, index_dir)
+        fingerprint = cls.fingerprint(db_path, with_stemming)
+        try:
+            with open(index_path, "rb") as f:
+                persisted_fingerprint, columns = pickle.load(f)
+            if persisted_fingerprint == fingerprint:
+                return cls(
+                    db_path=db_path, with_stemming=with_stemming, columns=columns
+                )
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            # e.g. a truncated index, or one pickled by an incompatible version
+            logger.warning(
+                "Could not read the content index {}, rebuilding it: {}".format(
+                    index_path, e
+                )
+            )
+
+        index = cls.build(db_path, with_stemming)
+        # processes that build the same index concurrently write the same content
+        tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                pickle.dump((fingerprint, index.columns), f)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            logger.warning(
+                "Could not write the content index {}: {}".format(index_path, e)
+            )
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return index
+
+    @property
+    def num_entries(self) -> int:
+        return sum(
+            len(whole_entries) + len(partial_entries)
+            for whole_entries, partial_entries in self.columns.values()
+        )
+
+    def lookup(
+        self, span: Tuple[str, ...], table_name: str, column_name: str
+    ) -> List[Tuple[EntryType, str]]:
+        column = self.columns.get((table_name.lower(), column_name.lower()), None)
+        if column is None:
+            return []
+        whole_entries, partial_entries = column
+        matches: List[Tuple[EntryType, str]] = []
+        if span in whole_entries:
+            matches.append((EntryType.WHOLE_ENTRY, whole_entries[span]))
+        if len(span) == 1 and span[0] in partial_entries:
+            matches.append((EntryType.PARTIAL_ENTRY, partial_entries[span[0]]))
+        return matches
+
+    @property
+    def size(self) -> int:
+        """The number of entries, and of nodes and matches of the automatons that were
+        built, which bounds the memory use of the index."""
+        return self.num_entries + sum(
+            automaton.size for automaton in self._automatons.values()
+        )
+
+    def automaton(
+        self, max_span_length: int, by_characters: bool = False
+    ) -> "DBContentAutomaton":
+        # the automaton over characters does not depend on the maximum span length
+        key = (by_characters, None if by_characters else max_span_length)
+        if key not in self._automatons:
+            self._automatons[key] = DBContentAutomaton(
+                _character_patterns(self.columns)
+                if by_characters
+                else _word_patterns(self.columns, max_span_length)
+            )
+        return self._automatons[key]
+
+
+# map: (table_name, column_name) -> matches of a span in the column
+ColumnMatches = Dict[Tuple[str, str], List[Tuple[EntryType, str]]]
+
+# (symbols, (table_name, column_name), entry type, value)
+Pattern = Tuple[Sequence[str], Tuple[str, str], EntryType, str]
+
+
+def _word_patterns(
+    columns: Dict[Tuple[str, str], ColumnEntries], max_span_length: int
+) -> Iterator[Pattern]:
+    """The entries of the columns as sequences of words: whole entries up to
+    `max_span_length` words, and partial entries. Whole entries come first, and so
+    first among matches, like in DBContentIndex.lookup."""
+    for column, (whole_entries, _) in columns.items():
+        for words, value in whole_entries.items():
+            if 0 < len(words) <= max_span_length:
+                yield words, column, EntryType.WHOLE_ENTRY, value
+    for column, (_, partial_entries) in columns.items():
+        for word, value in partial_entries.items():
+            yield (word,), column, EntryType.PARTIAL_ENTRY, value
+
+
+def _character_patterns(
+    columns: Dict[Tuple[str, str], ColumnEntries]
+) -> Iterator[Pattern]:
+    """The rows of the columns as strings of characters without spaces, for languages
+    that are written without spaces, like Chinese and Japanese: whole rows, and the
+    words of rows as partial entries. When several rows of a column produce the same
+    entry, the last row wins."""
+    whole_patterns: Dict[Tuple[Tuple[str, str], str], str] = {}
+    partial_patterns: Dict[Tuple[Tuple[str, str], str], str] = {}
+    for column, (whole_entries, _) in columns.items():
+        for row in whole_entries.values():
+            words = row.lower().split()
+            whole_patterns[(column, "".join(words))] = row
+            for word in words:
+                partial_patterns[(column, word)] = row
+    for (column, chars), row in whole_patterns.items():
+        if len(chars) > 0:
+            yield chars, column, EntryType.WHOLE_ENTRY, row
+    for (column, chars), row in partial_patterns.items():
+        yield chars, column, EntryType.PARTIAL_ENTRY, row
+
+
+class DBContentAutomaton(object):
+    """
+    Aho-Corasick automaton over symbols, words or characters, whose patterns are the
+    entries of all the columns of a database. Scanning a sequence of words once finds
+    the matches of all its spans in all the columns. Over words, these are the same as
+    DBContentIndex.lookup of every span and column.
+    """
+
+    def __init__(self, patterns: Iterable[Pattern]) -> None:
+        # the trie of the patterns, as transitions, depths and matches of the nodes
+        self.goto: List[Dict[str, int]] = [{}]
+        self.depth: List[int] = [0]
+        # matches: ((table_name, column_name), entry type, value)
+        self.matches: List[List[Tuple[Tuple[str, str], EntryType, str]]] = [[]]
+        for symbols, column, entry_type, value in patterns:
+            node = self._add(symbols)
+            self.matches[node].append((column, entry_type, value))
+
+        # failure links point to the longest proper suffix that is in the trie, and
+        # output links to the longest proper suffix that has matches
+        self.fail: List[int] = [0] * len(self.goto)
+        self.output: List[int] = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for word, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and word not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(word, 0)
+                self.output[child] = (
+                    self.fail[child]
+                    if self.matches[self.fail[child]]
+                    else self.output[self.fail[child]]
+                )
+                queue.append(child)
+
+        self.size = len(self.goto) + sum(len(matches) for matches in self.matches)
+
+    def _add(self, symbols: Sequence[str]) -> int:
+        node = 0
+        for symbol in symbols:
+            if symbol not in self.goto[node]:
+                self.goto.append({})
+                self.depth.append(self.depth[node] + 1)
+                self.matches.append([])
+                self.goto[node][symbol] = len(self.goto) - 1
+            node = self.goto[node][symbol]
+        return node
+
+    def scan(self, symbols: Sequence[str]) -> Dict[Tuple[int, int], ColumnMatches]:
+        """map: (start, end) -> matches of symbols[start:end] by column"""
+        spans: Dict[Tuple[int, int], ColumnMatches] = {}
+        node = 0
+        for end, symbol in enumerate(symbols, start=1):
+            while node and symbol not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(symbol, 0)
+            match_node = node if self.matches[node] else self.output[node]
+            while match_node:
+                column_matches = spans.setdefault(
+                    (end - self.depth[match_node], end), {}
+                )
+                for column, entry_type, value in self.matches[match_node]:
+                    column_matches.setdefault(column, []).append((entry_type, value))
+                match_node = self.output[match_node]
+        return spans
+
+    def scan_characters(
+        self, words: Sequence[str], max_span_length: int
+    ) -> Dict[Tuple[int, int], ColumnMatches]:
+        """map: (start, end) -> matches of the characters of words[start:end] by column,
+        for the spans up to `max_span_length` words"""
+        # map: character offset -> word index, at the boundaries of the words
+        starts, ends, offset = {}, {}, 0
+        for index, word in enumerate(words):
+            starts[offset] = index
+            offset += len(word)
+            ends[offset] = index + 1
+        spans = {}
+        for (start, end), column_matches in self.scan("".join(words)).items():
+            if start in starts and end in ends:
+                span = (starts[start], ends[end])
+                if span[1] - span[0] <= max_span_length:
+                    spans[span] = column_matches
+        return spans
+
+
+class DBContentIndexCache(object):
+    """
+    The content indexes that are in memory, with least recently used indexes evicted
+    once their total size, i.e. their number of entries and of automaton nodes and
+    matches, exceeds `max_entries`. The index that was used last is always kept, even
+    if it is larger than that.
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        # map: (db_path, with_stemming) -> index, from least to most recently used
+        self._indexes: "OrderedDict[Tuple[str, bool], DBContentIndex]" = OrderedDict()
+        self.num_entries = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._indexes)
+
+    def get(
+        self, db_path: str, with_stemming: bool, index_dir: Optional[str] = None
+    ) -> DBContentIndex:
+        key = (db_path, with_stemming)
+        if key in self._indexes:
+            self.hits += 1
+            self._indexes.move_to_end(key)
+            return self._indexes[key]
+
+        self.misses += 1
+        index = DBContentIndex.load_or_build(db_path, with_stemming, index_dir)
+        self._indexes[key] = index
+        self.num_entries += index.size
+        self._evict()
+        return index
+
+    def automaton(
+        self,
+        db_path: str,
+        with_stemming: bool,
+        max_span_length: int,
+        index_dir: Optional[str] = None,
+        by_characters: bool = False,
+    ) -> "DBContentAutomaton":
+        """The automaton of the content index of a database, whose size counts towards
+        the one of the index once it is built."""
+        index = self.get(db_path, with_stemming, index_dir)
+        size = index.size
+        automaton = index.automaton(max_span_length, by_characters)
+        self.num_entries += index.size - size
+        self._evict()
+        return automaton
+
+    def _evict(self) -> None:
+        while self.num_entries > self.max_entries and len(self._indexes) > 1:
+            _, evicted_index = self._indexes.popitem(last=False)
+            self.num_entries -= evicted_index.size
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._indexes.clear()
+        self.num_entries = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "indexes": len(self._indexes),
+            "entries": self.num_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# indexes are loaded on first match
+db_content_indexes = DBContentIndexCache(max_entries=DB_CONTENT_INDEXES_MAX_ENTRIES)
+
+
+def get_db_content_index(
+    db_path: str, with_stemming: bool, index_dir: Optional[str] = None
+) -> DBContentIndex:
+    return db_content_indexes.get(db_path, with_stemming, index_dir)
 
 
 def match_db_content(
@@ -42,86 +439,144 @@ def match_db_content(
     db_id: str,
     db_path: str,
     with_stemming: bool,
+    index_dir: Optional[str] = None,
 ) -> List[Tuple[EntryType, str]]:
     """
     Try to match a span to a certain database column.
-    Indexes the column beforehand if it was not indexed yet.
+    Loads or builds the content index of the database beforehand if needed.
     :param span:
     :param column_name:
     :param table_name:
     :param db_id:
     :param db_path:
     :param with_stemming:
+    :param index_dir: directory of the persisted content indexes, or None for the
+    directory of the database
     :return: List of matches of length 0, 1 or 2.
     A match is defined by a tuple (entry_type, match_value) giving the type of entry (whole or partial), and the
     raw DB-value that was matched.
     """
-
-    def _index_column(columnd_identifier: ColumnIdentifier, db_path: str) -> None:
-        """
-        Go through column content and add each row and its words to the index
-        """
-        if columnd_identifier in _indexed_columns:
-            return  # column was already indexed
-
-        column_content = get_column_content(columnd_identifier, db_path)
-        # index the row and the words in it
-        for row in column_content:
-            processed_row = pre_process_words(
-                words=row.lower().split(), with_stemming=with_stemming
-            )
-
-            # TODO: What if several rows in the same column produce the same entry ("James Doe" and "James Smith"
-            # both would have "James" part-of-entry). List of matching values instead?
-            # Add the whole row
-            entry: Entry = (processed_row, EntryType.WHOLE_ENTRY)
-            if entry not in _db_index:
-                _db_index[entry] = {}
-            _db_index[entry][columnd_identifier] = row
-
-            # Add parts of the row
-            # TODO: also add sub-spans of length >1 ?
-            for word in processed_row:
-                entry: Entry = ((word,), EntryType.PARTIAL_ENTRY)
-                if entry not in _db_index:
-                    _db_index[entry] = {}
-                _db_index[entry][columnd_identifier] = row
-
-        # register that column was indexed
-        _indexed_columns.add(columnd_identifier)
-
     # Skip stop-words
     if len(span) == 1 and span[0] in stop_words:
         return []
 
     span = pre_process_words(words=span, with_stemming=with_stemming)
-    column_identifier = ColumnIdentifier(
-        column_name=column_name, table_name=table_name, db_id=db_id
+    db_content_index = get_db_content_index(db_path, with_stemming, index_dir)
+    return db_content_index.lookup(span, table_name=table_name, column_name=column_name)
+
+
+def match_db_content_spans(
+    words: Sequence[str],
+    db_path: str,
+    with_stemming: bool,
+    max_span_length: int,
+    index_dir: Optional[str] = None,
+    by_characters: bool = False,
+) -> Dict[Tuple[int, int], ColumnMatches]:
+    """
+    Match all the spans of a sequence of words, up to `max_span_length` words, to all
+    the columns of a database at once. The matches of a span and a column are those of
+    match_db_content, or, `by_characters`, those of the characters of the span with
+    the characters of rows and of their words, without spaces, e.g. for Chinese and
+    Japanese.
+    :return: map: (start, end) -> {(table_name, column_name): matches of the span}, for
+    the spans that match. Table and column names are lower-cased.
+    """
+    automaton = db_content_indexes.automaton(
+        db_path, with_stemming, max_span_length, index_dir, by_characters
     )
-    _index_column(
-        columnd_identifier=column_identifier, db_path=db_path,
+    if by_characters:
+        spans = automaton.scan_characters(words, max_span_length)
+    else:
+        spans = automaton.scan(
+            pre_process_words(words=words, with_stemming=with_stemming)
+        )
+    # Skip stop-words
+    for start, word in enumerate(words):
+        if word in stop_words:
+            spans.pop((start, start + 1), None)
+    return spans
+
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    # read-only, and without locking, since the database does not change while it is
+    # being indexed
+    conn = sqlite3.connect(
+        "file:{}?mode=ro&immutable=1".format(pathname2url(os.path.abspath(db_path))),
+        uri=True,
     )
+    # Avoid "could not decode to utf-8" errors
+    conn.text_factory = lambda b: b.decode(errors="ignore")
+    return conn
+
 
-    matches: List[Tuple[EntryType, str]] = []
-    for entry in ((span, EntryType.WHOLE_ENTRY), (span, EntryType.PARTIAL_ENTRY)):
-        if entry in _db_index and column_identifier in _db_index[entry]:
-            matches.append((entry[1], _db_index[entry][column_identifier]))
-    return matches
+def _has_text(declared_type: str) -> bool:
+    """
+    Whether a column may hold text, following the type affinity rules of SQLite.
+    Columns without a declared type are kept, they often hold text in practice.
+    """
+    declared_type = declared_type.upper()
+    if "INT" in declared_type:
+        return False
+    if any(text_type in declared_type for text_type in ("CHAR", "CLOB", "TEXT")):
+        return True
+    if "BLOB" in declared_type:
+        return False
+    if any(real_type in declared_type for real_type in ("REAL", "FLOA", "DOUB")):
+        return False
+    # e.g. dates, decimals and booleans, which are often stored as text
+    return True
+
+
+def _column_content(
+    conn: sqlite3.Connection, table_name: str, column_name: str
+) -> Iterator[str]:
+    query = f'SELECT "{column_name}" FROM "{table_name}";'
+    cursor = conn.execute(query)
+    while True:
+        rows = cursor.fetchmany(DB_CONTENT_FETCH_SIZE)
+        if len(rows) == 0:
+            break
+        for row in rows:
+            yield str(row[0])
+
+
+def get_db_content(db_path: str) -> Iterator[Tuple[str, str, Iterator[str]]]:
+    """
+    Obtain the content of all text columns of a database, as (table, column, rows).
+    The rows of a column have to be consumed before moving on to the next column.
+    """
+    conn = _connect(db_path)
+    try:
+        table_names = [
+            row[0]
+            for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table';"
+            ).fetchall()
+        ]
+        for table_name in table_names:
+            query = f'PRAGMA table_info("{table_name}");'
+            for _, column_name, declared_type, *_ in conn.execute(query).fetchall():
+                if not _has_text(declared_type):
+                    continue
+                yield table_name, column_name, _column_content(
+                    conn, table_name, column_name
+                )
+    finally:
+        conn.close()
 
 
 def get_column_content(column_identifier: ColumnIdentifier, db_path: str) -> List[str]:
     """Obtain and process content of column"""
-    db_file = db_path
-    conn = sqlite3.connect(db_file)
-    # Avoid "could not decode to utf-8" errors
-    conn.text_factory = lambda b: b.decode(errors="ignore")
-    query = f'SELECT "{column_identifier.column_name}" FROM "{column_identifier.table_name}";'
-    col_content = conn.execute(query).fetchall()
-    conn.close()
-
-    col_content = [r[0] for r in col_content]
-    processed_column_content = [str(row) for row in col_content]
-    return processed_column_content
+    conn = _connect(db_path)
+    try:
+        return list(
+            _column_content(
+                conn, column_identifier.table_name, column_identifier.column_name
+            )
+        )
+    finally:
+        conn.close()
 
 
 def pre_process_words(words: Iterable[str], with_stemming: bool, lemma=None) -> Tuple[str, ...]:
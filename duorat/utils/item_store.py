@@ -0,0 +1,182 @@
+"""Memory-mapped, read-only storage of fully built items.
+
+A store is a directory with one pair of files per section: a flat binary file that
+holds the bytes of all the tensors of all the items, and a pickled index that maps
+item keys to the layout of these tensors within the binary file. Items are rebuilt
+from zero-copy views of the memory-mapped binary file, so that processes that read
+from the same store share its pages.
+"""
+
+import dataclasses
+import glob
+import hashlib
+import logging
+import os
+import pickle
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Offsets of the tensors in the binary file are aligned to this many bytes
+ALIGNMENT = 8
+
+BIN_SUFFIX = ".bin"
+INDEX_SUFFIX = ".index.pkl"
+
+
+def item_key(item: Any) -> str:
+    """Content hash of a picklable item."""
+    return hashlib.sha1(pickle.dumps(item)).hexdigest()
+
+
+class ItemStoreWriter(object):
+    """Writes the items of one section.
+    The files are only moved into place when the writer is closed."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path + BIN_SUFFIX + ".tmp", "wb")
+        self._index: Dict[str, Any] = {}
+
+    def __enter__(self) -> "ItemStoreWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._file.name)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def add(self, key: str, item: Any) -> None:
+        self._index[key] = self._write(item)
+
+    def _write(self, obj: Any) -> Tuple:
+        if isinstance(obj, torch.Tensor):
+            array = obj.detach().cpu().numpy()
+            offset = self._file.tell()
+            padding = -offset % ALIGNMENT
+            if padding > 0:
+                self._file.write(bytes(padding))
+                offset += padding
+            self._file.write(np.ascontiguousarray(array).tobytes())
+            return "tensor", array.dtype.str, array.shape, offset
+        elif dataclasses.is_dataclass(obj):
+            return (
+                "dataclass",
+                type(obj),
+                {
+                    field.name: self._write(getattr(obj, field.name))
+                    for field in dataclasses.fields(obj)
+                },
+            )
+        elif isinstance(obj, tuple):
+            return "tuple", tuple(self._write(elem) for elem in obj)
+        else:
+            return "object", obj
+
+    def close(self) -> None:
+        self._file.close()
+        with open(self.path + INDEX_SUFFIX + ".tmp", "wb") as f:
+            pickle.dump(self._index, f)
+        os.replace(self.path + BIN_SUFFIX + ".tmp", self.path + BIN_SUFFIX)
+        os.replace(self.path + INDEX_SUFFIX + ".tmp", self.path + INDEX_SUFFIX)
+
+
+class ItemStoreReader(object):
+    """Reads the items of one section."""
+
+    def __init__(self, path: str) -> None:
+        with open(path + INDEX_SUFFIX, "rb") as f:
+            self._index: Dict[str, Any] = pickle.load(f)
+        if os.path.getsize(path + BIN_SUFFIX) > 0:
+            # copy-on-write, so that the tensors do not have to be read-only
+            self._buffer = np.memmap(path + BIN_SUFFIX, dtype=np.uint8, mode="c")
+        else:
+            self._buffer = np.empty((0,), dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def get(self, key: str, device: torch.device) -> Optional[Any]:
+        layout = self._index.get(key, None)
+        if layout is None:
+            return None
+        return self._read(layout, device)
+
+    def _read(self, layout: Tuple, device: torch.device) -> Any:
+        kind = layout[0]
+        if kind == "tensor":
+            _, dtype, shape, offset = layout
+            array = np.ndarray(
+                shape=shape, dtype=np.dtype(dtype), buffer=self._buffer, offset=offset
+            )
+            return torch.from_numpy(array).to(device)
+        elif kind == "dataclass":
+            _, cls, fields = layout
+            return cls(
+                **{
+                    name: self._read(field_layout, device)
+                    for name, field_layout in fields.items()
+                }
+            )
+        elif kind == "tuple":
+            return tuple(self._read(elem, device) for elem in layout[1])
+        else:
+            return layout[1]
+
+
+class ItemStore(object):
+    """All the sections in a store directory. Sections are opened lazily."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._readers: Optional[Dict[str, ItemStoreReader]] = None
+
+    def section_path(self, section: str) -> str:
+        return os.path.join(self.path, section)
+
+    def writer(self, section: str) -> ItemStoreWriter:
+        self._readers = None
+        return ItemStoreWriter(self.section_path(section))
+
+    @property
+    def readers(self) -> Dict[str, ItemStoreReader]:
+        if self._readers is None:
+            self._readers = {}
+            for index_path in sorted(glob.glob(self.section_path("*") + INDEX_SUFFIX)):
+                section_path = index_path[: -len(INDEX_SUFFIX)]
+                self._readers[os.path.basename(section_path)] = ItemStoreReader(
+                    section_path
+                )
+            if len(self._readers) > 0:
+                logger.info(
+                    "Loaded the items of {} from {}".format(
+                        ", ".join(self._readers.keys()), self.path
+                    )
+                )
+        return self._readers
+
+    def get(self, key: str, device: torch.device) -> Optional[Any]:
+        for reader in self.readers.values():
+            item = reader.get(key, device)
+            if item is not None:
+                return item
+        return None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # memory maps are reopened rather than pickled, e.g. in data loader workers
+        return {"path": self.path, "_readers": None}
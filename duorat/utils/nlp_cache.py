@@ -0,0 +1,168 @@
+"""Persistent cache of tokenization and lemmatization results.
+
+Results are stored in an SQLite file, under a namespace that names the tool, the
+language and the model version that produced them, so that preprocessing, inference
+and the API reuse each other's work. Writes are batched, and several processes can
+share a file.
+"""
+
+import atexit
+import logging
+import os
+import pickle
+import sqlite3
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# number of new entries that are written at once
+COMMIT_EVERY = 256
+
+# bump to discard the entries written by earlier versions
+NLP_CACHE_VERSION = 2
+
+_caches: List["PersistentNLPCache"] = []
+
+
+def default_cache_path() -> str:
+    return os.path.join(os.environ.get("CACHE_DIR", os.getcwd()), ".nlp_cache.sqlite")
+
+
+class PersistentNLPCache(object):
+    def __init__(self, path: str, namespace: str) -> None:
+        self.path = path
+        self.namespace = "v{}/{}".format(NLP_CACHE_VERSION, namespace)
+        self.hits = 0
+        self.misses = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid: Optional[int] = None
+        self._pending: Dict[str, Any] = {}
+        _caches.append(self)
+
+    def _connection(self) -> sqlite3.Connection:
+        # connections are not shared with forked processes
+        if self._conn is None or self._conn_pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL;")
+            self._conn.execute("PRAGMA synchronous=NORMAL;")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, "
+                "PRIMARY KEY (namespace, key));"
+            )
+            self._conn.commit()
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def get(self, key: str) -> Optional[Any]:
+        return self.get_many([key]).get(key, None)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """The cached values of the keys that are in the cache."""
+        keys = list(dict.fromkeys(keys))
+        values = {key: self._pending[key] for key in keys if key in self._pending}
+        missing = [key for key in keys if key not in values]
+        # stay below the maximum number of SQLite query parameters
+        for start in range(0, len(missing), 500):
+            batch = missing[start : start + 500]
+            query = "SELECT key, value FROM cache WHERE namespace = ? AND key IN ({});"
+            rows = self._connection().execute(
+                query.format(", ".join("?" * len(batch))), [self.namespace] + batch
+            )
+            for key, value in rows:
+                values[key] = pickle.loads(value)
+        self.hits += len(values)
+        self.misses += len(keys) - len(values)
+        return values
+
+    def put(self, key: str, value: Any) -> None:
+        self._pending[key] = value
+        if len(self._pending) >= COMMIT_EVERY:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self._pending) == 0:
+            return
+        conn = self._connection()
+        conn.executemany(
+            "INSERT OR IGNORE INTO cache (namespace, key, value) VALUES (?, ?, ?);",
+            [
+                (self.namespace, key, pickle.dumps(value))
+                for key, value in self._pending.items()
+            ],
+        )
+        conn.commit()
+        self._pending = {}
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "namespace": self.namespace,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+    def __getstate__(self) -> Dict[str, Any]:
+        self.flush()
+        state = dict(self.__dict__)
+        state["_conn"], state["_conn_pid"] = None, None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        _caches.append(self)
+
+
+def process_stats() -> Dict[str, Dict[str, int]]:
+    """Hits and misses of the caches of this process, by namespace."""
+    stats: Dict[str, Dict[str, int]] = {}
+    for cache in _caches:
+        if cache.hits + cache.misses > 0:
+            add_stats(
+                stats, {cache.namespace: {"hits": cache.hits, "misses": cache.misses}}
+            )
+    return stats
+
+
+def add_stats(
+    total: Dict[str, Dict[str, int]], stats: Dict[str, Dict[str, int]]
+) -> None:
+    """Adds hits and misses, e.g. of other processes, to `total`."""
+    for namespace, namespace_stats in stats.items():
+        total_stats = total.setdefault(namespace, {"hits": 0, "misses": 0})
+        total_stats["hits"] += namespace_stats["hits"]
+        total_stats["misses"] += namespace_stats["misses"]
+
+
+def reset_stats() -> None:
+    for cache in _caches:
+        cache.hits, cache.misses = 0, 0
+
+
+def report(stats: Optional[Dict[str, Dict[str, int]]] = None) -> str:
+    """Hit rates of the caches, of this process if `stats` is None."""
+    if stats is None:
+        stats = process_stats()
+    return "\n".join(
+        "{}: {} hits, {} misses, hit rate {:.1%}".format(
+            namespace,
+            namespace_stats["hits"],
+            namespace_stats["misses"],
+            namespace_stats["hits"]
+            / max(namespace_stats["hits"] + namespace_stats["misses"], 1),
+        )
+        for namespace, namespace_stats in stats.items()
+    )
+
+
+@atexit.register
+def flush_all() -> None:
+    """Writes the new entries of all the caches of this process, which happens at exit
+    too, but not in worker processes that are terminated."""
+    for cache in _caches:
+        try:
+            cache.flush()
+        except sqlite3.Error as e:
+            logger.warning("Could not write the NLP cache {}: {}".format(cache.path, e))
@@ -1,17 +1,23 @@
 import abc
 from functools import partial
+import itertools
 import json
-from collections import deque
+from collections import deque, OrderedDict
 
 import _jsonnet
 from dataclasses import replace
 from typing import (
+    Dict,
+    Generic,
+    List,
     Tuple,
     Generator,
     Optional,
     Callable,
     Iterable,
     Sequence,
+    TypeVar,
+    Union,
 )
 
 from duorat.preproc.slml import SLMLBuilder
@@ -19,6 +25,8 @@ from duorat.preproc.utils import has_subsequence
 from duorat.types import (
     SQLSchema,
     ValueMatchTag,
+    ColumnId,
+    TableId,
     HighConfidenceMatch,
     TableMatchTag,
     ColumnMatchTag,
@@ -30,7 +38,7 @@ from duorat.types import (
 from duorat.utils import registry
 from duorat.utils.db_content import (
     pre_process_words,
-    match_db_content,
+    match_db_content_spans,
     EntryType,
 )
 from duorat.utils.tokenization import AbstractTokenizer, StanzaTokenizer
@@ -41,6 +49,15 @@ class AbstractSchemaLinker(metaclass=abc.ABCMeta):
     def question_to_slml(self, question: str, sql_schema: SQLSchema, lang: str = 'en') -> str:
         pass
 
+    def prefetch(
+        self, questions: Sequence[str], sql_schemas: Iterable[SQLSchema], lang: str = 'en'
+    ) -> None:
+        """Prepare in bulk for linking the questions to the schemas."""
+        pass
+
+
+# number of (schema, language) pairs whose name indexes a schema linker keeps
+SCHEMA_NAME_INDEX_CACHE_SIZE = 256
 
 MATCH_CONFIDENCE = {
     "high": HighConfidenceMatch(),
@@ -59,6 +76,8 @@ class SpiderSchemaLinker(AbstractSchemaLinker):
         blocking_match: bool = True,
         whole_entry_db_content_confidence: str = "high",
         partial_entry_db_content_confidence: str = "low",
+        db_content_index_dir: Optional[str] = None,
+        char_ngram_langs: Sequence[str] = (),
     ):
         super(SpiderSchemaLinker, self).__init__()
         self.max_n_gram = max_n_gram
@@ -70,7 +89,85 @@ class SpiderSchemaLinker(AbstractSchemaLinker):
         self.partial_entry_db_content_confidence = MATCH_CONFIDENCE[
             partial_entry_db_content_confidence
         ]
+        # None keeps the content index of a database next to it
+        self.db_content_index_dir = db_content_index_dir
+        # languages whose questions are matched to schema names and db-content
+        # character-wise, without tokenizing or lemmatizing the names, e.g. zh and ja
+        self.char_ngram_langs = set(char_ngram_langs)
         self.tokenizer: AbstractTokenizer = registry.construct("tokenizer", tokenizer)
+        # map: (id of schema, lang) -> (schema, column name index, table name index)
+        self._schema_name_indexes: OrderedDict = OrderedDict()
+
+    def _get_schema_name_indexes(
+        self,
+        sql_schema: SQLSchema,
+        lang: str,
+        tokenize: Callable[[str], Sequence[str]],
+        lemma: Callable[[str], Sequence[str]],
+    ) -> Tuple["NameIndex[ColumnId]", "NameIndex[TableId]"]:
+        key = (id(sql_schema), lang)
+        cached = self._schema_name_indexes.get(key, None)
+        # the schema is kept in the cache, so that its id is not reused while cached
+        if cached is not None and cached[0] is sql_schema:
+            self._schema_name_indexes.move_to_end(key)
+            return cached[1], cached[2]
+
+        if lang in self.char_ngram_langs:
+            column_name_index, table_name_index = build_char_ngram_name_indexes(
+                sql_schema
+            )
+        else:
+            column_name_index, table_name_index = build_schema_name_indexes(
+                sql_schema=sql_schema,
+                tokenize=tokenize,
+                lemma=lemma,
+                with_stemming=self.with_stemming,
+            )
+        self._schema_name_indexes[key] = (
+            sql_schema,
+            column_name_index,
+            table_name_index,
+        )
+        if len(self._schema_name_indexes) > SCHEMA_NAME_INDEX_CACHE_SIZE:
+            self._schema_name_indexes.popitem(last=False)
+        return column_name_index, table_name_index
+
+    def prefetch(
+        self, questions: Sequence[str], sql_schemas: Iterable[SQLSchema], lang: str = 'en'
+    ) -> None:
+        """
+        Tokenize and lemmatize in bulk what question_to_slml will ask the tokenizer for:
+        the questions and the schema names, then the spans of the questions and the
+        tokenized schema names. Languages that are matched character-wise only need
+        the questions.
+        """
+        if not isinstance(self.tokenizer, StanzaTokenizer):
+            return
+        if lang in self.char_ngram_langs:
+            self.tokenizer.analyze_batch(questions, lang=lang)
+            return
+        names = set(
+            itertools.chain.from_iterable(
+                itertools.chain(
+                    sql_schema.column_names.values(), sql_schema.table_names.values()
+                )
+                for sql_schema in sql_schemas
+            )
+        )
+        self.tokenizer.analyze_batch(itertools.chain(questions, names), lang=lang)
+        if not self.with_stemming:
+            return
+
+        spans = []
+        for question in questions:
+            tokens = [
+                token for token, _ in self.tokenizer.tokenize_with_raw(question, lang=lang)
+            ]
+            for n in range(1, self.max_n_gram + 1):
+                for start in range(len(tokens) - n + 1):
+                    spans.append(" ".join(tokens[start : start + n]))
+        spans += [" ".join(self.tokenizer.tokenize(name, lang=lang)) for name in names]
+        self.tokenizer.analyze_batch(spans, lang=lang)
 
     def question_to_slml(self, question: str, sql_schema: SQLSchema, lang: str = 'en') -> str:
         if  isinstance(self.tokenizer, StanzaTokenizer) or \
@@ -83,7 +180,10 @@ class SpiderSchemaLinker(AbstractSchemaLinker):
             _tokenize = self.tokenizer.tokenize
             _tokenized_question = self.tokenizer.tokenize_with_raw(question)
             _detokenize = self.tokenizer.detokenize
-        
+
+        column_name_index, table_name_index = self._get_schema_name_indexes(
+            sql_schema=sql_schema, lang=lang, tokenize=_tokenize, lemma=_lemma
+        )
         tagged_question_tokens = tag_question_with_schema_links(
             tokenized_question=_tokenized_question,
             sql_schema=sql_schema,
@@ -94,6 +194,10 @@ class SpiderSchemaLinker(AbstractSchemaLinker):
             blocking_match=self.blocking_match,
             whole_entry_db_content_confidence=self.whole_entry_db_content_confidence,
             partial_entry_db_content_confidence=self.partial_entry_db_content_confidence,
+            db_content_index_dir=self.db_content_index_dir,
+            column_name_index=column_name_index,
+            table_name_index=table_name_index,
+            by_characters=lang in self.char_ngram_langs,
         )
         slml_builder = SLMLBuilder(
             sql_schema=sql_schema, detokenize=_detokenize
@@ -114,6 +218,10 @@ def tag_question_with_schema_links(
     blocking_match: bool,
     whole_entry_db_content_confidence: Optional[MatchConfidence],
     partial_entry_db_content_confidence: Optional[MatchConfidence],
+    db_content_index_dir: Optional[str] = None,
+    column_name_index: Optional["NameIndex[ColumnId]"] = None,
+    table_name_index: Optional["NameIndex[TableId]"] = None,
+    by_characters: bool = False,
 ) -> TaggedSequence:
     """
 
@@ -125,8 +233,19 @@ def tag_question_with_schema_links(
     :param blocking_match:
     :param whole_entry_db_content_confidence:
     :param partial_entry_db_content_confidence:
+    :param db_content_index_dir:
+    :param column_name_index: built from the schema if None
+    :param table_name_index: built from the schema if None
+    :param by_characters: match db-content character-wise, e.g. for zh and ja
     :return:
     """
+    if column_name_index is None or table_name_index is None:
+        column_name_index, table_name_index = build_schema_name_indexes(
+            sql_schema=sql_schema,
+            tokenize=tokenize,
+            lemma=lemma,
+            with_stemming=with_stemming,
+        )
 
     def _entry_type_to_confidence(entry_type):
         if entry_type is EntryType.WHOLE_ENTRY:
@@ -140,12 +259,19 @@ def tag_question_with_schema_links(
         for token, raw_token in tokenized_question
     ]
 
+    # map: (start, end) -> db-content matches of the span by column, found in one pass
+    # over the question when first needed
+    db_content_matches_by_span = None
+
     for n in range(max_n_gram, 0, -1):
         for (start, end), question_n_gram in get_spans(
             tagged_sequence=tagged_question_tokens, n=n
         ):
             # Try to match column names
-            for column_id, column_name in sql_schema.column_names.items():
+            name_matches = column_name_index.matches(
+                [tagged_token.value for tagged_token in question_n_gram]
+            )
+            for column_id in sql_schema.column_names.keys():
                 if (
                     column_id
                     not in sql_schema.column_to_table
@@ -153,26 +279,30 @@ def tag_question_with_schema_links(
                 ):
                     continue
                 table_id = sql_schema.column_to_table[column_id]
-                match = span_matches_entity(
-                    tagged_span=question_n_gram,
-                    entity_name=column_name,
-                    tokenize=tokenize,
-                    lemma=lemma,
-                    with_stemming=with_stemming,
-                )
+                match = name_matches.get(column_id, NO_MATCH)
 
                 # Try to match using db-content only if a column match did not succeed.
                 # That means column matches have precedence!
                 db_content_matches = []
                 if match is NO_MATCH:
                     if table_id is not None:
-                        db_content_matches = match_db_content(
-                            [token.value for token in question_n_gram],
-                            sql_schema.original_column_names[column_id],
-                            sql_schema.original_table_names[table_id],
-                            sql_schema.db_id,
-                            sql_schema.db_path,
-                            with_stemming=with_stemming,
+                        if db_content_matches_by_span is None:
+                            db_content_matches_by_span = match_db_content_spans(
+                                [token.value for token in tagged_question_tokens],
+                                sql_schema.db_path,
+                                with_stemming=with_stemming,
+                                max_span_length=max_n_gram,
+                                index_dir=db_content_index_dir,
+                                by_characters=by_characters,
+                            )
+                        db_content_matches = db_content_matches_by_span.get(
+                            (start, end), {}
+                        ).get(
+                            (
+                                sql_schema.original_table_names[table_id].lower(),
+                                sql_schema.original_column_names[column_id].lower(),
+                            ),
+                            [],
                         )
                         # Filter non-None confidence.
                         db_content_matches = [
@@ -227,14 +357,11 @@ def tag_question_with_schema_links(
             tagged_sequence=tagged_question_tokens, n=n
         ):
             # Try to match table names
-            for table_id, table_name in sql_schema.table_names.items():
-                match = span_matches_entity(
-                    tagged_span=question_n_gram,
-                    entity_name=table_name,
-                    tokenize=tokenize,
-                    lemma=lemma,
-                    with_stemming=with_stemming,
-                )
+            name_matches = table_name_index.matches(
+                [tagged_token.value for tagged_token in question_n_gram]
+            )
+            for table_id in sql_schema.table_names.keys():
+                match = name_matches.get(table_id, NO_MATCH)
 
                 # Tag the sequence if a match was found
                 if match is not NO_MATCH:
@@ -328,3 +455,152 @@ def span_matches_entity(
             return PARTIAL_MATCH
         else:
             return NO_MATCH
+
+
+T = TypeVar("T")
+
+
+class SchemaNameIndex(Generic[T]):
+    """
+    Names of schema entities (columns or tables), prepared for matching spans.
+    With stemming, all the contiguous sub-sequences of the lemmatized names are indexed,
+    so that the matches of a span are found with one lemmatization and two lookups.
+    Without stemming, matching only involves string comparisons.
+    Matches are the same as with span_matches_entity.
+    """
+
+    def __init__(
+        self,
+        names: Dict[T, str],
+        tokenize: Callable[[str], Sequence[str]],
+        lemma: Callable[[str], Sequence[str]],
+        with_stemming: bool,
+    ) -> None:
+        self.names = names
+        self.lemma = lemma
+        self.with_stemming = with_stemming
+        # map: lemmatized name -> entities
+        self.exact: Dict[Tuple[str, ...], List[T]] = {}
+        # map: sub-sequence of lemmatized name -> entities
+        self.partial: Dict[Tuple[str, ...], List[T]] = {}
+        if with_stemming:
+            for entity_id, name in names.items():
+                name_seq = pre_process_words(
+                    tokenize(name), with_stemming=with_stemming, lemma=lemma
+                )
+                self.exact.setdefault(name_seq, []).append(entity_id)
+                # the empty sequence is a sub-sequence of every name
+                sub_seqs = {()} | {
+                    name_seq[start:end]
+                    for start in range(len(name_seq))
+                    for end in range(start + 1, len(name_seq) + 1)
+                }
+                for sub_seq in sub_seqs:
+                    self.partial.setdefault(sub_seq, []).append(entity_id)
+
+    def matches(self, span: List[str]) -> Dict[T, str]:
+        """map: entity -> EXACT_MATCH or PARTIAL_MATCH, for the entities that match"""
+        if self.with_stemming:
+            span_seq = pre_process_words(
+                span, with_stemming=self.with_stemming, lemma=self.lemma
+            )
+            matches = {
+                entity_id: PARTIAL_MATCH
+                for entity_id in self.partial.get(span_seq, [])
+            }
+            for entity_id in self.exact.get(span_seq, []):
+                matches[entity_id] = EXACT_MATCH
+            return matches
+        else:
+            span_str = " ".join(span)
+            matches = {}
+            for entity_id, entity_name_str in self.names.items():
+                if span_str == entity_name_str:
+                    matches[entity_id] = EXACT_MATCH
+                elif span_str in entity_name_str:
+                    matches[entity_id] = PARTIAL_MATCH
+                elif len(span) == 1 and entity_name_str in span_str:
+                    # When span length is 1, also test the other inclusion
+                    matches[entity_id] = PARTIAL_MATCH
+            return matches
+
+
+def build_schema_name_indexes(
+    sql_schema: SQLSchema,
+    tokenize: Callable[[str], Sequence[str]],
+    lemma: Callable[[str], Sequence[str]],
+    with_stemming: bool,
+) -> Tuple[SchemaNameIndex[ColumnId], SchemaNameIndex[TableId]]:
+    return (
+        SchemaNameIndex(
+            names=sql_schema.column_names,
+            tokenize=tokenize,
+            lemma=lemma,
+            with_stemming=with_stemming,
+        ),
+        SchemaNameIndex(
+            names=sql_schema.table_names,
+            tokenize=tokenize,
+            lemma=lemma,
+            with_stemming=with_stemming,
+        ),
+    )
+
+
+class CharNGramNameIndex(Generic[T]):
+    """
+    Names of schema entities, prepared for matching spans of languages that are written
+    without spaces, such as Chinese and Japanese. Spans and names are compared as
+    strings of characters, without spaces, so that names are neither tokenized nor
+    lemmatized. As without stemming, a span matches a name exactly if the strings are
+    the same, and partially if the span is a substring of the name or, for spans of one
+    token, if the name is a substring of the span.
+    All the substrings of the names are indexed, which makes matching a span a few
+    lookups.
+    """
+
+    def __init__(self, names: Dict[T, str]) -> None:
+        self.names = names
+        # map: name -> entities
+        self.exact: Dict[str, List[T]] = {}
+        # map: substring of name -> entities
+        self.partial: Dict[str, List[T]] = {}
+        for entity_id, name in names.items():
+            name_str = "".join(name.lower().split())
+            self.exact.setdefault(name_str, []).append(entity_id)
+            for sub_str in _substrings(name_str):
+                self.partial.setdefault(sub_str, []).append(entity_id)
+
+    def matches(self, span: List[str]) -> Dict[T, str]:
+        """map: entity -> EXACT_MATCH or PARTIAL_MATCH, for the entities that match"""
+        span_str = "".join(span)
+        matches = {
+            entity_id: PARTIAL_MATCH for entity_id in self.partial.get(span_str, [])
+        }
+        if len(span) == 1:
+            # When span length is 1, also test the other inclusion
+            for sub_str in _substrings(span_str):
+                for entity_id in self.exact.get(sub_str, []):
+                    matches[entity_id] = PARTIAL_MATCH
+        for entity_id in self.exact.get(span_str, []):
+            matches[entity_id] = EXACT_MATCH
+        return matches
+
+
+def _substrings(s: str) -> Iterable[str]:
+    # the empty string is a substring of every string
+    return {""} | {
+        s[start:end] for start in range(len(s)) for end in range(start + 1, len(s) + 1)
+    }
+
+
+NameIndex = Union[SchemaNameIndex[T], CharNGramNameIndex[T]]
+
+
+def build_char_ngram_name_indexes(
+    sql_schema: SQLSchema,
+) -> Tuple[CharNGramNameIndex[ColumnId], CharNGramNameIndex[TableId]]:
+    return (
+        CharNGramNameIndex(names=sql_schema.column_names),
+        CharNGramNameIndex(names=sql_schema.table_names),
+    )
@@ -1,13 +1,19 @@
 import abc
-from functools import lru_cache
-from typing import Dict, List, Sequence, Tuple
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
 import stanza
 from transformers import BertTokenizerFast, XLMRobertaTokenizer
 from transformers import AutoTokenizer, AutoModelForMaskedLM
+from transformers import __version__ as transformers_version
 
 # from duorat.utils import registry, corenlp
 from duorat.utils import registry
+from duorat.utils.nlp_cache import PersistentNLPCache, default_cache_path
+
+# number of strings whose tokens and lemmas a Stanza tokenizer keeps
+STANZA_CACHE_SIZE = 100000
 
 
 class AbstractTokenizer(metaclass=abc.ABCMeta):
@@ -22,26 +28,136 @@ class AbstractTokenizer(metaclass=abc.ABCMeta):
 
 @registry.register("tokenizer", "StanzaTokenizer")
 class StanzaTokenizer(AbstractTokenizer):
-    def __init__(self, langs: List[str] = ['en']):
-        self.nlp: Dict[str, stanza.Document] = \
-            {lang: stanza.Pipeline(lang=lang, processors="tokenize,lemma", logging_level='FATAL', download_method=None) for lang in langs}
+    def __init__(
+        self,
+        langs: List[str] = ['en'],
+        batch_size: int = 256,
+        persistent_cache: bool = True,
+        cache_path: Optional[str] = None,
+        idle_unload_after: Optional[float] = None,
+        lemmatize_langs: Optional[List[str]] = None,
+    ):
+        self.langs = langs
+        # languages whose pipelines lemmatize, all of them if None. The lemmas of the
+        # other languages are their tokens, e.g. for zh and ja, where lemmatization is
+        # nearly the identity and linking does not need it.
+        self.lemmatize_langs = langs if lemmatize_langs is None else lemmatize_langs
+        # pipelines are loaded on first use of their language
+        self._pipelines: Dict[str, stanza.Pipeline] = {}
+        # map: lang -> time of the last use of its pipeline
+        self._last_used: Dict[str, float] = {}
+        # number of seconds after which an unused pipeline is unloaded, or None to
+        # keep pipelines loaded
+        self.idle_unload_after = idle_unload_after
+        # number of strings per Stanza document batch
+        self.batch_size = batch_size
+        # map: (lang, string) -> (tokens, lemmas), from least to most recently used
+        self._analyses: OrderedDict = OrderedDict()
+        # map: lang -> cache of (tokens, lemmas), shared with other processes
+        self._persistent_caches: Dict[str, PersistentNLPCache] = (
+            {
+                lang: PersistentNLPCache(
+                    path=cache_path if cache_path is not None else default_cache_path(),
+                    namespace="stanza-{}/{}{}".format(
+                        stanza.__version__,
+                        lang,
+                        "" if lang in self.lemmatize_langs else "/tokenize",
+                    ),
+                )
+                for lang in langs
+            }
+            if persistent_cache
+            else {}
+        )
+
+    def pipeline(self, lang: str) -> stanza.Pipeline:
+        """The pipeline of a language, which is loaded if needed. Pipelines of other
+        languages that have been idle for too long are unloaded."""
+        if lang not in self.langs:
+            raise ValueError("No Stanza pipeline for language {}".format(lang))
+        now = time.monotonic()
+        if self.idle_unload_after is not None:
+            for other_lang, last_used in list(self._last_used.items()):
+                if other_lang != lang and now - last_used > self.idle_unload_after:
+                    del self._pipelines[other_lang], self._last_used[other_lang]
+        if lang not in self._pipelines:
+            self._pipelines[lang] = stanza.Pipeline(
+                lang=lang,
+                processors=(
+                    "tokenize,lemma" if lang in self.lemmatize_langs else "tokenize"
+                ),
+                logging_level="FATAL",
+                download_method=None,
+            )
+        self._last_used[lang] = now
+        return self._pipelines[lang]
+
+    def unload(self) -> None:
+        self._pipelines.clear()
+        self._last_used.clear()
+
+    def _remember(
+        self, key: Tuple[str, str], analysis: Tuple[Sequence[str], Sequence[str]]
+    ) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+        # analyses are kept immutable, since callers may change the lists they get
+        tokens, lemmas = analysis
+        analysis = (tuple(tokens), tuple(lemmas))
+        self._analyses[key] = analysis
+        if len(self._analyses) > STANZA_CACHE_SIZE:
+            self._analyses.popitem(last=False)
+        return analysis
+
+    def analyze_batch(self, strings: Iterable[str], lang: str = 'en') -> None:
+        """
+        Tokenize and lemmatize in bulk the strings that were not analyzed yet, and are
+        not in the persistent cache either. The results are kept for tokenize and lemma,
+        up to STANZA_CACHE_SIZE strings.
+        """
+        pending = list(
+            dict.fromkeys(s for s in strings if (lang, s) not in self._analyses)
+        )
+        persistent_cache = self._persistent_caches.get(lang, None)
+        if persistent_cache is not None and len(pending) > 0:
+            persisted = persistent_cache.get_many(pending)
+            for s, analysis in persisted.items():
+                self._remember((lang, s), analysis)
+            pending = [s for s in pending if s not in persisted]
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start : start + self.batch_size]
+            docs = self.pipeline(lang)([stanza.Document([], text=s) for s in batch])
+            for s, doc in zip(batch, docs):
+                tokens = [
+                    token.text for sentence in doc.sentences for token in sentence.tokens
+                ]
+                if lang in self.lemmatize_langs:
+                    lemmas = [
+                        word.lemma
+                        for sentence in doc.sentences
+                        for word in sentence.words
+                    ]
+                else:
+                    lemmas = list(tokens)
+                analysis = self._remember((lang, s), (tokens, lemmas))
+                if persistent_cache is not None:
+                    persistent_cache.put(s, analysis)
+
+    def analyze(self, s: str, lang: str = 'en') -> Tuple[List[str], List[str]]:
+        """The tokens and the lemmas of a string, from a single run of the pipeline"""
+        key = (lang, s)
+        if key not in self._analyses:
+            self.analyze_batch([s], lang)
+        self._analyses.move_to_end(key)
+        tokens, lemmas = self._analyses[key]
+        return list(tokens), list(lemmas)
 
-    @lru_cache(maxsize=1024)
     def tokenize(self, s: str, lang: str = 'en') -> List[str]:
-        doc = self.nlp[lang](s)
-        return [
-            token.text for sentence in doc.sentences for token in sentence.tokens
-        ]
+        return self.analyze(s, lang)[0]
 
     def tokenize_with_raw(self, s: str, lang='en') -> List[Tuple[str, str]]:
         return [(token.lower(), token) for token in self.tokenize(s, lang)]
 
-    @lru_cache(maxsize=1024)
     def lemma(self, s: str, lang: str = 'en') -> List[str]:
-        doc = self.nlp[lang](s)
-        return [
-            token.lemma for sentence in doc.sentences for token in sentence.words
-        ]
+        return self.analyze(s, lang)[1]
 
     def lemma_with_raw(self, s: str, lang='en') -> List[Tuple[str, str]]:
         return [(token.lower(), token) for token in self.lemma(s, lang)]
@@ -51,6 +167,12 @@ class StanzaTokenizer(AbstractTokenizer):
             return "".join(xs)
         else:
             return " ".join(xs)
+
+    def __getstate__(self) -> Dict:
+        # pipelines are reloaded on demand rather than pickled
+        state = dict(self.__dict__)
+        state["_pipelines"], state["_last_used"] = {}, {}
+        return state
             
 
 @registry.register("tokenizer", "BERTTokenizer")
@@ -160,15 +282,46 @@ class GRAPPATokenizer(AbstractTokenizer):
 
 @registry.register("tokenizer", "XLMRTokenizer")
 class XLMRTokenizer(AbstractTokenizer):
-    def __init__(self, pretrained_model_name_or_path: str):
+    def __init__(
+        self,
+        pretrained_model_name_or_path: str,
+        persistent_cache: bool = True,
+        cache_path: Optional[str] = None,
+    ):
         self._bert_tokenizer = AutoTokenizer.from_pretrained(
             use_fast=True,
             pretrained_model_name_or_path=pretrained_model_name_or_path)
+        self._persistent_cache = (
+            PersistentNLPCache(
+                path=cache_path if cache_path is not None else default_cache_path(),
+                namespace="transformers-{}/{}".format(
+                    transformers_version, pretrained_model_name_or_path
+                ),
+            )
+            if persistent_cache
+            else None
+        )
 
     def tokenize(self, s: str) -> List[str]:
-        return self._bert_tokenizer.tokenize(s)
+        if self._persistent_cache is None:
+            return self._bert_tokenizer.tokenize(s)
+        tokens = self._persistent_cache.get("tokenize:" + s)
+        if tokens is None:
+            # cached results are immutable, since callers may change the lists they get
+            tokens = tuple(self._bert_tokenizer.tokenize(s))
+            self._persistent_cache.put("tokenize:" + s, tokens)
+        return list(tokens)
 
     def tokenize_with_raw(self, s: str) -> List[Tuple[str, str]]:
+        if self._persistent_cache is None:
+            return self._tokenize_with_raw(s)
+        tokens_with_raw = self._persistent_cache.get("tokenize_with_raw:" + s)
+        if tokens_with_raw is None:
+            tokens_with_raw = tuple(self._tokenize_with_raw(s))
+            self._persistent_cache.put("tokenize_with_raw:" + s, tokens_with_raw)
+        return iter(tokens_with_raw)
+
+    def _tokenize_with_raw(self, s: str) -> List[Tuple[str, str]]:
         # TODO: at some point, hopefully, transformers API will be mature enough
         # to do this in 1 call instead of 2
         tokens = self._bert_tokenizer.tokenize(s)
@@ -39,7 +39,7 @@ from duorat.asdl.lang.spider.spider_transition_system import SpiderTransitionSys
 
 from duorat.utils import registry, optimizers
 from duorat.utils import saver as saver_mod
-from duorat.utils import parallelizer
+from duorat.utils import nlp_cache, parallelizer
 from duorat.utils.evaluation import find_any_config
 from duorat.api import ModelLoader
 
@@ -71,6 +71,7 @@ class Inferer(ModelLoader):
                 output,
                 args.nproc,
                 args.decode_max_time_step,
+                args.batch_size,
             )
 
 
@@ -84,6 +85,7 @@ class Inferer(ModelLoader):
             output,
             nproc,
             decode_max_time_step,
+            batch_size=1,
     ):
         list_items = [
             (idx, oi, pi)
@@ -94,9 +96,10 @@ class Inferer(ModelLoader):
             cp = parallelizer.CUDAParallelizer(nproc)
         else:
             cp = parallelizer.CPUParallelizer(nproc)
+        # Questions are parsed in batches of batch_size
         params = [
-            (beam_size, output_history, indices, orig_items, preproc_items)
-            for indices, orig_items, preproc_items in list_items
+            (beam_size, output_history, list_items[i : i + batch_size])
+            for i in range(0, len(list_items), batch_size)
         ]
         write_all(
             output,
@@ -104,7 +107,7 @@ class Inferer(ModelLoader):
                 [
                     (
                         functools.partial(
-                            self._parse_single,
+                            self._parse_batch,
                             model,
                             decode_max_time_step=decode_max_time_step
                         ),
@@ -114,9 +117,9 @@ class Inferer(ModelLoader):
             ),
         )
 
-    def _parse_single(self, model, param, decode_max_time_step):
-        beam_size, output_history, index, orig_item, preproc_item = param
-        batch = [preproc_item]
+    def _parse_batch(self, model, param, decode_max_time_step):
+        beam_size, output_history, items = param
+        batch = [preproc_item for _, _, preproc_item in items]
 
         def check_heuristic(tree):
             """Return true if tree contains other columns than `*`"""
@@ -128,49 +131,56 @@ class Inferer(ModelLoader):
             return candidate_column_ids != {0}
 
         try:
-            beams = model.parse(batch, decode_max_time_step, beam_size)
-
-            decoded = []
-            for beam in beams:
-                asdl_ast = beam.ast
-                if isinstance(model.preproc.transition_system, SpiderTransitionSystem):
-                    tree = model.preproc.transition_system.ast_to_surface_code(
-                        asdl_ast=asdl_ast
+            batch_beams = model.parse_batch(batch, decode_max_time_step, beam_size)
+
+            results = []
+            for (index, orig_item, _), beams in zip(items, batch_beams):
+                decoded = []
+                for beam in beams:
+                    asdl_ast = beam.ast
+                    if isinstance(model.preproc.transition_system, SpiderTransitionSystem):
+                        tree = model.preproc.transition_system.ast_to_surface_code(
+                            asdl_ast=asdl_ast
+                        )
+                        # Filter out trees for which the heuristic would not work well
+                        # ex: SELECT Count(*) FROM singer;
+                        if self.from_heuristic and check_heuristic(tree):
+                            tree['p_from']=tree["from"]
+                            del tree["from"]
+                        inferred_code = model.preproc.transition_system.spider_grammar.unparse(
+                            tree=tree, spider_schema=orig_item.spider_schema
+                        )
+                        inferred_code_readable = ""
+                    else:
+                        raise NotImplementedError
+
+                    decoded.append(
+                        {
+                            "question": orig_item.question,
+                            "model_output": asdl_ast.pretty(),
+                            "inferred_code": inferred_code,
+                            "inferred_code_readable": inferred_code_readable,
+                            "score": beam.score,
+                            **(
+                                {"choice_history": None, "score_history": None, }
+                                if output_history
+                                else {}
+                            ),
+                        }
                     )
-                    # Filter out trees for which the heuristic would not work well
-                    # ex: SELECT Count(*) FROM singer;
-                    if self.from_heuristic and check_heuristic(tree):
-                        tree['p_from']=tree["from"]
-                        del tree["from"]
-                    inferred_code = model.preproc.transition_system.spider_grammar.unparse(
-                        tree=tree, spider_schema=orig_item.spider_schema
-                    )
-                    inferred_code_readable = ""
-                else:
-                    raise NotImplementedError
-
-                decoded.append(
+                results.append(
                     {
-                        "question": orig_item.question,
-                        "model_output": asdl_ast.pretty(),
-                        "inferred_code": inferred_code,
-                        "inferred_code_readable": inferred_code_readable,
-                        "score": beam.score,
-                        **(
-                            {"choice_history": None, "score_history": None, }
-                            if output_history
-                            else {}
-                        ),
+                        "index": index,
+                        "beams": decoded,
                     }
                 )
-            result = {
-                "index": index,
-                "beams": decoded,
-            }
         except Exception as e:
             raise e
-            result = {"index": index, "error": str(e), "trace": traceback.format_exc()}
-        return json.dumps(result) + "\n"
+            results = [
+                {"index": index, "error": str(e), "trace": traceback.format_exc()}
+                for index, _, _ in items
+            ]
+        return "".join(json.dumps(result) + "\n" for result in results)
 
     def _debug(self, model, sliced_data, output):
         for i, item in enumerate(tqdm.tqdm(sliced_data)):
@@ -198,6 +208,12 @@ def main(args=None, logdir_suffix: List[str] = None):
     parser.add_argument("--start-offset", type=int)
     parser.add_argument("--limit", type=int)
     parser.add_argument("--nproc", type=int, default=1)
+    parser.add_argument(
+        "--batch-size",
+        default=1,
+        type=int,
+        help="Number of questions that are parsed together",
+    )
     parser.add_argument("--decode_max_time_step", type=int, default=500)
     parser.add_argument(
         "--from_heuristic",
@@ -225,6 +241,8 @@ def main(args=None, logdir_suffix: List[str] = None):
     inferer = Inferer(config, from_heuristic=args.from_heuristic)
     model = inferer.load_model(args.logdir, args.step, allow_untrained=True).to(device=device)
     inferer.infer(model, args.output_path, args)
+    if nlp_cache.report():
+        print(nlp_cache.report())
 
 
 if __name__ == "__main__":
@@ -1,15 +1,23 @@
 import argparse
+import copy
 import json
+import multiprocessing
+import pickle
 import _jsonnet
 import tqdm
 import os
+from collections import OrderedDict
 
 from duorat import datasets
 from duorat.preproc import offline, utils
-from duorat.utils import schema_linker
+from duorat.utils import nlp_cache, schema_linker
 from duorat.asdl.lang import spider
 from duorat.utils import registry
 
+# number of items whose NLP work is batched together
+PREFETCH_SIZE = 256
+
+
 class Preprocessor:
     def __init__(self, config):
         self.config = config
@@ -21,7 +29,14 @@ class Preprocessor:
         self.model_preproc.clear_items()
         for section in sections:
             data = registry.construct("dataset", self.config["data"][section])
-            for item in tqdm.tqdm(data, desc=section, dynamic_ncols=True):
+            for index, item in enumerate(
+                tqdm.tqdm(data, desc=section, dynamic_ncols=True)
+            ):
+                if index % PREFETCH_SIZE == 0:
+                    end = min(index + PREFETCH_SIZE, len(data))
+                    self.model_preproc.prefetch(
+                        [data[i] for i in range(index, end)], section
+                    )
                 to_add, validation_info = self.model_preproc.validate_item(
                     item, section,
                 )
@@ -33,6 +48,139 @@ class Preprocessor:
         else:
             self.model_preproc.save()
 
+    def merge_shards(self, section, shard_paths, shards_vocab_counts, keep_vocab):
+        """Collect the items of preprocess_shard outputs in the order of the dataset."""
+        self.model_preproc.clear_items()
+        for vocab_counts in shards_vocab_counts:
+            self.model_preproc.merge_vocab_counts(vocab_counts)
+        indexed_preproc_items = []
+        for shard_path in shard_paths:
+            with open(shard_path, "rb") as f:
+                indexed_preproc_items += pickle.load(f)
+        indexed_preproc_items.sort(key=lambda indexed: indexed[0])
+        self.model_preproc.preproc_items[section] = [
+            preproc_item
+            for _, preproc_items in indexed_preproc_items
+            for preproc_item in preproc_items
+        ]
+
+        if keep_vocab:
+            self.model_preproc.save_examples()
+        else:
+            self.model_preproc.save()
+        for shard_path in shard_paths:
+            os.remove(shard_path)
+
+
+# The preprocessor of a pool worker, reused for all the shards of the same config
+_worker_preproc = None
+_worker_preproc_config = None
+
+
+def preprocess_shard(preproc_config, section, indexed_items, shard_path):
+    """Preprocess some items of a section in a pool worker and write them to a file.
+    Returns the vocabulary counts and the NLP cache statistics of the shard."""
+    global _worker_preproc, _worker_preproc_config
+    if _worker_preproc_config != preproc_config:
+        _worker_preproc = registry.construct("preproc", preproc_config)
+        _worker_preproc_config = preproc_config
+    model_preproc = _worker_preproc
+    model_preproc.clear_items()
+    model_preproc.clear_vocab_counts()
+    nlp_cache.reset_stats()
+
+    indexed_preproc_items = []
+    for position, (index, item) in enumerate(indexed_items):
+        if position % PREFETCH_SIZE == 0:
+            next_items = indexed_items[position : position + PREFETCH_SIZE]
+            model_preproc.prefetch([next_item for _, next_item in next_items], section)
+        to_add, validation_info = model_preproc.validate_item(item, section)
+        if to_add:
+            num_preproc_items = len(model_preproc.preproc_items.get(section, []))
+            model_preproc.add_item(item, section, validation_info)
+            indexed_preproc_items.append(
+                (index, model_preproc.preproc_items[section][num_preproc_items:])
+            )
+
+    with open(shard_path + ".tmp", "wb") as f:
+        pickle.dump(indexed_preproc_items, f)
+    os.replace(shard_path + ".tmp", shard_path)
+    # pool workers are terminated without running exit handlers
+    nlp_cache.flush_all()
+    return model_preproc.vocab_counts(), nlp_cache.process_stats()
+
+
+def shard_by_db(data, shard_size):
+    """Shards of (index, item) pairs that keep all the items of a database together,
+    so that the schema of every database is counted only once in the vocabularies."""
+    items_by_db = OrderedDict()
+    for index, item in enumerate(data):
+        items_by_db.setdefault(item.spider_schema.db_id, []).append((index, item))
+    shards = [[]]
+    for db_items in items_by_db.values():
+        if len(shards[-1]) > 0 and len(shards[-1]) + len(db_items) > shard_size:
+            shards.append([])
+        shards[-1] += db_items
+    return shards
+
+
+def preprocess_sharded(jobs, num_workers, shard_size):
+    """Fan the shards of all the jobs out to a pool of workers, then merge the shards of
+    every job, in order, as soon as they are done. The shard files that are left when a
+    shard fails are removed. Returns the NLP cache statistics of the workers."""
+    pending_jobs, all_shard_paths = [], []
+    # hits and misses of the NLP caches of the workers
+    nlp_cache_stats = {}
+    try:
+        with multiprocessing.get_context("spawn").Pool(num_workers) as pool:
+            for config, section, keep_vocab in jobs:
+                save_path = config["model"]["preproc"]["save_path"]
+                os.makedirs(save_path, exist_ok=True)
+                data = registry.construct("dataset", config["data"][section])
+                shard_paths, results = [], []
+                for shard_index, indexed_items in enumerate(
+                    shard_by_db(data, shard_size)
+                ):
+                    shard_path = os.path.join(
+                        save_path, "{}.shard-{:05d}.pkl".format(section, shard_index)
+                    )
+                    shard_paths.append(shard_path)
+                    results.append(
+                        pool.apply_async(
+                            preprocess_shard,
+                            args=(
+                                config["model"]["preproc"],
+                                section,
+                                indexed_items,
+                                shard_path,
+                            ),
+                        )
+                    )
+                pending_jobs.append((config, section, keep_vocab, shard_paths, results))
+                all_shard_paths += shard_paths
+
+            for config, section, keep_vocab, shard_paths, results in pending_jobs:
+                desc = "{} ({})".format(
+                    section, config["model"]["preproc"]["save_path"]
+                )
+                shards_vocab_counts = []
+                for result in tqdm.tqdm(results, desc=desc, dynamic_ncols=True):
+                    vocab_counts, shard_nlp_cache_stats = result.get()
+                    shards_vocab_counts.append(vocab_counts)
+                    nlp_cache.add_stats(nlp_cache_stats, shard_nlp_cache_stats)
+                preprocessor = Preprocessor(config)
+                preprocessor.merge_shards(
+                    section, shard_paths, shards_vocab_counts, keep_vocab
+                )
+    finally:
+        # the workers are terminated by now
+        for shard_path in all_shard_paths:
+            for path in (shard_path, shard_path + ".tmp"):
+                if os.path.exists(path):
+                    os.remove(path)
+    return nlp_cache_stats
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", required=True)
@@ -41,6 +189,10 @@ def main():
     parser.add_argument("--keep-vocab", action='store_true',
                         help="Keep existing vocabulary files")
     parser.add_argument("--language_list", nargs='+', default= None)
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="Preprocess shards of the data in this many processes")
+    parser.add_argument("--shard_size", type=int, default=500,
+                        help="Approximate number of items per shard")
     args = parser.parse_args()
 
     if args.sections is None:
@@ -50,21 +202,27 @@ def main():
 
     config = json.loads(_jsonnet.evaluate_file(args.config))
 
+    jobs = []
     for language in args.language_list:
         for section in args.sections:
             config['model']['preproc']['save_path'] = './dataset/pkl/{}'.format(language)
             config['model']['preproc']['target_vocab_pkl_path'] = \
             os.path.join(config['model']['preproc']['save_path'], "target_vocab.pkl")
-     
+
             config['model']['preproc']['langs'][section]=language
             config['model']['preproc']['schema_linker']['tokenizer']['langs'] = [language]
 
-            if 'train' in section:
-                preprocessor = Preprocessor(config)
-                preprocessor.preprocess([section], False)
-            else:
-                preprocessor = Preprocessor(config)
-                preprocessor.preprocess([section], True)
+            jobs.append((copy.deepcopy(config), section, 'train' not in section))
+
+    if args.num_workers > 1:
+        nlp_cache_stats = preprocess_sharded(jobs, args.num_workers, args.shard_size)
+    else:
+        for job_config, section, keep_vocab in jobs:
+            preprocessor = Preprocessor(job_config)
+            preprocessor.preprocess([section], keep_vocab)
+        nlp_cache_stats = nlp_cache.process_stats()
+    if nlp_cache_stats:
+        print(nlp_cache.report(nlp_cache_stats))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,56 @@
+import argparse
+import json
+import _jsonnet
+import tqdm
+
+# noinspection PyUnresolvedReferences
+from duorat import datasets
+
+# noinspection PyUnresolvedReferences
+from duorat import preproc
+
+# noinspection PyUnresolvedReferences
+from duorat import models
+from duorat.utils import registry
+
+
+class Tensorizer:
+    def __init__(self, config):
+        self.config = config
+        self.model_preproc = registry.construct(
+            "preproc", self.config["model"]["preproc"],
+        )
+        self.model_preproc.load()
+        self.model = registry.construct(
+            "model", self.config["model"], preproc=self.model_preproc,
+        )
+
+    def tensorize(self, sections):
+        for section in sections:
+            data = self.model_preproc.dataset(section)
+            num_items = self.model.tensorize(
+                section, tqdm.tqdm(data, desc=section, dynamic_ncols=True)
+            )
+            print(f"{section}: {num_items} items in {self.model.item_store.path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the encoder and decoder items of preprocessed sections "
+        "and store them next to the preprocessed data, for training and evaluation."
+    )
+    parser.add_argument("--config", required=True)
+    parser.add_argument("--sections", nargs='+', default=None,
+                        help="Tensorize only the listed sections")
+    args = parser.parse_args()
+
+    if args.sections is None:
+        args.sections = ['train', 'val']
+
+    config = json.loads(_jsonnet.evaluate_file(args.config))
+    tensorizer = Tensorizer(config)
+    tensorizer.tensorize(args.sections)
+
+
+if __name__ == "__main__":
+    main()
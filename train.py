@@ -28,7 +28,7 @@ import itertools
 import json
 import os
 import traceback
-from typing import Type, List
+from typing import Type, List, Sequence
 
 import _jsonnet
 import torch
@@ -36,7 +36,7 @@ import numpy as np
 
 # noinspection PyUnresolvedReferences
 from torch.cuda.amp import autocast, GradScaler
-from torch.utils.data import DataLoader
+from torch.utils.data import ConcatDataset, DataLoader
 
 # noinspection PyUnresolvedReferences
 from duorat import datasets
@@ -51,6 +51,9 @@ from duorat import models
 from duorat.asdl.lang.spider.spider_transition_system import SpiderTransitionSystem
 from duorat.types import RATPreprocItem
 
+# noinspection PyUnresolvedReferences
+from duorat.utils import batching
+
 # noinspection PyUnresolvedReferences
 from duorat.utils import optimizers
 from duorat.utils import registry, parallelizer
@@ -219,19 +222,33 @@ class Trainer:
                 data_splits = [
                     section for section in self.config["data"] if "train" in section
                 ]
-            train_data = list(
-                itertools.chain.from_iterable(
-                    self.model_preproc.dataset(split) for split in data_splits
-                )
+            # the splits are concatenated lazily, items are read when they are batched
+            train_data = ConcatDataset(
+                [self.model_preproc.dataset(split) for split in data_splits]
             )
             self.logger.log(f"{len(train_data)} training examples")
 
-            train_data_loader = self._yield_batches_from_epochs(
-                DataLoader(
-                    train_data,
+            batch_sampler_config = self.config["train"].get("batch_sampler", None)
+            if batch_sampler_config is not None:
+                # e.g. {"name": "bucket", "max_tokens_squared": 2000000}
+                batching_kwargs = dict(
+                    batch_sampler=registry.construct(
+                        "batch_sampler",
+                        batch_sampler_config,
+                        data=train_data,
+                        batch_size=self.config["train"]["batch_size"],
+                    )
+                )
+            else:
+                batching_kwargs = dict(
                     batch_size=self.config["train"]["batch_size"],
                     shuffle=True,
                     drop_last=True,
+                )
+            train_data_loader = self._yield_batches_from_epochs(
+                DataLoader(
+                    train_data,
+                    **batching_kwargs,
                     collate_fn=lambda x: x,
                     pin_memory=True if torch.cuda.is_available() else False,
                     num_workers=8 if torch.cuda.is_available() else 0,
@@ -401,7 +418,9 @@ class Trainer:
         self.logger.log("Inferring...")
 
         orig_data = registry.construct("dataset", self.config["data"][eval_section])
-        preproc_data: List[RATPreprocItem] = self.model_preproc.dataset(eval_section)
+        preproc_data: Sequence[RATPreprocItem] = self.model_preproc.dataset(
+            eval_section
+        )
 
         self.model.eval()
         with torch.no_grad():
@@ -420,6 +439,7 @@ class Trainer:
                     decode_max_time_step=self.config["train"][
                         "eval_decode_max_time_step"
                     ],
+                    batch_size=self.config["train"].get("infer_batch_size", 1),
                 )
             )
         self.model.train()
@@ -435,34 +455,69 @@ class Trainer:
 
     @classmethod
     def _inner_infer(
-            cls, model, orig_data, preproc_data, nproc, beam_size, decode_max_time_step
+            cls,
+            model,
+            orig_data,
+            preproc_data,
+            nproc,
+            beam_size,
+            decode_max_time_step,
+            batch_size=1,
     ):
         if torch.cuda.is_available():
             cp = parallelizer.CUDAParallelizer(nproc)
         else:
             cp = parallelizer.CPUParallelizer(nproc)
-        return cp.parallel_map(
-            [
-                (
-                    functools.partial(
-                        cls._parse_single,
-                        model,
-                        beam_size=beam_size,
-                        decode_max_time_step=decode_max_time_step,
-                    ),
-                    list(enumerate(zip(orig_data, preproc_data))),
+        # Questions are parsed in batches of batch_size
+        items = list(enumerate(zip(orig_data, preproc_data)))
+        return itertools.chain.from_iterable(
+            cp.parallel_map(
+                [
+                    (
+                        functools.partial(
+                            cls._parse_batch,
+                            model,
+                            beam_size=beam_size,
+                            decode_max_time_step=decode_max_time_step,
+                        ),
+                        [
+                            items[i : i + batch_size]
+                            for i in range(0, len(items), batch_size)
+                        ],
+                    )
+                ]
+            )
+        )
+
+    @classmethod
+    def _parse_batch(cls, model, items, beam_size, decode_max_time_step):
+        batch = [preproc_item for _, (_, preproc_item) in items]
+
+        try:
+            batch_beams = model.parse_batch(batch, decode_max_time_step, beam_size)
+        except Exception as e:
+            if len(items) == 1:
+                ((index, _),) = items
+                result = {"index": index, "error": str(e), "trace": traceback.format_exc()}
+                return [json.dumps(result) + "\n"]
+            # Parse the questions one by one so that only the failing ones report an error
+            return [
+                line
+                for item in items
+                for line in cls._parse_batch(
+                    model, [item], beam_size, decode_max_time_step
                 )
             ]
-        )
+        return [
+            cls._format_beams(model, item, beams)
+            for item, beams in zip(items, batch_beams)
+        ]
 
     @staticmethod
-    def _parse_single(model, item, beam_size, decode_max_time_step):
-        index, (orig_item, preproc_item) = item
-        batch = [preproc_item]
+    def _format_beams(model, item, beams):
+        index, (orig_item, _preproc_item) = item
 
         try:
-            beams = model.parse(batch, decode_max_time_step, beam_size)
-
             decoded = []
             for beam in beams:
                 asdl_ast = beam.ast